@@ -40,11 +40,33 @@ class Config(BaseModel):
 
     pixiv_use_local_cache: bool = True
     pixiv_local_cache_type: Literal["sql", "file"] = "file"
+    pixiv_cache_codec: Literal["json", "orjson", "msgpack"] = "json"
+    pixiv_cache_write_behind: bool = True
+    pixiv_cache_write_behind_queue_size: int = 256
+    pixiv_cache_write_behind_flush_interval: float = 0.5
+    pixiv_sql_clean_batch_size: int = 500
+    pixiv_sql_clean_step_time_limit: int = 100  # 单位：毫秒
+    pixiv_sql_vacuum: Literal["none", "incremental", "full"] = "none"
+    pixiv_sql_image_storage: Literal["database", "file"] = "file"
+    pixiv_sql_sqlite_wal: bool = True
+    pixiv_sql_sqlite_pool_size: int = 5
+    pixiv_sql_sqlite_busy_timeout: int = 5000  # 单位：毫秒
+    pixiv_sql_sqlite_mmap_size: int = 256 * 1024 * 1024  # 单位：字节
+    pixiv_sql_sqlite_cache_size: int = 16 * 1024  # 单位：KiB
 
     pixiv_proxy: Optional[str] = None
     pixiv_query_timeout: float = 60.0
     pixiv_loading_prompt_delayed_time: float = 5.0
     pixiv_simultaneous_query: int = 8
+    pixiv_query_prefetch_pages: int = 1
+    pixiv_query_max_rate: float = 5.0
+    pixiv_query_min_rate: float = 0.2
+    pixiv_query_burst: int = 10
+    pixiv_query_queue_timeout: float = 30.0
+    pixiv_query_interactive_reserved: int = 2
+    pixiv_query_interactive_weight: int = 4
+    pixiv_query_subscription_weight: int = 2
+    pixiv_query_watch_weight: int = 1
 
     pixiv_download_cache_expires_in: int = 3600 * 24 * 7
     pixiv_illust_detail_cache_expires_in: int = 3600 * 24 * 7
@@ -60,6 +82,12 @@ class Config(BaseModel):
     pixiv_user_bookmarks_cache_delete_in: int = 3600 * 24 * 30
     pixiv_related_illusts_cache_expires_in: int = 3600 * 24
     pixiv_other_cache_expires_in: int = 3600 * 6
+    pixiv_negative_cache_expires_in: int = 3600
+    pixiv_cache_stale_grace: Dict[str, int] = {"illust_detail": 3600 * 24,
+                                                "illust_ranking": 3600,
+                                                "recommended_illusts": 3600}
+    pixiv_shared_agen_max_bytes: int = 256 * 1024 * 1024  # 单位：字节
+    pixiv_shared_agen_max_bytes_by_type: Dict[str, int] = {"image": 128 * 1024 * 1024}
 
     pixiv_block_tags: List[str] = []
     pixiv_block_action: BlockAction = BlockAction.no_image
@@ -67,10 +95,18 @@ class Config(BaseModel):
     pixiv_exclude_ai_illusts: bool = False
 
     pixiv_download_custom_domain: Optional[str] = None
+    pixiv_download_max_bytes: int = 64 * 1024 * 1024
+    pixiv_download_quantity: DownloadQuantity = DownloadQuantity.original
+    pixiv_download_quantity_by_platform: Dict[str, DownloadQuantity] = {}
+    pixiv_download_original_max_bytes: int = 0
 
     pixiv_compression_enabled: bool = False
     pixiv_compression_max_size: int = 1200
     pixiv_compression_quantity: float = 0.8
+    pixiv_compression_format: Literal["jpeg", "webp", "avif"] = "jpeg"
+    pixiv_compression_max_pixels: int = 64 * 1024 * 1024
+    pixiv_compression_executor: Literal["process", "thread"] = "thread"
+    pixiv_compression_workers: int = 0
 
     pixiv_query_to_me_only: bool = False
     pixiv_command_to_me_only: bool = False
@@ -85,6 +121,10 @@ class Config(BaseModel):
     pixiv_max_page_per_illust: int = 10
 
     pixiv_tag_translation_enabled: bool = True
+    pixiv_tag_cache_size: int = 65536
+    pixiv_tag_flush_interval: int = 30  # 单位：秒
+    pixiv_tag_fuzzy_search_enabled: bool = False
+    pixiv_tag_fuzzy_search_threshold: float = 0.6
 
     pixiv_more_enabled: bool = True
     pixiv_query_expires_in: int = 10 * 60
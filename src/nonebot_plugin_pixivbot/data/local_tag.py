@@ -1,13 +1,21 @@
-from typing import Optional, Collection
+import asyncio
+from functools import partial
+from typing import Optional, Collection, Dict
 
+from apscheduler.triggers.interval import IntervalTrigger
+from cachetools import LRUCache
 from nonebot import logger
+from nonebot_plugin_apscheduler import scheduler as apscheduler
 from sqlalchemy import select
 from sqlalchemy.orm import mapped_column, Mapped
 
 from .source.sql import DataSource
 from .utils.sql import insert
+from ..config import Config
 from ..global_context import context
 from ..model import Tag, Illust
+from ..utils.lifecycler import on_startup
+from ..utils.tag_index import TagSearchIndex
 
 
 @DataSource.registry.mapped
@@ -18,56 +26,201 @@ class LocalTag:
     translated_name: Mapped[str] = mapped_column(index=True)
 
 
+conf = context.require(Config)
 data_source = context.require(DataSource)
 
+# 查询过但不存在的标签（避免每次查询都访问数据库）
+_NOT_FOUND = None
+_MISSING = object()
+
+# 脏标签积累到这个数量时立即在后台写入数据库
+_FLUSH_THRESHOLD = 1024
+# 每条INSERT语句写入的最大行数
+_FLUSH_BATCH_SIZE = 500
+
 
 @context.register_singleton()
 class LocalTagRepo:
+    """
+    在内存中维护 标签名->翻译 与 翻译->标签名 的双向索引（LRU），启动时从数据库预热
+    更新只修改内存中的索引并记为脏，由后台任务定期批量写入数据库
+    另外维护一个模糊搜索索引，热度为标签在缓存的插画中出现的次数
+    """
+
+    def __init__(self):
+        maxsize = max(1, conf.pixiv_tag_cache_size)
+        self._by_name: LRUCache[str, Optional[str]] = LRUCache(maxsize=maxsize)
+        self._by_translated: LRUCache[str, Optional[str]] = LRUCache(maxsize=maxsize)
+        self._index: Optional[TagSearchIndex] = \
+            TagSearchIndex(maxsize) if conf.pixiv_tag_fuzzy_search_enabled else None
+
+        self._dirty: Dict[str, str] = {}
+        self._flushing: Dict[str, str] = {}
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+        data_source.on_initialized(self.warm_up)
+        # 必须在数据库关闭之前写入
+        data_source.on_closing(self.flush)
+
+        on_startup(replay=True)(
+            partial(
+                apscheduler.add_job,
+                self.flush,
+                id='pixivbot_local_tag_flush',
+                trigger=IntervalTrigger(seconds=conf.pixiv_tag_flush_interval),
+                max_instances=1
+            )
+        )
+
+    def _index_tag(self, name: str, translated_name: Optional[str], hits: int = 0):
+        if self._index is not None:
+            self._index.add(name, name, hits)
+            if translated_name:
+                self._index.add(translated_name, name, hits)
+
+    def _put(self, name: str, translated_name: str):
+        old = self._by_name.get(name)
+        if old is not None and old != translated_name and self._by_translated.get(old) == name:
+            # 数据库中可能还是旧的翻译，因此记为不存在而不是删除
+            self._by_translated[old] = _NOT_FOUND
+
+        self._by_name[name] = translated_name
+        self._by_translated[translated_name] = name
+        self._index_tag(name, translated_name)
+
+    async def warm_up(self):
+        async with data_source.start_session() as session:
+            stmt = select(LocalTag.name, LocalTag.translated_name).limit(self._by_name.maxsize)
+            result = await session.execute(stmt)
+            n = 0
+            for name, translated_name in result:
+                self._put(name, translated_name)
+                n += 1
+        logger.debug(f"[local_tag_repo] loaded {n} local tags")
 
     async def find_by_name(self, name: str) -> Optional[Tag]:
-        async with data_source.start_session() as session:
-            stmt = select(LocalTag).where(LocalTag.name == name).limit(1)
-            local_tag = (await session.execute(stmt)).scalar_one_or_none()
+        translated_name = self._dirty.get(name) or self._flushing.get(name) or self._by_name.get(name, _MISSING)
+
+        if translated_name is _MISSING:
+            async with data_source.start_session() as session:
+                stmt = select(LocalTag).where(LocalTag.name == name).limit(1)
+                local_tag = (await session.execute(stmt)).scalar_one_or_none()
+
             if local_tag is not None:
-                return Tag.from_orm(local_tag)
+                translated_name = local_tag.translated_name
+                self._put(name, translated_name)
             else:
-                return None
+                translated_name = _NOT_FOUND
+                self._by_name[name] = _NOT_FOUND
+
+        if translated_name is _NOT_FOUND:
+            return None
+        return Tag(name=name, translated_name=translated_name)
 
     async def find_by_translated_name(self, translated_name: str) -> Optional[Tag]:
-        async with data_source.start_session() as session:
-            stmt = select(LocalTag).where(LocalTag.translated_name == translated_name).limit(1)
-            local_tag = (await session.execute(stmt)).scalar_one_or_none()
+        name = self._by_translated.get(translated_name, _MISSING)
+
+        if name is _MISSING:
+            async with data_source.start_session() as session:
+                stmt = select(LocalTag).where(LocalTag.translated_name == translated_name).limit(1)
+                local_tag = (await session.execute(stmt)).scalar_one_or_none()
+
             if local_tag is not None:
-                return Tag.from_orm(local_tag)
+                name = local_tag.name
+                self._put(name, translated_name)
             else:
-                return None
+                name = _NOT_FOUND
+                self._by_translated[translated_name] = _NOT_FOUND
+
+        if name is _NOT_FOUND:
+            return None
+        return Tag(name=name, translated_name=translated_name)
+
+    async def find_similar(self, word: str) -> Optional[Tag]:
+        """
+        模糊搜索与word最相似的标签（只搜索内存中的索引）
+        """
+        if self._index is None:
+            return None
+
+        name = self._index.best_match(word, conf.pixiv_tag_fuzzy_search_threshold)
+        if name is None:
+            return None
+        translated_name = self._dirty.get(name) or self._by_name.get(name)
+        return Tag(name=name, translated_name=translated_name)
 
     async def update_one(self, tag: Tag):
         await self.update_many([tag])
 
     async def update_many(self, tags: Collection[Tag]):
-        if len(tags) == 0:
-            return
+        n = 0
+        for t in tags:
+            if not t.translated_name:
+                continue
 
-        async with data_source.start_session() as session:
-            stmt = insert(LocalTag).values([t.dict() for t in tags])
-            stmt = stmt.on_conflict_do_update(index_elements=[LocalTag.name],
-                                              set_={
-                                                  LocalTag.translated_name: stmt.excluded.translated_name
-                                              })
+            # 翻译没有变化的标签不需要写入
+            if self._dirty.get(t.name, self._by_name.get(t.name)) == t.translated_name:
+                continue
 
-            await session.execute(stmt)
-            await session.commit()
-            logger.debug(f"[local_tag_repo] added {len(tags)} local tags")
+            self._put(t.name, t.translated_name)
+            self._dirty[t.name] = t.translated_name
+            n += 1
+
+        if n > 0:
+            logger.trace(f"[local_tag_repo] {n} local tags changed, {len(self._dirty)} pending")
+
+        if len(self._dirty) >= _FLUSH_THRESHOLD and (self._flush_task is None or self._flush_task.done()):
+            # 调用方可能正持有数据库的写入锁（如延迟写入的事务中），因此不在这里等待写入
+            self._flush_task = asyncio.create_task(self._flush_in_background())
 
     async def update_from_illusts(self, illusts: Collection[Illust]):
         tags = {}
         for x in illusts:
             for t in x.tags:
+                self._index_tag(t.name, t.translated_name, hits=1)
                 if t.translated_name:
                     tags[t.name] = t
 
         await self.update_many(tags.values())
 
+    async def _flush_in_background(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.opt(exception=e).error("[local_tag_repo] failed to flush local tags")
+
+    async def flush(self):
+        """
+        把脏标签批量写入数据库
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            if len(self._dirty) == 0:
+                return
+
+            self._flushing, self._dirty = self._dirty, {}
+            try:
+                rows = [{"name": k, "translated_name": v} for k, v in self._flushing.items()]
+                async with data_source.start_session(write=True) as session:
+                    for i in range(0, len(rows), _FLUSH_BATCH_SIZE):
+                        stmt = insert(LocalTag).values(rows[i:i + _FLUSH_BATCH_SIZE])
+                        stmt = stmt.on_conflict_do_update(index_elements=[LocalTag.name],
+                                                          set_={
+                                                              LocalTag.translated_name: stmt.excluded.translated_name
+                                                          })
+                        await session.execute(stmt)
+                    await session.commit()
+                logger.debug(f"[local_tag_repo] added {len(rows)} local tags")
+            except BaseException:
+                # 写入失败时放回，下次再写入（期间更新过的以新的为准）
+                for k, v in self._flushing.items():
+                    self._dirty.setdefault(k, v)
+                raise
+            finally:
+                self._flushing = {}
+
 
 __all__ = ("LocalTagRepo",)
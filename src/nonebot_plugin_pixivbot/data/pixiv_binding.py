@@ -39,7 +39,7 @@ class PixivBindingRepo:
                 return None
 
     async def update(self, binding: PixivBinding):
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             stmt = (insert(PixivBindingOrm)
                     .values(platform=binding.platform,
                             user_id=binding.user_id,
@@ -52,7 +52,7 @@ class PixivBindingRepo:
             await session.commit()
 
     async def remove(self, platform: str, user_id: str) -> bool:
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             stmt = (delete(PixivBindingOrm)
                     .where(PixivBindingOrm.platform == platform,
                            PixivBindingOrm.user_id == user_id))
@@ -1,6 +1,6 @@
 from typing import Union, AsyncGenerator, Protocol
 
-from nonebot_plugin_pixivbot.enums import RankingMode
+from nonebot_plugin_pixivbot.enums import RankingMode, DownloadQuantity
 from nonebot_plugin_pixivbot.model import Illust, User
 from .lazy_illust import LazyIllust
 from .models import PixivRepoMetadata
@@ -35,7 +35,9 @@ class PixivRepo(Protocol):
             -> AsyncGenerator[Union[LazyIllust, PixivRepoMetadata], None]:
         ...
 
-    def image(self, illust: Illust, page: int = 0) -> AsyncGenerator[Union[bytes, PixivRepoMetadata], None]:
+    def image(self, illust: Illust, page: int = 0,
+              quantity: DownloadQuantity = DownloadQuantity.original) \
+            -> AsyncGenerator[Union[bytes, PixivRepoMetadata], None]:
         ...
 
 
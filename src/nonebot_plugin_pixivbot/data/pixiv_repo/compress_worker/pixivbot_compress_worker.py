@@ -0,0 +1,78 @@
+"""
+压缩的工作进程执行的代码
+
+进程池以spawn/forkserver方式启动工作进程，工作进程反序列化任务时需要导入这里的函数。
+导入nonebot_plugin_pixivbot的任何子模块都会执行插件的__init__，而插件只能在nonebot初始化之后导入，
+因此这个模块不属于插件包（由compressor按文件路径加载），并且只依赖Pillow
+"""
+
+from dataclasses import dataclass
+from io import BytesIO
+from time import perf_counter
+from typing import Tuple
+
+from PIL import Image
+
+_PIL_FORMATS = {
+    "jpeg": "JPEG",
+    "webp": "WEBP",
+    "avif": "AVIF",
+}
+
+
+@dataclass
+class CompressionJobStats:
+    queue_time: float = 0.0  # 等待执行器的时间（单位：秒，下同）
+    decode_time: float = 0.0
+    resize_time: float = 0.0
+    encode_time: float = 0.0
+    input_size: int = 0  # 单位：字节
+    output_size: int = 0
+
+
+class ImageTooLargeError(ValueError):
+    pass
+
+
+def _compress(content: bytes, max_size: int, quality: int, format: str, max_pixels: int) \
+        -> Tuple[bytes, CompressionJobStats]:
+    # 在工作进程中执行，只接收与返回可pickle的对象
+    stats = CompressionJobStats(input_size=len(content))
+
+    begin = perf_counter()
+    try:
+        img = Image.open(BytesIO(content))
+
+        w, h = img.size
+        if 0 < max_pixels < w * h:
+            raise ImageTooLargeError(f"image too large: {w}x{h}")
+
+        # 对于JPEG，让解码器直接以1/2、1/4或1/8的尺寸解码
+        img.draft("RGB", (max_size, max_size))
+        img.load()
+    except Image.DecompressionBombError as e:
+        # 像素数超过Pillow的上限（MAX_IMAGE_PIXELS的两倍）时，在检查max_pixels之前open就会抛出
+        raise ImageTooLargeError(str(e)) from None
+    stats.decode_time = perf_counter() - begin
+
+    begin = perf_counter()
+    w, h = img.size
+    if w > max_size or h > max_size:
+        ratio = min(max_size / w, max_size / h)
+        img = img.resize((int(ratio * w), int(ratio * h)), Image.Resampling.LANCZOS)
+
+    if format == "jpeg" or img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if format != "jpeg" and img.has_transparency_data else "RGB")
+    stats.resize_time = perf_counter() - begin
+
+    begin = perf_counter()
+    with BytesIO() as bio:
+        if format == "jpeg":
+            img.save(bio, format="JPEG", optimize=True, quality=quality)
+        else:
+            img.save(bio, format=_PIL_FORMATS[format], quality=quality)
+        result = bio.getvalue()
+    stats.encode_time = perf_counter() - begin
+    stats.output_size = len(result)
+
+    return result, stats
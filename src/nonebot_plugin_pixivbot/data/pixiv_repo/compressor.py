@@ -1,55 +1,140 @@
 import asyncio
 import functools
 import multiprocessing
-from concurrent.futures.thread import ThreadPoolExecutor
-from io import BytesIO
+import sys
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from time import perf_counter
+from typing import Tuple
 
-from PIL import Image, ImageFile
+from PIL import features
+from nonebot import logger
 
 from nonebot_plugin_pixivbot.config import Config
 from nonebot_plugin_pixivbot.global_context import context
+from nonebot_plugin_pixivbot.utils.lifecycler import on_shutdown
+
+# 按文件路径加载压缩函数所在的模块，而不修改sys.path
+# 模块名不能带点：工作进程反序列化时会导入模块名的每一级，导入插件包需要nonebot已初始化
+_WORKER_NAME = "nonebot_plugin_pixivbot_compress_worker"
+_WORKER_LOADER = f"""
+import importlib.util, sys
+if {_WORKER_NAME!r} not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+        {_WORKER_NAME!r}, {str(Path(__file__).parent / "compress_worker" / "pixivbot_compress_worker.py")!r})
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+"""
+
+exec(_WORKER_LOADER, {})
+_worker = sys.modules[_WORKER_NAME]
+CompressionJobStats = _worker.CompressionJobStats
+ImageTooLargeError = _worker.ImageTooLargeError
+_compress = _worker._compress
 
 conf = context.require(Config)
 
 
+@dataclass
+class CompressionStats:
+    jobs: int = 0
+    skipped: int = 0  # 超过像素上限而没有压缩的任务数
+    queue_time: float = 0.0
+    decode_time: float = 0.0
+    resize_time: float = 0.0
+    encode_time: float = 0.0
+    input_size: int = 0
+    output_size: int = 0
+
+    def add(self, job: CompressionJobStats):
+        self.jobs += 1
+        self.queue_time += job.queue_time
+        self.decode_time += job.decode_time
+        self.resize_time += job.resize_time
+        self.encode_time += job.encode_time
+        self.input_size += job.input_size
+        self.output_size += job.output_size
+
+
+def _check_format(format: str) -> str:
+    if format == "jpeg":
+        return format
+
+    try:
+        supported = features.check(format)
+    except ValueError:
+        supported = False
+
+    if not supported:
+        logger.warning(f"[compressor] {format} is not supported by current Pillow, fall back to jpeg")
+        return "jpeg"
+    return format
+
+
+def _create_executor(kind: str, workers: int) -> Executor:
+    if kind == "process":
+        # 不使用fork：事件循环所在的进程有多个线程，fork出的子进程可能因为继承了被持有的锁而死锁
+        # 注意forkserver与spawn启动的工作进程会重新导入主模块（即bot.py），启动bot的语句应放在if __name__ == "__main__"内
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            method = "forkserver"
+        else:
+            method = "spawn"
+        return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(method),
+                                   initializer=exec, initargs=(_WORKER_LOADER, {}))
+
+    return ThreadPoolExecutor(workers, "compressor")
+
+
 @context.register_singleton()
 class Compressor:
 
     def __init__(self) -> None:
         self.enabled = conf.pixiv_compression_enabled
         self.max_size = conf.pixiv_compression_max_size
-        self.quantity = conf.pixiv_compression_quantity
+        self.quality = max(1, min(95, round(conf.pixiv_compression_quantity * 100)))
+        self.max_pixels = conf.pixiv_compression_max_pixels
+        self.stats = CompressionStats()
 
         if self.enabled:
-            cpu_count = multiprocessing.cpu_count()
-            self._executor = ThreadPoolExecutor(cpu_count, "compressor")
-            # logger.info(f"A ThreadPool with {cpu_count} worker(s) was created for compression")
+            self.format = _check_format(conf.pixiv_compression_format)
+
+            workers = conf.pixiv_compression_workers or multiprocessing.cpu_count()
+            self._executor = _create_executor(conf.pixiv_compression_executor, workers)
+            logger.info(f"[compressor] {type(self._executor).__name__} with {workers} worker(s) "
+                        f"was created for compression (format: {self.format}, quality: {self.quality})")
+
+            on_shutdown()(self.shutdown)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
 
     async def compress(self, content: bytes) -> bytes:
         if self.enabled:
-            loop = asyncio.get_running_loop()
-            task = loop.run_in_executor(
-                self._executor, functools.partial(self._compress, content))
-            return await task
-        else:
-            return content
-
-    def _compress(self, content: bytes) -> bytes:
-        p = ImageFile.Parser()
-        p.feed(content)
-        img = p.close()
-
-        w, h = img.size
-        if w > self.max_size or h > self.max_size:
-            ratio = min(self.max_size / w,
-                        self.max_size / h)
-            img_cp = img.resize(
-                (int(ratio * w), int(ratio * h)), Image.ANTIALIAS)
-        else:
-            img_cp = img.copy()
-        img_cp = img_cp.convert("RGB")
+            content, _ = await self.compress_with_stats(content)
+        return content
+
+    async def compress_with_stats(self, content: bytes) -> Tuple[bytes, CompressionJobStats]:
+        if not self.enabled:
+            return content, CompressionJobStats(input_size=len(content), output_size=len(content))
+
+        loop = asyncio.get_running_loop()
+        begin = perf_counter()
+        try:
+            result, stats = await loop.run_in_executor(
+                self._executor,
+                functools.partial(_compress, content, self.max_size, self.quality, self.format, self.max_pixels))
+        except ImageTooLargeError as e:
+            logger.warning(f"[compressor] {e}, skip compression")
+            self.stats.skipped += 1
+            return content, CompressionJobStats(input_size=len(content), output_size=len(content))
+
+        elapsed = perf_counter() - begin
+        stats.queue_time = max(0.0, elapsed - stats.decode_time - stats.resize_time - stats.encode_time)
+        self.stats.add(stats)
+        logger.trace(f"[compressor] {stats}")
+        return result, stats
+
 
-        with BytesIO() as bio:
-            img_cp.save(bio, format="JPEG", optimize=True,
-                        quantity=self.quantity)
-            return bio.getvalue()
+__all__ = ("Compressor", "CompressionStats", "CompressionJobStats")
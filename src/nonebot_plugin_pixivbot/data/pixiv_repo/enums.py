@@ -17,3 +17,9 @@ class PixivResType(Enum):
 class CacheStrategy(Enum):
     NORMAL = 0
     FORCE_EXPIRATION = 1
+
+
+class QueryLane(Enum):
+    INTERACTIVE = 0  # 用户主动发起的查询
+    SUBSCRIPTION = 1  # 定时订阅
+    WATCH = 2  # 更新推送
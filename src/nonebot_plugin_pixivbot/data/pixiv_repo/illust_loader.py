@@ -0,0 +1,106 @@
+import asyncio
+from asyncio import Future
+from typing import Dict, Optional, Set
+
+from nonebot import logger
+
+from nonebot_plugin_pixivbot.global_context import context
+from nonebot_plugin_pixivbot.model import Illust
+from nonebot_plugin_pixivbot.utils.lazy_delegation import LazyDelegation
+
+__all__ = ("IllustDetailLoader",)
+
+
+def _get_repo():
+    from .base import PixivRepo
+    return context.require(PixivRepo)
+
+
+def _get_local():
+    from .local_repo import LocalPixivRepo
+    return context.require(LocalPixivRepo)
+
+
+@context.register_singleton()
+class IllustDetailLoader:
+    """
+    批量加载插画详情：同一轮事件循环内请求的插画合并为一批，
+    先从本地缓存一次性查询，未命中的再并发地向远程查询
+    """
+    repo = LazyDelegation(_get_repo)
+    local = LazyDelegation(_get_local)
+
+    def __init__(self):
+        self._pending: Dict[int, Future] = {}
+        # 持有正在执行的批次的引用，避免任务在执行期间被回收
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def load(self, illust_id: int) -> Optional[Illust]:
+        fut = self._pending.get(illust_id)
+        if fut is None:
+            loop = asyncio.get_running_loop()
+            if len(self._pending) == 0:
+                # 等到当前这一轮的其他协程都提交了请求再分发
+                loop.call_soon(self._dispatch)
+            fut = loop.create_future()
+            self._pending[illust_id] = fut
+
+        # 多个请求共享同一个future，某个请求被取消时不影响其他请求
+        return await asyncio.shield(fut)
+
+    def _dispatch(self):
+        batch, self._pending = self._pending, {}
+        if len(batch) != 0:
+            task = asyncio.create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: Dict[int, Future]):
+        try:
+            await self._load_batch(batch)
+        except BaseException as e:
+            # 出现意外的异常时，使还未完成的请求失败，而不是一直等待
+            if not isinstance(e, asyncio.CancelledError):
+                logger.opt(exception=e).error("[illust_loader] failed to load illusts")
+            for fut in batch.values():
+                if fut.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    fut.cancel()
+                else:
+                    fut.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+
+    async def _load_batch(self, batch: Dict[int, Future]):
+        logger.debug(f"[illust_loader] loading {len(batch)} illusts")
+
+        try:
+            found = await self.local.illust_details(list(batch.keys()))
+        except Exception as e:
+            logger.opt(exception=e).warning("[illust_loader] failed to load illusts from local cache")
+            found = {}
+
+        for illust_id, illust in found.items():
+            fut = batch.get(illust_id)
+            if fut is not None and not fut.done():
+                fut.set_result(illust)
+
+        # 未命中本地缓存（或已过期）的通过repo加载，由repo负责共享查询、负缓存与限流
+        await asyncio.gather(*[self._load_one(illust_id, fut)
+                               for illust_id, fut in batch.items() if illust_id not in found])
+
+    async def _load_one(self, illust_id: int, fut: Future):
+        try:
+            result = None
+            async for x in self.repo.illust_detail(illust_id):
+                result = x
+                break
+            if not fut.done():
+                fut.set_result(result)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
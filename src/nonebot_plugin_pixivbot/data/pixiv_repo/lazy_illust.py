@@ -2,38 +2,52 @@ from __future__ import annotations
 
 from typing import Optional
 
-from nonebot_plugin_pixivbot.model import Illust
+from nonebot_plugin_pixivbot.model import Illust, LightIllust
 from nonebot_plugin_pixivbot.utils.lazy_delegation import LazyDelegation
 
 __all__ = ("LazyIllust",)
 
 
-def _get_src():
-    from .base import PixivRepo
+def _get_loader():
+    from .illust_loader import IllustDetailLoader
     from nonebot_plugin_pixivbot.global_context import context
-    return context.require(PixivRepo)
+    return context.require(IllustDetailLoader)
 
 
 class LazyIllust:
-    src = LazyDelegation(_get_src)
+    loader = LazyDelegation(_get_loader)
 
-    def __init__(self, id: int, content: Optional[Illust] = None) -> None:
+    def __init__(self, id: int, content: Optional[Illust] = None, light: Optional[LightIllust] = None) -> None:
         self.id = id
         self.content = content
+        self._light = light
 
     async def get(self) -> Illust:
         if self.content is None:
-            async for x in self.src.illust_detail(self.id):
-                self.content = x
-                break
+            # 同时加载的插画由loader合并为一批查询，需要加载多个时应并发地调用
+            self.content = await self.loader.load(self.id)
         return self.content
 
     @property
     def loaded(self):
         return self.content is not None
 
+    @property
+    def light(self) -> Optional[LightIllust]:
+        """
+        插画的投影：只查询了投影时不需要加载完整的插画
+        """
+        if self._light is None and self.content is not None:
+            self._light = LightIllust.from_illust(self.content)
+        return self._light
+
     def __getattr__(self, attr):
-        if self.content is None:
-            return None
-        else:
+        if self.content is not None:
             return self.content.__getattribute__(attr)
+        elif self._light is not None and attr in _LIGHT_FIELDS:
+            return self._light.__getattribute__(attr)
+        else:
+            return None
+
+
+_LIGHT_FIELDS = {"total_bookmarks", "total_view", "create_date", "illust_ai_type"}
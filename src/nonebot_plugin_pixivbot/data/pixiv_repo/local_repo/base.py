@@ -1,6 +1,6 @@
-from typing import List, Union
+from typing import List, Union, Optional, Dict, Collection
 
-from nonebot_plugin_pixivbot.enums import RankingMode
+from nonebot_plugin_pixivbot.enums import RankingMode, DownloadQuantity
 from nonebot_plugin_pixivbot.model import Illust, User
 from ..base import PixivRepo
 from ..lazy_illust import LazyIllust
@@ -8,6 +8,14 @@ from ..models import PixivRepoMetadata
 
 
 class LocalPixivRepo(PixivRepo):
+    async def illust_details(self, illust_ids: Collection[int]) -> Dict[int, Illust]:
+        """
+        批量查询插画详情
+
+        :return: 未过期的插画详情，不存在或已过期的插画不包含在内
+        """
+        ...
+
     async def update_illust_detail(self, illust: Illust, metadata: PixivRepoMetadata):
         ...
 
@@ -71,7 +79,17 @@ class LocalPixivRepo(PixivRepo):
         ...
 
     async def update_image(self, illust_id: int, page: int, content: bytes,
-                           metadata: PixivRepoMetadata):
+                           metadata: PixivRepoMetadata,
+                           quantity: DownloadQuantity = DownloadQuantity.original):
+        ...
+
+    async def negative_result(self, res_type: str, id: int) -> Optional[str]:
+        """
+        :return: 未过期的查询失败的原因，没有时返回None
+        """
+        ...
+
+    async def update_negative_result(self, res_type: str, id: int, reason: str):
         ...
 
     async def invalidate_all(self):
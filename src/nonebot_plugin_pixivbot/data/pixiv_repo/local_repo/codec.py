@@ -0,0 +1,295 @@
+import json
+import typing
+from datetime import datetime, date
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar
+
+from nonebot import logger
+from nonebot.compat import PYDANTIC_V2, model_dump
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+T = TypeVar("T", bound=BaseModel)
+
+
+def _default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Enum):
+        return obj.value
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+# ================ codec ================
+# 编码结果的第一个字节标记格式，解码时据此选择解码器，因此切换编解码器后旧缓存仍然可读
+# 以'{'或'['开头的视为没有标记的JSON（切换前写入的缓存）
+_TAG_JSON = b"J"
+_TAG_MSGPACK = b"M"
+
+
+class Codec:
+    name: str
+    tag: bytes
+
+    def dumps(self, obj: Any) -> bytes:
+        raise NotImplementedError()
+
+    def loads(self, data: bytes) -> Any:
+        raise NotImplementedError()
+
+
+class JsonCodec(Codec):
+    name = "json"
+    tag = _TAG_JSON
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(Codec):
+    name = "orjson"
+    tag = _TAG_JSON
+
+    def dumps(self, obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default)
+
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+    tag = _TAG_MSGPACK
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+def get_codec(name: str) -> Codec:
+    if name == "msgpack":
+        if msgpack is not None:
+            return MsgpackCodec()
+        logger.warning("[codec] msgpack is not installed, fall back to orjson/json")
+        name = "orjson"
+
+    if name == "orjson":
+        if orjson is not None:
+            return OrjsonCodec()
+        logger.warning("[codec] orjson is not installed, fall back to json")
+
+    return JsonCodec()
+
+
+# JSON总是用能找到的最快的库解码
+_json_decoder: Codec = OrjsonCodec() if orjson is not None else JsonCodec()
+
+
+def encode(obj: Any, codec: Codec) -> bytes:
+    return codec.tag + codec.dumps(obj)
+
+
+def decode(data: bytes) -> Any:
+    tag = data[:1]
+    if tag == _TAG_JSON:
+        return _json_decoder.loads(data[1:])
+    elif tag == _TAG_MSGPACK:
+        if msgpack is None:
+            raise ValueError("msgpack is required to decode this data")
+        return msgpack.unpackb(data[1:], raw=False)
+    elif tag in (b"{", b"["):
+        return _json_decoder.loads(data)
+    else:
+        raise ValueError(f"unknown codec tag: {tag}")
+
+
+# ================ model ================
+def dump_model(model: BaseModel) -> Dict[str, Any]:
+    return model_dump(model)
+
+
+_Converter = Callable[[Any], Any]
+_MISSING = object()
+
+
+class _ModelPlan:
+    """
+    构造某个模型所需的信息，每个模型只计算一次
+    fields中每项为(字段名, 转换函数, 默认值)，默认值为_MISSING表示必填，为None则在缺失时调用default_factory
+    """
+
+    def __init__(self, t: Type[BaseModel]):
+        self.t = t
+        self.fields: List[Tuple[str, Optional[_Converter], Any]] = []
+        self.default_factories: Dict[str, Callable[[], Any]] = {}
+
+        if PYDANTIC_V2:
+            for name, field in t.model_fields.items():
+                if field.is_required():
+                    default = _MISSING
+                elif field.default_factory is not None:
+                    default = None
+                    self.default_factories[name] = field.default_factory
+                else:
+                    default = field.default
+                self.fields.append((name, _converter_of(field.annotation), default))
+
+            # 只有普通的模型可以直接填充__dict__，其余情况交给model_construct
+            self.direct = (not t.__pydantic_root_model__
+                           and not t.__pydantic_post_init__
+                           and not t.__private_attributes__
+                           and t.model_config.get("extra") != "allow")
+        else:
+            for name, field in t.__fields__.items():
+                if field.required:
+                    default = _MISSING
+                elif field.default_factory is not None:
+                    default = None
+                    self.default_factories[name] = field.default_factory
+                else:
+                    default = field.default
+                self.fields.append((name, _converter_of(field.outer_type_), default))
+            self.direct = False
+
+    def construct(self, obj: Dict[str, Any]) -> BaseModel:
+        values = {}
+        for name, converter, default in self.fields:
+            v = obj.get(name, _MISSING)
+            if v is _MISSING:
+                if default is _MISSING:
+                    raise ValueError(f"missing field {name} of {self.t.__name__}")
+                elif default is None and name in self.default_factories:
+                    v = self.default_factories[name]()
+                else:
+                    v = default
+            elif converter is not None and v is not None:
+                v = converter(v)
+            values[name] = v
+
+        if self.direct:
+            m = self.t.__new__(self.t)
+            _object_setattr(m, "__dict__", values)
+            _object_setattr(m, "__pydantic_fields_set__", set(values))
+            _object_setattr(m, "__pydantic_extra__", None)
+            _object_setattr(m, "__pydantic_private__", None)
+            return m
+        elif PYDANTIC_V2:
+            return self.t.model_construct(**values)
+        else:
+            return self.t.construct(**values)
+
+
+_object_setattr = object.__setattr__
+_plans: Dict[type, _ModelPlan] = {}
+
+
+def _plan_of(t: Type[BaseModel]) -> _ModelPlan:
+    plan = _plans.get(t)
+    if plan is None:
+        plan = _ModelPlan(t)
+        _plans[t] = plan
+    return plan
+
+
+def _parse_datetime(v):
+    if isinstance(v, str):
+        if v.endswith("Z"):
+            v = v[:-1] + "+00:00"
+        return datetime.fromisoformat(v)
+    return v
+
+
+def _converter_of(annotation) -> Optional[_Converter]:
+    origin = typing.get_origin(annotation)
+    if origin is typing.Union:
+        args = [x for x in typing.get_args(annotation) if x is not type(None)]
+        if len(args) == 1:
+            return _converter_of(args[0])
+        return None
+
+    if origin in (list, List):
+        args = typing.get_args(annotation)
+        item_converter = _converter_of(args[0]) if len(args) > 0 else None
+        if item_converter is None:
+            return None
+        return lambda v: [item_converter(x) for x in v]
+
+    if isinstance(annotation, type):
+        if issubclass(annotation, BaseModel):
+            # 模型可能尚未定义完成（前向引用），因此在第一次构造时才生成plan
+            return lambda v: _plan_of(annotation).construct(v) if isinstance(v, dict) else v
+        if issubclass(annotation, datetime):
+            return _parse_datetime
+        if issubclass(annotation, Enum):
+            return lambda v: annotation(v) if not isinstance(v, annotation) else v
+
+    return None
+
+
+def construct_model(t: Type[T], obj: Dict[str, Any]) -> T:
+    """
+    不经校验地构造模型（递归处理嵌套的模型、列表与datetime），缺少必填字段时抛出ValueError
+    """
+    return _plan_of(t).construct(obj)
+
+
+def load_model(t: Type[T], obj: Dict[str, Any]) -> T:
+    # 缓存均由本插件写入，pydantic v1的校验由Python实现，较慢，因此直接构造；
+    # pydantic v2的校验由pydantic-core完成，比在Python中构造更快
+    if PYDANTIC_V2:
+        return t.model_validate(obj)
+    else:
+        return construct_model(t, obj)
+
+
+_list_adapters: Dict[type, Any] = {}
+
+
+def _list_adapter_of(t: Type[T]):
+    adapter = _list_adapters.get(t)
+    if adapter is None:
+        from pydantic import TypeAdapter
+
+        adapter = TypeAdapter(List[t])
+        _list_adapters[t] = adapter
+    return adapter
+
+
+def encode_model(model: BaseModel, codec: Codec) -> bytes:
+    return encode(dump_model(model), codec)
+
+
+def decode_model(t: Type[T], data: bytes) -> T:
+    if PYDANTIC_V2 and data[:1] == _TAG_JSON:
+        # 由pydantic-core一次完成JSON解析与校验，不需要生成中间的dict
+        return t.model_validate_json(data[1:])
+    return load_model(t, decode(data))
+
+
+def encode_models(models: List[BaseModel], codec: Codec) -> bytes:
+    return encode([dump_model(x) for x in models], codec)
+
+
+def decode_models(t: Type[T], data: bytes) -> List[T]:
+    if PYDANTIC_V2 and data[:1] == _TAG_JSON:
+        return _list_adapter_of(t).validate_json(data[1:])
+    return [load_model(t, x) for x in decode(data)]
+
+
+__all__ = ("Codec", "JsonCodec", "OrjsonCodec", "MsgpackCodec", "get_codec",
+           "encode", "decode", "dump_model", "construct_model", "load_model",
+           "encode_model", "decode_model", "encode_models", "decode_models")
@@ -11,9 +11,19 @@ class DummyPixivRepo(LocalPixivRepo):
         raise NoSuchItemError()
         yield None
 
+    async def illust_details(self, *args, **kwargs):
+        return {}
+
     async def update_illust_detail(self, *args, **kwargs):
         pass
 
+    # ================ negative_result ================
+    async def negative_result(self, *args, **kwargs):
+        return None
+
+    async def update_negative_result(self, *args, **kwargs):
+        pass
+
     # ================ user_detail ================
     async def user_detail(self, *args, **kwargs):
         raise NoSuchItemError()
@@ -1,30 +1,43 @@
-import json
+import asyncio
 import os
+import shutil
+from functools import partial
 from pathlib import Path
-from typing import AsyncGenerator, Union, Generic, TypeVar, Type, List, Callable, Any
+from typing import AsyncGenerator, Union, TypeVar, Type, List, Callable, Any, Optional, Set, Collection, Dict
+from uuid import uuid4
+from weakref import WeakValueDictionary
 
 import aiofiles
+import aiofiles.os
+from cachetools import LRUCache
 from nonebot import logger
 from nonebot_plugin_localstore import get_cache_dir
 from pydantic import ValidationError, BaseModel
-from pydantic.generics import GenericModel
 
 from .base import LocalPixivRepo
-from ..errors import NoSuchItemError
+from .codec import get_codec, encode, decode, dump_model, load_model, encode_models, decode_models
+from .image_store import image_key
+from ..errors import NoSuchItemError, CacheExpiredError
 from ..lazy_illust import LazyIllust
-from ..models import PixivRepoMetadata
+from ..models import PixivRepoMetadata, NegativeResult
 from ...local_tag import LocalTagRepo
 from ....config import Config
-from ....enums import RankingMode
+from ....enums import RankingMode, DownloadQuantity
 from ....global_context import context
 from ....model import Illust, User
+from ....utils.blob_store import FileBlobStore
+from ....utils.lifecycler import on_startup
 
-T = TypeVar("T")
 
+class ListSegment(BaseModel):
+    id: int
+    count: int
 
-class FileModel(GenericModel, Generic[T]):
-    content: T
+
+class ListMeta(BaseModel):
     metadata: PixivRepoMetadata
+    segments: List[ListSegment] = []
+    next_segment_id: int = 0
 
 
 conf = context.require(Config)
@@ -35,10 +48,25 @@ def mkdirs_for_parent(path: Path):
     path.parent.mkdir(parents=True, exist_ok=True)
 
 
+async def _load_illusts(content: List[Union[Illust, LazyIllust]]) -> List[Illust]:
+    # 并发地加载，使未加载的插画合并为一批查询
+    return list(await asyncio.gather(*[
+        x.get() if isinstance(x, LazyIllust) else asyncio.sleep(0, x)
+        for x in content
+    ]))
+
+
 @context.register_singleton()
 class FilePixivRepo(LocalPixivRepo):
     def __init__(self):
         self.root = get_cache_dir("nonebot_plugin_pixivbot")
+        self._list_keys: LRUCache[Path, Set[str]] = LRUCache(maxsize=64)
+        # 同一个列表缓存的追加与删除需要串行执行，否则并发的读-改-写会覆盖彼此的段
+        self._list_locks: WeakValueDictionary[Path, asyncio.Lock] = WeakValueDictionary()
+        self._image_store = FileBlobStore(self.root / "blob" / "image")
+        self._codec = get_codec(conf.pixiv_cache_codec)
+
+        on_startup(replay=True)(self.remove_legacy_files)
 
     T_Content = TypeVar("T_Content", bound=BaseModel)
 
@@ -48,13 +76,13 @@ class FilePixivRepo(LocalPixivRepo):
             raise NoSuchItemError()
 
         try:
-            async with aiofiles.open(file, 'r', encoding="utf-8") as f:
-                obj = json.loads(await f.read())
-                model = FileModel[t_content].parse_obj(obj)
-                model.metadata.check_is_expired(expires_in)
-                yield model.metadata
-                yield model.content
-        except (KeyError, ValueError, ValidationError) as e:
+            async with aiofiles.open(file, 'rb') as f:
+                obj = decode(await f.read())
+            metadata = load_model(PixivRepoMetadata, obj["metadata"])
+            metadata.check_is_expired(expires_in)
+            yield metadata
+            yield load_model(t_content, obj["content"])
+        except (KeyError, TypeError, ValueError, ValidationError) as e:
             logger.opt(exception=e).warning(
                 f"[local] deleting invalid file {file}")
             os.remove(file)
@@ -62,67 +90,138 @@ class FilePixivRepo(LocalPixivRepo):
 
     async def _write_single(self, file: Path, content: T_Content, metadata: PixivRepoMetadata):
         mkdirs_for_parent(file)
-        s = FileModel(content=content, metadata=metadata).json()
-        async with aiofiles.open(file, 'w+', encoding="utf-8") as f:
-            await f.write(s)
-
-    async def _read_list(self, file: Path, t_content: Type[T_Content], expires_in: int, offset: int = 0) \
+        data = encode({"content": dump_model(content), "metadata": dump_model(metadata)}, self._codec)
+        async with aiofiles.open(file, 'wb') as f:
+            await f.write(data)
+
+    # 列表缓存的目录结构：
+    #   meta.json   元数据与各段的顺序、条目数
+    #   keys        已存在条目的键（每行一个，只追加）
+    #   <id>.seg    各段的条目（整段编码为一个列表，格式见codec），段只写一次，不再修改
+    # 追加一页只需写一个新段并替换meta.json；在开头追加时新段插入到段列表的最前面
+    async def _read_list_meta(self, directory: Path) -> Optional[ListMeta]:
+        meta_file = directory / "meta.json"
+        if not meta_file.exists():
+            return None
+
+        async with aiofiles.open(meta_file, 'r', encoding="utf-8") as f:
+            return ListMeta.parse_raw(await f.read())
+
+    @staticmethod
+    async def _write_atomically(file: Path, content: str):
+        tmp = file.with_name(f".{file.name}.{uuid4().hex}.tmp")
+        try:
+            async with aiofiles.open(tmp, 'w', encoding="utf-8") as f:
+                await f.write(content)
+            await aiofiles.os.replace(tmp, file)
+        except BaseException:
+            if tmp.exists():
+                os.remove(tmp)
+            raise
+
+    async def _read_list(self, directory: Path, t_content: Type[T_Content], expires_in: int, offset: int = 0) \
             -> AsyncGenerator[Union[T_Content, PixivRepoMetadata], None]:
-        if not file.exists():
-            raise NoSuchItemError()
-
         try:
-            async with aiofiles.open(file, 'r', encoding="utf-8") as f:
-                obj = json.loads(await f.read())
-                model = FileModel[List[t_content]].parse_obj(obj)
-                model.metadata.check_is_expired(expires_in)
-                yield model.metadata.copy(update={"pages": 0})
-                for x in model.content:
-                    if offset == 0:
-                        yield x
-                    else:
-                        offset -= 1
-                yield model.metadata
-        except (KeyError, ValueError, ValidationError) as e:
+            meta = await self._read_list_meta(directory)
+            if meta is None:
+                raise NoSuchItemError()
+
+            meta.metadata.check_is_expired(expires_in)
+            yield meta.metadata.copy(update={"pages": 0})
+
+            for seg in meta.segments:
+                # 整段跳过，不需要读取
+                if offset >= seg.count:
+                    offset -= seg.count
+                    continue
+
+                async with aiofiles.open(directory / f"{seg.id}.seg", 'rb') as f:
+                    items = decode_models(t_content, await f.read())
+
+                for x in items[offset:]:
+                    yield x
+                offset = 0
+
+            yield meta.metadata
+        except (KeyError, TypeError, ValueError, ValidationError, FileNotFoundError) as e:
             logger.opt(exception=e).warning(
-                f"[local] deleting invalid file {file}")
-            os.remove(file)
+                f"[local] deleting invalid list cache {directory}")
+            await self._invalidate_list(directory)
             raise NoSuchItemError()
 
-    async def _append_list(self, file: Path, t_content: Type[T_Content],
+    async def _read_list_keys(self, directory: Path) -> Set[str]:
+        keys = self._list_keys.get(directory)
+        if keys is None:
+            keys_file = directory / "keys"
+            if keys_file.exists():
+                async with aiofiles.open(keys_file, 'r', encoding="utf-8") as f:
+                    keys = set((await f.read()).split())
+            else:
+                keys = set()
+            self._list_keys[directory] = keys
+        return keys
+
+    async def _append_list(self, directory: Path, t_content: Type[T_Content],
                            content: List[T_Content], metadata: PixivRepoMetadata,
                            content_key: Callable[[T_Content], Any],
                            append_at_begin: bool = False) -> bool:
         # 返回值表示content中是否有已经存在于集合的文档
-        if not file.exists():
-            current_content = []
-        else:
-            async with aiofiles.open(file, 'r', encoding="utf-8") as f:
-                obj = json.loads(await f.read())
-                model = FileModel[List[t_content]].parse_obj(obj)
-                current_content = model.content
-
-        keys = set(map(content_key, current_content))
-        has_duplicated = False
-
-        for c in content:
-            c_key = content_key(c)
-            if c_key not in keys:
-                keys.add(c_key)
+        async with self._list_lock(directory):
+            directory.mkdir(parents=True, exist_ok=True)
+
+            meta = await self._read_list_meta(directory)
+            if meta is None:
+                meta = ListMeta(metadata=metadata)
+            else:
+                meta.metadata = metadata
+
+            keys = await self._read_list_keys(directory)
+            has_duplicated = False
+
+            new_keys = []
+            new_items = []
+            for c in content:
+                c_key = str(content_key(c))
+                if c_key not in keys:
+                    keys.add(c_key)
+                    new_keys.append(c_key)
+                    new_items.append(c)
+                else:
+                    has_duplicated = True
+
+            if len(new_items) > 0:
+                seg = ListSegment(id=meta.next_segment_id, count=len(new_items))
+                meta.next_segment_id += 1
+
+                async with aiofiles.open(directory / f"{seg.id}.seg", 'wb') as f:
+                    await f.write(encode_models(new_items, self._codec))
+
                 if append_at_begin:
-                    current_content.insert(0, c)
+                    meta.segments.insert(0, seg)
                 else:
-                    current_content.append(c)
-            else:
-                has_duplicated = True
+                    meta.segments.append(seg)
 
-        s = FileModel[List[t_content]](
-            content=current_content, metadata=metadata).json()
-        mkdirs_for_parent(file)
-        async with aiofiles.open(file, 'w+', encoding="utf-8") as f:
-            await f.write(s)
+            # 先写段，再替换meta.json，最后记录键：中途崩溃时只会留下没有被引用的段
+            await self._write_atomically(directory / "meta.json", meta.json())
+
+            if len(new_keys) > 0:
+                async with aiofiles.open(directory / "keys", 'a', encoding="utf-8") as f:
+                    await f.write("\n".join(new_keys) + "\n")
+
+            return has_duplicated
+
+    def _list_lock(self, directory: Path) -> asyncio.Lock:
+        lock = self._list_locks.get(directory)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._list_locks[directory] = lock
+        return lock
 
-        return has_duplicated
+    async def _invalidate_list(self, directory: Path):
+        async with self._list_lock(directory):
+            self._list_keys.pop(directory, None)
+            await asyncio.get_running_loop().run_in_executor(None, partial(shutil.rmtree, directory,
+                                                                           ignore_errors=True))
 
     # ================ illust_detail ================
     async def illust_detail(self, illust_id: int) \
@@ -133,6 +232,22 @@ class FilePixivRepo(LocalPixivRepo):
         async for x in self._read_single(file, Illust, conf.pixiv_illust_detail_cache_expires_in):
             yield x
 
+    async def illust_details(self, illust_ids: Collection[int]) -> Dict[int, Illust]:
+        logger.debug(f"[local] illust_details ({len(illust_ids)} items)")
+
+        async def read(illust_id: int) -> Optional[Illust]:
+            file = self.root / "illust_detail" / f"{illust_id}.json"
+            try:
+                async for x in self._read_single(file, Illust, conf.pixiv_illust_detail_cache_expires_in):
+                    if isinstance(x, Illust):
+                        return x
+            except (NoSuchItemError, CacheExpiredError):
+                return None
+
+        illust_ids = list(set(illust_ids))
+        illusts = await asyncio.gather(*[read(x) for x in illust_ids])
+        return {illust_id: illust for illust_id, illust in zip(illust_ids, illusts) if illust is not None}
+
     async def update_illust_detail(self, illust: Illust, metadata: PixivRepoMetadata):
         logger.debug(f"[local] update illust_detail {illust.id} {metadata}")
 
@@ -143,6 +258,25 @@ class FilePixivRepo(LocalPixivRepo):
         if conf.pixiv_tag_translation_enabled:
             await local_tags.update_from_illusts([illust])
 
+    # ================ negative_result ================
+    async def negative_result(self, res_type: str, id: int) -> Optional[str]:
+        file = self.root / "negative" / res_type / f"{id}.json"
+        try:
+            async for x in self._read_single(file, NegativeResult, conf.pixiv_negative_cache_expires_in):
+                if isinstance(x, NegativeResult):
+                    return x.reason
+        except NoSuchItemError:
+            pass
+        except CacheExpiredError:
+            file.unlink(missing_ok=True)
+        return None
+
+    async def update_negative_result(self, res_type: str, id: int, reason: str):
+        logger.debug(f"[local] update negative_result {res_type} {id}: {reason}")
+
+        file = self.root / "negative" / res_type / f"{id}.json"
+        await self._write_single(file, NegativeResult(reason=reason), PixivRepoMetadata())
+
     # ================ user_detail ================
     async def user_detail(self, user_id: int) \
             -> AsyncGenerator[Union[User, PixivRepoMetadata], None]:
@@ -163,8 +297,8 @@ class FilePixivRepo(LocalPixivRepo):
             -> AsyncGenerator[Union[LazyIllust, PixivRepoMetadata], None]:
         logger.debug(f"[local] search_illust {word}")
 
-        file = self.root / "search_illust" / f"{word}.json"
-        async for x in self._read_list(file, Illust, conf.pixiv_search_illust_cache_expires_in, offset):
+        directory = self.root / "search_illust" / f"{word}"
+        async for x in self._read_list(directory, Illust, conf.pixiv_search_illust_cache_expires_in, offset):
             if isinstance(x, PixivRepoMetadata):
                 yield x
             elif isinstance(x, Illust):
@@ -172,28 +306,25 @@ class FilePixivRepo(LocalPixivRepo):
 
     async def invalidate_search_illust(self, word: str):
         logger.debug(f"[local] invalidate search_illust {word}")
-        file = self.root / "search_illust" / f"{word}.json"
-        os.remove(file)
+        directory = self.root / "search_illust" / f"{word}"
+        await self._invalidate_list(directory)
 
     async def append_search_illust(self, word: str, content: List[Union[Illust, LazyIllust]],
                                    metadata: PixivRepoMetadata) -> bool:
         logger.debug(f"[local] append search_illust {word} "
                      f"({len(content)} items) "
                      f"{metadata}")
-        file = self.root / "search_illust" / f"{word}.json"
-        content: List[Illust] = [
-            await x.get() if isinstance(x, LazyIllust) else x
-            for x in content
-        ]
-        return await self._append_list(file, Illust, content, metadata, lambda x: x.id)
+        directory = self.root / "search_illust" / f"{word}"
+        content: List[Illust] = await _load_illusts(content)
+        return await self._append_list(directory, Illust, content, metadata, lambda x: x.id)
 
     # ================ search_user ================
     async def search_user(self, word: str, *, offset: int = 0) \
             -> AsyncGenerator[Union[User, PixivRepoMetadata], None]:
         logger.debug(f"[local] search_user {word}")
 
-        file = self.root / "search_user" / f"{word}.json"
-        async for x in self._read_list(file, User, conf.pixiv_search_user_cache_expires_in, offset):
+        directory = self.root / "search_user" / f"{word}"
+        async for x in self._read_list(directory, User, conf.pixiv_search_user_cache_expires_in, offset):
             if isinstance(x, PixivRepoMetadata):
                 yield x
             elif isinstance(x, User):
@@ -201,8 +332,8 @@ class FilePixivRepo(LocalPixivRepo):
 
     async def invalidate_search_user(self, word: str):
         logger.debug(f"[local] invalidate search_user {word}")
-        file = self.root / "search_user" / f"{word}.json"
-        os.remove(file)
+        directory = self.root / "search_user" / f"{word}"
+        await self._invalidate_list(directory)
 
     async def append_search_user(self, word: str, content: List[User],
                                  metadata: PixivRepoMetadata) -> bool:
@@ -210,16 +341,16 @@ class FilePixivRepo(LocalPixivRepo):
                      f"({len(content)} items) "
                      f"{metadata}")
 
-        file = self.root / "search_user" / f"{word}.json"
-        return await self._append_list(file, User, content, metadata, lambda x: x.id)
+        directory = self.root / "search_user" / f"{word}"
+        return await self._append_list(directory, User, content, metadata, lambda x: x.id)
 
     # ================ user_illusts ================
     async def user_illusts(self, user_id: int, *, offset: int = 0) \
             -> AsyncGenerator[Union[LazyIllust, PixivRepoMetadata], None]:
         logger.debug(f"[local] user_illusts {user_id}")
 
-        file = self.root / "user_illusts" / f"{user_id}.json"
-        async for x in self._read_list(file, Illust, conf.pixiv_user_illusts_cache_expires_in, offset):
+        directory = self.root / "user_illusts" / f"{user_id}"
+        async for x in self._read_list(directory, Illust, conf.pixiv_user_illusts_cache_expires_in, offset):
             if isinstance(x, PixivRepoMetadata):
                 yield x
             elif isinstance(x, Illust):
@@ -227,8 +358,8 @@ class FilePixivRepo(LocalPixivRepo):
 
     async def invalidate_user_illusts(self, user_id: int):
         logger.debug(f"[local] invalidate user_illusts {user_id}")
-        file = self.root / "user_illusts" / f"{user_id}.json"
-        os.remove(file)
+        directory = self.root / "user_illusts" / f"{user_id}"
+        await self._invalidate_list(directory)
 
     async def append_user_illusts(self, user_id: int,
                                   content: List[Union[Illust, LazyIllust]],
@@ -239,20 +370,17 @@ class FilePixivRepo(LocalPixivRepo):
                      f"({len(content)} items) "
                      f"{metadata}")
 
-        file = self.root / "user_illusts" / f"{user_id}.json"
-        content: List[Illust] = [
-            await x.get() if isinstance(x, LazyIllust) else x
-            for x in content
-        ]
-        return await self._append_list(file, Illust, content, metadata, lambda x: x.id, append_at_begin)
+        directory = self.root / "user_illusts" / f"{user_id}"
+        content: List[Illust] = await _load_illusts(content)
+        return await self._append_list(directory, Illust, content, metadata, lambda x: x.id, append_at_begin)
 
     # ================ user_bookmarks ================
     async def user_bookmarks(self, user_id: int = 0, *, offset: int = 0) \
             -> AsyncGenerator[Union[LazyIllust, PixivRepoMetadata], None]:
         logger.debug(f"[local] user_bookmarks {user_id}")
 
-        file = self.root / "user_bookmarks" / f"{user_id}.json"
-        async for x in self._read_list(file, Illust, conf.pixiv_user_bookmarks_cache_expires_in, offset):
+        directory = self.root / "user_bookmarks" / f"{user_id}"
+        async for x in self._read_list(directory, Illust, conf.pixiv_user_bookmarks_cache_expires_in, offset):
             if isinstance(x, PixivRepoMetadata):
                 yield x
             elif isinstance(x, Illust):
@@ -260,8 +388,8 @@ class FilePixivRepo(LocalPixivRepo):
 
     async def invalidate_user_bookmarks(self, user_id: int):
         logger.debug(f"[local] invalidate user_bookmarks {user_id}")
-        file = self.root / "user_bookmarks" / f"{user_id}.json"
-        os.remove(file)
+        directory = self.root / "user_bookmarks" / f"{user_id}"
+        await self._invalidate_list(directory)
 
     async def append_user_bookmarks(self, user_id: int,
                                     content: List[Union[Illust, LazyIllust]],
@@ -272,21 +400,21 @@ class FilePixivRepo(LocalPixivRepo):
                      f"({len(content)} items) "
                      f"{metadata}")
 
-        file = self.root / "user_bookmarks" / f"{user_id}.json"
+        directory = self.root / "user_bookmarks" / f"{user_id}"
         content: List[Illust] = [
             x.content if isinstance(x, LazyIllust) else x
             for x in content
         ]
         content = list(filter(lambda x: x is not None, content))
-        return await self._append_list(file, Illust, content, metadata, lambda x: x.id, append_at_begin)
+        return await self._append_list(directory, Illust, content, metadata, lambda x: x.id, append_at_begin)
 
     # ================ recommended_illusts ================
     async def recommended_illusts(self, *, offset: int = 0) \
             -> AsyncGenerator[Union[LazyIllust, PixivRepoMetadata], None]:
         logger.debug("[local] recommended_illusts")
 
-        file = self.root / "other" / "recommended_illusts.json"
-        async for x in self._read_list(file, Illust, conf.pixiv_other_cache_expires_in, offset):
+        directory = self.root / "other" / "recommended_illusts"
+        async for x in self._read_list(directory, Illust, conf.pixiv_other_cache_expires_in, offset):
             if isinstance(x, PixivRepoMetadata):
                 yield x
             elif isinstance(x, Illust):
@@ -294,8 +422,8 @@ class FilePixivRepo(LocalPixivRepo):
 
     async def invalidate_recommended_illusts(self):
         logger.debug("[local] invalidate recommended_illusts")
-        file = self.root / "other" / "recommended_illusts.json"
-        os.remove(file)
+        directory = self.root / "other" / "recommended_illusts"
+        await self._invalidate_list(directory)
 
     async def append_recommended_illusts(self, content: List[Union[Illust, LazyIllust]],
                                          metadata: PixivRepoMetadata) -> bool:
@@ -303,20 +431,17 @@ class FilePixivRepo(LocalPixivRepo):
                      f"({len(content)} items) "
                      f"{metadata}")
 
-        file = self.root / "other" / "recommended_illusts.json"
-        content: List[Illust] = [
-            await x.get() if isinstance(x, LazyIllust) else x
-            for x in content
-        ]
-        return await self._append_list(file, Illust, content, metadata, lambda x: x.id)
+        directory = self.root / "other" / "recommended_illusts"
+        content: List[Illust] = await _load_illusts(content)
+        return await self._append_list(directory, Illust, content, metadata, lambda x: x.id)
 
     # ================ related_illusts ================
     async def related_illusts(self, illust_id: int, *, offset: int = 0) \
             -> AsyncGenerator[Union[LazyIllust, PixivRepoMetadata], None]:
         logger.debug(f"[local] related_illusts {illust_id}")
 
-        file = self.root / "related_illusts" / f"{illust_id}.json"
-        async for x in self._read_list(file, Illust, conf.pixiv_related_illusts_cache_expires_in, offset):
+        directory = self.root / "related_illusts" / f"{illust_id}"
+        async for x in self._read_list(directory, Illust, conf.pixiv_related_illusts_cache_expires_in, offset):
             if isinstance(x, PixivRepoMetadata):
                 yield x
             elif isinstance(x, Illust):
@@ -324,8 +449,8 @@ class FilePixivRepo(LocalPixivRepo):
 
     async def invalidate_related_illusts(self, illust_id: int):
         logger.debug("[local] invalidate related_illusts")
-        file = self.root / "related_illusts" / f"{illust_id}.json"
-        os.remove(file)
+        directory = self.root / "related_illusts" / f"{illust_id}"
+        await self._invalidate_list(directory)
 
     async def append_related_illusts(self, illust_id: int, content: List[Union[Illust, LazyIllust]],
                                      metadata: PixivRepoMetadata) -> bool:
@@ -333,12 +458,9 @@ class FilePixivRepo(LocalPixivRepo):
                      f"({len(content)} items) "
                      f"{metadata}")
 
-        file = self.root / "related_illusts" / f"{illust_id}.json"
-        content: List[Illust] = [
-            await x.get() if isinstance(x, LazyIllust) else x
-            for x in content
-        ]
-        return await self._append_list(file, Illust, content, metadata, lambda x: x.id)
+        directory = self.root / "related_illusts" / f"{illust_id}"
+        content: List[Illust] = await _load_illusts(content)
+        return await self._append_list(directory, Illust, content, metadata, lambda x: x.id)
 
     # ================ illust_ranking ================
     async def illust_ranking(self, mode: Union[str, RankingMode], *, offset: int = 0) \
@@ -348,8 +470,8 @@ class FilePixivRepo(LocalPixivRepo):
 
         logger.debug(f"[local] illust_ranking {mode}")
 
-        file = self.root / "illust_ranking" / f"{mode}.json"
-        async for x in self._read_list(file, Illust, conf.pixiv_illust_ranking_cache_expires_in, offset):
+        directory = self.root / "illust_ranking" / f"{mode}"
+        async for x in self._read_list(directory, Illust, conf.pixiv_illust_ranking_cache_expires_in, offset):
             if isinstance(x, PixivRepoMetadata):
                 yield x
             elif isinstance(x, Illust):
@@ -357,8 +479,8 @@ class FilePixivRepo(LocalPixivRepo):
 
     async def invalidate_illust_ranking(self, mode: RankingMode):
         logger.debug("[local] invalidate illust_ranking")
-        file = self.root / "illust_ranking" / f"{mode}.json"
-        os.remove(file)
+        directory = self.root / "illust_ranking" / f"{mode}"
+        await self._invalidate_list(directory)
 
     async def append_illust_ranking(self, mode: RankingMode, content: List[Union[Illust, LazyIllust]],
                                     metadata: PixivRepoMetadata) -> bool:
@@ -366,68 +488,75 @@ class FilePixivRepo(LocalPixivRepo):
                      f"({len(content)} items) "
                      f"{metadata}")
 
-        file = self.root / "illust_ranking" / f"{mode}.json"
-        content: List[Illust] = [
-            await x.get() if isinstance(x, LazyIllust) else x
-            for x in content
-        ]
-        return await self._append_list(file, Illust, content, metadata, lambda x: x.id)
+        directory = self.root / "illust_ranking" / f"{mode}"
+        content: List[Illust] = await _load_illusts(content)
+        return await self._append_list(directory, Illust, content, metadata, lambda x: x.id)
 
     # ================ image ================
-    async def image(self, illust: Illust, page: int = 0) -> AsyncGenerator[Union[bytes, PixivRepoMetadata], None]:
-        logger.debug(f"[local] image {illust.id}")
+    @staticmethod
+    def _image_key(illust_id: int, page: int, quantity: DownloadQuantity) -> str:
+        return image_key(illust_id, page, quantity.value)
 
-        metadata_file = self.root / "image" / \
-            f"{illust.id}_{page}_metadata.json"
-        image_file = self.root / "image" / f"{illust.id}_{page}.jpg"
+    async def image(self, illust: Illust, page: int = 0,
+                    quantity: DownloadQuantity = DownloadQuantity.original) \
+            -> AsyncGenerator[Union[bytes, PixivRepoMetadata], None]:
+        logger.debug(f"[local] image {illust.id}[{page}] {quantity.value}")
 
-        if not metadata_file.exists() or image_file:
+        blob = await self._image_store.read(self._image_key(illust.id, page, quantity))
+        if blob is None:
             raise NoSuchItemError()
 
-        try:
-            async with aiofiles.open(metadata_file, 'r', encoding="utf-8") as f:
-                obj = json.loads(await f.read())
-                metadata = PixivRepoMetadata.parse_obj(obj).check_is_expired(
-                    conf.pixiv_download_cache_expires_in)
+        update_time, content = blob
+        metadata = PixivRepoMetadata(update_time=update_time).check_is_expired(conf.pixiv_download_cache_expires_in)
 
-            async with aiofiles.open(image_file, 'rb') as f:
-                content = f.read()
-
-            yield metadata
-            yield content
-        except (KeyError, ValueError, ValidationError) as e:
-            if metadata_file.exists():
-                logger.opt(exception=e).warning(
-                    f"[local] deleting invalid file {metadata_file}")
-                os.remove(metadata_file)
-            if image_file.exists():
-                logger.opt(exception=e).warning(
-                    f"[local] deleting invalid file {image_file}")
-                os.remove(image_file)
-            raise NoSuchItemError()
+        yield metadata
+        yield content
 
     async def update_image(self, illust_id: int, page: int,
-                           content: bytes, metadata: PixivRepoMetadata):
-        logger.debug(f"[local] update image {illust_id} {metadata}")
-
-        metadata_file = self.root / "image" / \
-            f"{illust_id}_{page}_metadata.json"
-        image_file = self.root / "image" / f"{illust_id}_{page}.jpg"
+                           content: bytes, metadata: PixivRepoMetadata,
+                           quantity: DownloadQuantity = DownloadQuantity.original):
+        logger.debug(f"[local] update image {illust_id}[{page}] {quantity.value} {metadata}")
 
-        
-        mkdirs_for_parent(metadata_file)
-        mkdirs_for_parent(image_file)
-
-        async with aiofiles.open(metadata_file, 'w+', encoding="utf-8") as f:
-            await f.write(metadata.json())
-
-        async with aiofiles.open(image_file, 'wb+') as f:
-            await f.write(content)
+        await self._image_store.write(self._image_key(illust_id, page, quantity), content, metadata.update_time)
 
     async def invalidate_all(self):
-        os.removedirs(self.root)
+        self._list_keys.clear()
+        await asyncio.get_running_loop().run_in_executor(None, partial(shutil.rmtree, self.root, ignore_errors=True))
+
+    # 旧版本的缓存格式：图片存放在image目录下，列表缓存是单个{name}.json文件
+    _LEGACY_LIST_DIRS = ("search_illust", "search_user", "user_illusts", "user_bookmarks",
+                         "related_illusts", "illust_ranking", "other")
+
+    def _remove_legacy_files_sync(self) -> int:
+        removed = 0
+
+        image_dir = self.root / "image"
+        if image_dir.exists():
+            removed += sum(1 for x in image_dir.rglob("*") if x.is_file())
+            shutil.rmtree(image_dir, ignore_errors=True)
+
+        for name in self._LEGACY_LIST_DIRS:
+            directory = self.root / name
+            if not directory.exists():
+                continue
+            for file in directory.glob("*.json"):
+                if file.is_file():
+                    file.unlink(missing_ok=True)
+                    removed += 1
+
+        return removed
+
+    async def remove_legacy_files(self):
+        """
+        删除旧版本格式的缓存文件（不再被读取）
+        """
+        removed = await asyncio.get_running_loop().run_in_executor(None, self._remove_legacy_files_sync)
+        if removed > 0:
+            logger.success(f"[local] deleted {removed} legacy cache files")
 
     async def clean_expired(self):
         logger.debug("[local] clean_expired")
 
+        await self.remove_legacy_files()
+
         # TODO
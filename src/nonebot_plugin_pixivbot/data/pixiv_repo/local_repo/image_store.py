@@ -0,0 +1,17 @@
+from nonebot_plugin_localstore import get_cache_dir
+
+from ....utils.blob_store import FileBlobStore
+
+
+def image_key(illust_id: int, page: int, quantity: str) -> str:
+    return f"image:{illust_id}:{page}:{quantity}"
+
+
+def create_sql_image_store() -> FileBlobStore:
+    """
+    pixiv_sql_image_storage为file时，SqlPixivRepo存放图片内容的目录（数据库中只保存元数据）
+    """
+    return FileBlobStore(get_cache_dir("nonebot_plugin_pixivbot") / "sql_blob" / "image")
+
+
+__all__ = ("image_key", "create_sql_image_store")
@@ -1,26 +1,35 @@
+import asyncio
+from dataclasses import dataclass
 from datetime import datetime, timezone, timedelta
 from functools import partial
-from typing import AsyncGenerator, Union, Optional, List
+from time import perf_counter
+from hashlib import sha1
+from typing import AsyncGenerator, Union, Optional, List, Iterable, Sequence, Dict, Callable, Awaitable, Collection
 
 from apscheduler.triggers.interval import IntervalTrigger
 from nonebot import logger
 from nonebot_plugin_apscheduler import scheduler as apscheduler
-from sqlalchemy import select, delete, func, text
+from sqlalchemy import select, delete, func, text, and_, tuple_, inspect, Select, Row, ColumnElement
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import InstrumentedAttribute
 
 from .base import LocalPixivRepo
+from .codec import get_codec, encode_model, decode_model, construct_model
+from .image_store import image_key, create_sql_image_store
 from .sql_models import IllustDetailCache, UserDetailCache, DownloadCache, IllustSetCache, IllustSetCacheIllust, \
-    UserSetCache, UserSetCacheUser
+    UserSetCache, UserSetCacheUser, IllustLightCache, NegativeCache
 from ..errors import NoSuchItemError
 from ..lazy_illust import LazyIllust
 from ..models import PixivRepoMetadata
+from ..query_mode import is_light_query
 from ...local_tag import LocalTagRepo
 from ...source.sql import DataSource
-from ...utils.sql import insert
+from ...utils.sql import insert, hash_key
 from ....config import Config
-from ....enums import RankingMode
+from ....enums import RankingMode, DownloadQuantity
 from ....global_context import context
-from ....model import Illust, User
+from ....model import Illust, User, LightIllust
+from ....utils.blob_store import FileBlobStore
 from ....utils.lifecycler import on_startup
 
 
@@ -34,6 +43,22 @@ def _extract_metadata(cache, is_set_cache):
     return metadata
 
 
+def _chunked(rows: Sequence[dict]) -> Iterable[Sequence[dict]]:
+    # SQLite单条语句的参数个数有上限（旧版本为999），分批插入
+    for i in range(0, len(rows), _BULK_CHUNK_SIZE):
+        yield rows[i:i + _BULK_CHUNK_SIZE]
+
+
+_BULK_CHUNK_SIZE = 200
+_STREAM_BATCH_SIZE = 500
+
+
+@dataclass
+class CleanResult:
+    rows: int = 0  # 删除的行数
+    bytes: int = 0  # 回收的内容字节数（仅统计插画详情与下载缓存）
+
+
 conf = context.require(Config)
 data_source = context.require(DataSource)
 local_tags = context.require(LocalTagRepo)
@@ -43,6 +68,10 @@ local_tags = context.require(LocalTagRepo)
 class SqlPixivRepo(LocalPixivRepo):
 
     def __init__(self):
+        self._codec = get_codec(conf.pixiv_cache_codec)
+        self._image_store: Optional[FileBlobStore] = \
+            create_sql_image_store() if conf.pixiv_sql_image_storage == "file" else None
+
         on_startup(replay=True)(
             partial(
                 apscheduler.add_job,
@@ -53,6 +82,116 @@ class SqlPixivRepo(LocalPixivRepo):
             )
         )
 
+    def _encode_illust(self, illust: Illust) -> bytes:
+        return encode_model(illust, self._codec)
+
+    @staticmethod
+    def _decode_illust(illust_id: int, data: bytes) -> Optional[Illust]:
+        try:
+            return decode_model(Illust, data)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.opt(exception=e).warning(f"[local] invalid illust_detail cache of {illust_id}")
+            return None
+
+    async def _upsert_illust_details(self, session: AsyncSession, illusts: List[Illust], update_time: datetime):
+        # PostgreSQL不允许同一条语句多次更新同一行，因此按id去重
+        rows = list({
+            x.id: dict(illust_id=x.id, illust=self._encode_illust(x), update_time=update_time)
+            for x in illusts
+        }.values())
+
+        for chunk in _chunked(rows):
+            stmt = insert(IllustDetailCache).values(chunk)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[IllustDetailCache.illust_id],
+                set_={
+                    IllustDetailCache.illust: stmt.excluded.illust,
+                    IllustDetailCache.update_time: stmt.excluded.update_time
+                }
+            )
+            await session.execute(stmt)
+
+        rows = []
+        for x in {x.id: x for x in illusts}.values():
+            light = LightIllust.from_illust(x)
+            rows.append(dict(illust_id=light.id, total_bookmarks=light.total_bookmarks, total_view=light.total_view,
+                             create_date=light.create_date, tags=light.tags, illust_ai_type=light.illust_ai_type,
+                             update_time=update_time))
+
+        for chunk in _chunked(rows):
+            stmt = insert(IllustLightCache).values(chunk)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[IllustLightCache.illust_id],
+                set_={
+                    IllustLightCache.total_bookmarks: stmt.excluded.total_bookmarks,
+                    IllustLightCache.total_view: stmt.excluded.total_view,
+                    IllustLightCache.create_date: stmt.excluded.create_date,
+                    IllustLightCache.tags: stmt.excluded.tags,
+                    IllustLightCache.illust_ai_type: stmt.excluded.illust_ai_type,
+                    IllustLightCache.update_time: stmt.excluded.update_time
+                }
+            )
+            await session.execute(stmt)
+
+    @staticmethod
+    async def _iter_set_illusts(session: AsyncSession, stmt: Select, offset: int = 0) \
+            -> AsyncGenerator[Sequence[Row], None]:
+        """
+        按(rank, illust_id)分批读取插画集合（keyset分页），每批最多_STREAM_BATCH_SIZE行，
+        内存占用与集合大小无关。stmt的前两列必须是IllustSetCacheIllust.rank与IllustSetCacheIllust.illust_id
+        """
+        stmt = stmt.order_by(IllustSetCacheIllust.rank, IllustSetCacheIllust.illust_id).limit(_STREAM_BATCH_SIZE)
+
+        rows = (await session.execute(stmt.offset(offset))).all()
+        while len(rows) > 0:
+            yield rows
+            if len(rows) < _STREAM_BATCH_SIZE:
+                break
+
+            last_rank, last_illust_id = rows[-1][0], rows[-1][1]
+            rows = (await session.execute(stmt.where(
+                tuple_(IllustSetCacheIllust.rank, IllustSetCacheIllust.illust_id) > tuple_(last_rank, last_illust_id)
+            ))).all()
+
+    async def _get_light_illusts(self, session: AsyncSession, cache: IllustSetCache, offset: int):
+        # 只读取投影的各列（不构造ORM对象）；
+        # 没有投影的（在投影表出现之前写入的）插画读取完整的插画
+        stmt = (select(IllustSetCacheIllust.rank,
+                       IllustSetCacheIllust.illust_id,
+                       IllustLightCache.illust_id,
+                       IllustLightCache.total_bookmarks,
+                       IllustLightCache.total_view,
+                       IllustLightCache.create_date,
+                       IllustLightCache.tags,
+                       IllustLightCache.illust_ai_type,
+                       IllustDetailCache.illust)
+                .where(IllustSetCacheIllust.cache_id == cache.id)
+                .outerjoin(IllustLightCache, IllustSetCacheIllust.illust_id == IllustLightCache.illust_id)
+                .outerjoin(IllustDetailCache, and_(IllustSetCacheIllust.illust_id == IllustDetailCache.illust_id,
+                                                   IllustLightCache.illust_id.is_(None))))
+
+        total = 0
+        light_count = 0
+
+        try:
+            async for rows in self._iter_set_illusts(session, stmt, offset):
+                for _, illust_id, light_id, total_bookmarks, total_view, create_date, tags, illust_ai_type, illust \
+                        in rows:
+                    total += 1
+
+                    if light_id is not None:
+                        light_count += 1
+                        # 数据来自数据库，类型都是确定的，不需要校验
+                        light = construct_model(LightIllust, dict(id=illust_id, total_bookmarks=total_bookmarks,
+                                                                  total_view=total_view, create_date=create_date,
+                                                                  tags=tags, illust_ai_type=illust_ai_type))
+                        yield LazyIllust(illust_id, light=light)
+                    else:
+                        content = self._decode_illust(illust_id, illust) if illust is not None else None
+                        yield LazyIllust(illust_id, content)
+        finally:
+            logger.debug(f"[local] got {total} illusts, {light_count} of them are light")
+
     async def _get_illusts(self, session: AsyncSession,
                            cache_type: str,
                            key: dict,
@@ -60,7 +199,7 @@ class SqlPixivRepo(LocalPixivRepo):
                            offset: int = 0, ):
         stmt = (select(IllustSetCache)
                 .where(IllustSetCache.cache_type == cache_type,
-                       IllustSetCache.key == key))
+                       IllustSetCache.key_hash == hash_key(key)))
         cache: Optional[IllustSetCache] = (await session.execute(stmt)).scalar_one_or_none()
         if cache is None:
             raise NoSuchItemError()
@@ -69,27 +208,30 @@ class SqlPixivRepo(LocalPixivRepo):
 
         yield metadata.copy(update={"pages": 0})
 
-        stmt = (select(IllustSetCacheIllust, IllustDetailCache)
+        if is_light_query():
+            async for x in self._get_light_illusts(session, cache, offset):
+                yield x
+            yield metadata
+            return
+
+        stmt = (select(IllustSetCacheIllust.rank, IllustSetCacheIllust.illust_id, IllustDetailCache.illust)
                 .where(IllustSetCacheIllust.cache_id == cache.id)
-                .outerjoin(IllustDetailCache, IllustSetCacheIllust.illust_id == IllustDetailCache.illust_id)
-                .order_by(IllustSetCacheIllust.rank, IllustDetailCache.update_time.desc())
-                .offset(offset))
+                .outerjoin(IllustDetailCache, IllustSetCacheIllust.illust_id == IllustDetailCache.illust_id))
 
         total = 0
         broken = 0
 
         try:
-            async for cache_illust, illust in await session.stream(stmt):
-                cache_illust: IllustSetCacheIllust
-                illust: Optional[IllustDetailCache]
-
-                total += 1
-
-                if illust is not None:
-                    yield LazyIllust(illust.illust_id, Illust(**illust.illust))
-                else:
-                    yield LazyIllust(cache_illust.illust_id)
-                    broken += 1
+            async for rows in self._iter_set_illusts(session, stmt, offset):
+                for _, illust_id, illust in rows:
+                    total += 1
+
+                    content = self._decode_illust(illust_id, illust) if illust is not None else None
+                    if content is not None:
+                        yield LazyIllust(illust_id, content)
+                    else:
+                        yield LazyIllust(illust_id)
+                        broken += 1
         finally:
             logger.debug(f"[local] got {total} illusts, illust_detail of {broken} are missed")
 
@@ -98,12 +240,9 @@ class SqlPixivRepo(LocalPixivRepo):
     async def _invalidate_illusts(self, session: AsyncSession,
                                   cache_type: str,
                                   key: dict):
-        if conf.pixiv_sql_dialect == 'sqlite':
-            await session.execute(text("PRAGMA foreign_keys = ON;"))
-
         stmt = (delete(IllustSetCache)
                 .where(IllustSetCache.cache_type == cache_type,
-                       IllustSetCache.key == key))
+                       IllustSetCache.key_hash == hash_key(key)))
         await session.execute(stmt)
         await session.commit()
 
@@ -117,11 +256,11 @@ class SqlPixivRepo(LocalPixivRepo):
             async with session.begin_nested() as tx2:
                 stmt = (select(IllustSetCache)
                         .where(IllustSetCache.cache_type == cache_type,
-                               IllustSetCache.key == key)
+                               IllustSetCache.key_hash == hash_key(key))
                         .limit(1))
                 cache = (await session.execute(stmt)).scalar_one_or_none()
                 if cache is None:
-                    cache = IllustSetCache(cache_type=cache_type, key=key)
+                    cache = IllustSetCache(cache_type=cache_type, key=key, key_hash=hash_key(key))
                     session.add(cache)
 
                 cache.update_time = metadata.update_time
@@ -131,7 +270,7 @@ class SqlPixivRepo(LocalPixivRepo):
                 # commit to get cache id
                 await tx2.commit()
 
-            row_count = 0
+            # 在客户端计算rank，整页一次插入；冲突（已存在）的条目不会被RETURNING返回
             if append_at_begin:
                 stmt = select(
                     func.min(IllustSetCacheIllust.rank)
@@ -142,16 +281,7 @@ class SqlPixivRepo(LocalPixivRepo):
                 rnk = (await session.execute(stmt)).scalar_one_or_none()
                 if rnk is None:
                     rnk = 0
-
-                for x in reversed(content):
-                    stmt = insert(IllustSetCacheIllust).values(
-                        cache_id=cache.id, illust_id=x.id, rank=rnk - 1
-                    ).on_conflict_do_nothing(index_elements=[
-                        IllustSetCacheIllust.cache_id, IllustSetCacheIllust.illust_id
-                    ])
-                    result = await session.execute(stmt)
-                    row_count += result.rowcount
-                    rnk -= result.rowcount
+                rnk -= len(content)
             else:
                 stmt = select(
                     func.max(IllustSetCacheIllust.rank)
@@ -162,50 +292,37 @@ class SqlPixivRepo(LocalPixivRepo):
                 rnk = (await session.execute(stmt)).scalar_one_or_none()
                 if rnk is None:
                     rnk = 0
+                rnk += 1
 
-                for x in content:
-                    stmt = insert(IllustSetCacheIllust).values(
-                        cache_id=cache.id, illust_id=x.id, rank=rnk + 1
-                    ).on_conflict_do_nothing(index_elements=[
-                        IllustSetCacheIllust.cache_id, IllustSetCacheIllust.illust_id
-                    ])
-                    result = await session.execute(stmt)
-                    row_count += result.rowcount
-                    rnk += result.rowcount
+            rows = [dict(cache_id=cache.id, illust_id=x.id, rank=rnk + i) for i, x in enumerate(content)]
+
+            row_count = 0
+            for chunk in _chunked(rows):
+                stmt = (insert(IllustSetCacheIllust)
+                        .values(chunk)
+                        .on_conflict_do_nothing(index_elements=[
+                            IllustSetCacheIllust.cache_id, IllustSetCacheIllust.illust_id
+                        ])
+                        .returning(IllustSetCacheIllust.illust_id))
+                row_count += len((await session.execute(stmt)).scalars().all())
 
             cache.size += row_count
 
             await tx1.commit()
 
-        # insert illust detail
+        li = []
         for x in content:
             if isinstance(x, LazyIllust):
                 if not x.loaded:
                     continue
                 x = x.content
+            li.append(x)
 
-            stmt = insert(IllustDetailCache).values(
-                illust_id=x.id, illust=x.dict(), update_time=metadata.update_time
-            )
-            stmt = stmt.on_conflict_do_update(
-                index_elements=[IllustDetailCache.illust_id],
-                set_={
-                    IllustDetailCache.illust: stmt.excluded.illust,
-                    IllustDetailCache.update_time: stmt.excluded.update_time
-                }
-            )
-            await session.execute(stmt)
-
+        # insert illust detail
+        await self._upsert_illust_details(session, li, metadata.update_time)
         await session.commit()
 
         # insert local tags
-        li = []
-        for x in content:
-            if isinstance(x, LazyIllust):
-                if not x.loaded:
-                    continue
-                x = x.content
-            li.append(x)
         await local_tags.update_from_illusts(li)
 
         return row_count != len(content)
@@ -217,7 +334,7 @@ class SqlPixivRepo(LocalPixivRepo):
                          offset: int = 0):
         stmt = (select(UserSetCache)
                 .where(UserSetCache.cache_type == cache_type,
-                       UserSetCache.key == key))
+                       UserSetCache.key_hash == hash_key(key)))
         cache = (await session.execute(stmt)).scalar_one_or_none()
         if cache is None:
             raise NoSuchItemError()
@@ -247,12 +364,9 @@ class SqlPixivRepo(LocalPixivRepo):
     async def _invalidate_users(self, session: AsyncSession,
                                 cache_type: str,
                                 key: dict):
-        if conf.pixiv_sql_dialect == 'sqlite':
-            await session.execute(text("PRAGMA foreign_keys = ON;"))
-
         stmt = (delete(UserSetCache)
                 .where(UserSetCache.cache_type == cache_type,
-                       UserSetCache.key == key))
+                       UserSetCache.key_hash == hash_key(key)))
         await session.execute(stmt)
         await session.commit()
 
@@ -266,11 +380,11 @@ class SqlPixivRepo(LocalPixivRepo):
             async with session.begin_nested() as tx2:
                 stmt = (select(UserSetCache)
                         .where(UserSetCache.cache_type == cache_type,
-                               UserSetCache.key == key)
+                               UserSetCache.key_hash == hash_key(key))
                         .limit(1))
                 cache = (await session.execute(stmt)).scalar_one_or_none()
                 if cache is None:
-                    cache = UserSetCache(cache_type=cache_type, key=key)
+                    cache = UserSetCache(cache_type=cache_type, key=key, key_hash=hash_key(key))
                     session.add(cache)
 
                 cache.update_time = metadata.update_time
@@ -280,22 +394,28 @@ class SqlPixivRepo(LocalPixivRepo):
                 # commit to get cache id
                 await tx2.commit()
 
+            rows = [dict(cache_id=cache.id, user_id=x.id) for x in content]
+
             row_count = 0
-            for x in content:
-                stmt = insert(UserSetCacheUser).values(
-                    cache_id=cache.id, user_id=x.id
-                ).on_conflict_do_nothing(index_elements=[
-                    UserSetCacheUser.cache_id, UserSetCacheUser.user_id
-                ])
-                row_count += (await session.execute(stmt)).rowcount
+            for chunk in _chunked(rows):
+                stmt = (insert(UserSetCacheUser)
+                        .values(chunk)
+                        .on_conflict_do_nothing(index_elements=[
+                            UserSetCacheUser.cache_id, UserSetCacheUser.user_id
+                        ])
+                        .returning(UserSetCacheUser.user_id))
+                row_count += len((await session.execute(stmt)).scalars().all())
 
             await tx1.commit()
 
         # insert user detail
-        for x in content:
-            stmt = insert(UserDetailCache).values(
-                user_id=x.id, user=x.dict(), update_time=metadata.update_time
-            )
+        rows = list({
+            x.id: dict(user_id=x.id, user=x.dict(), update_time=metadata.update_time)
+            for x in content
+        }.values())
+
+        for chunk in _chunked(rows):
+            stmt = insert(UserDetailCache).values(chunk)
             stmt = stmt.on_conflict_do_update(
                 index_elements=[UserDetailCache.user_id],
                 set_={
@@ -304,7 +424,7 @@ class SqlPixivRepo(LocalPixivRepo):
                 }
             )
             await session.execute(stmt)
-            await session.commit()
+        await session.commit()
 
         return row_count != len(content)
 
@@ -316,28 +436,39 @@ class SqlPixivRepo(LocalPixivRepo):
         async with data_source.start_session() as session:
             stmt = select(IllustDetailCache).where(IllustDetailCache.illust_id == illust_id).limit(1)
             cache = (await session.execute(stmt)).scalar_one_or_none()
+            illust = self._decode_illust(cache.illust_id, cache.illust) if cache is not None else None
 
-            if cache is not None:
+            if illust is not None:
                 metadata = _extract_metadata(cache, False).check_is_expired(conf.pixiv_illust_detail_cache_expires_in)
 
                 yield metadata
-                yield Illust(**cache.illust)
+                yield illust
             else:
                 raise NoSuchItemError()
 
-    async def update_illust_detail(self, illust: Illust, metadata: PixivRepoMetadata):
-        logger.debug(f"[local] update illust_detail {illust.id} {metadata}")
+    async def illust_details(self, illust_ids: Collection[int]) -> Dict[int, Illust]:
+        logger.debug(f"[local] illust_details ({len(illust_ids)} items)")
 
+        illust_ids = list(set(illust_ids))
+        since = datetime.now(timezone.utc) - timedelta(seconds=conf.pixiv_illust_detail_cache_expires_in)
+
+        result = {}
         async with data_source.start_session() as session:
-            stmt = (insert(IllustDetailCache)
-                    .values(illust_id=illust.id, illust=illust.dict(), update_time=metadata.update_time))
-            stmt = stmt.on_conflict_do_update(index_elements=[IllustDetailCache.illust_id],
-                                              set_={
-                                                  IllustDetailCache.illust: stmt.excluded.illust,
-                                                  IllustDetailCache.update_time: stmt.excluded.update_time
-                                              })
+            for i in range(0, len(illust_ids), _BULK_CHUNK_SIZE):
+                stmt = (select(IllustDetailCache.illust_id, IllustDetailCache.illust)
+                        .where(IllustDetailCache.illust_id.in_(illust_ids[i:i + _BULK_CHUNK_SIZE]),
+                               IllustDetailCache.update_time > since))
+                for illust_id, data in await session.execute(stmt):
+                    illust = self._decode_illust(illust_id, data)
+                    if illust is not None:
+                        result[illust_id] = illust
+        return result
 
-            await session.execute(stmt)
+    async def update_illust_detail(self, illust: Illust, metadata: PixivRepoMetadata):
+        logger.debug(f"[local] update illust_detail {illust.id} {metadata}")
+
+        async with data_source.start_session(write=True) as session:
+            await self._upsert_illust_details(session, [illust], metadata.update_time)
             await session.commit()
 
             if conf.pixiv_tag_translation_enabled:
@@ -363,7 +494,7 @@ class SqlPixivRepo(LocalPixivRepo):
     async def update_user_detail(self, user: User, metadata: PixivRepoMetadata):
         logger.debug(f"[local] update user_detail {user.id} {metadata}")
 
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             stmt = (insert(UserDetailCache)
                     .values(user_id=user.id, user=user.dict(), update_time=metadata.update_time))
             stmt = stmt.on_conflict_do_update(index_elements=[UserDetailCache.user_id],
@@ -376,12 +507,29 @@ class SqlPixivRepo(LocalPixivRepo):
             await session.commit()
 
     # ================ image ================
-    async def image(self, illust: Illust, page: int = 0) -> AsyncGenerator[Union[bytes, PixivRepoMetadata], None]:
-        logger.debug(f"[local] image {illust.id}")
+    async def image(self, illust: Illust, page: int = 0,
+                    quantity: DownloadQuantity = DownloadQuantity.original) \
+            -> AsyncGenerator[Union[bytes, PixivRepoMetadata], None]:
+        logger.debug(f"[local] image {illust.id}[{page}] {quantity.value}")
+
+        if self._image_store is not None:
+            # 直接读取文件，不经过数据库连接
+            blob = await self._image_store.read(image_key(illust.id, page, quantity.value))
+            if blob is not None:
+                update_time, content = blob
+                metadata = PixivRepoMetadata(update_time=update_time) \
+                    .check_is_expired(conf.pixiv_download_cache_expires_in)
+
+                yield metadata
+                yield content
+                return
 
+        # 存放在数据库中的图片（pixiv_sql_image_storage为database，或者迁移之前写入的）
         async with data_source.start_session() as session:
             stmt = select(DownloadCache).where(DownloadCache.illust_id == illust.id,
-                                               DownloadCache.page == page).limit(1)
+                                               DownloadCache.page == page,
+                                               DownloadCache.quantity == quantity.value,
+                                               DownloadCache.content.is_not(None)).limit(1)
             cache = (await session.execute(stmt)).scalar_one_or_none()
 
             if cache is not None:
@@ -393,21 +541,68 @@ class SqlPixivRepo(LocalPixivRepo):
                 raise NoSuchItemError()
 
     async def update_image(self, illust_id: int, page: int,
-                           content: bytes, metadata: PixivRepoMetadata):
-        logger.debug(f"[local] update image {illust_id} {metadata}")
+                           content: bytes, metadata: PixivRepoMetadata,
+                           quantity: DownloadQuantity = DownloadQuantity.original):
+        logger.debug(f"[local] update image {illust_id}[{page}] {quantity.value} {metadata}")
 
-        async with data_source.start_session() as session:
+        if self._image_store is not None:
+            await self._image_store.write(image_key(illust_id, page, quantity.value), content, metadata.update_time)
+            stored_content = None
+        else:
+            stored_content = content
+
+        async with data_source.start_session(write=True) as session:
             stmt = (insert(DownloadCache)
-                    .values(illust_id=illust_id, page=page, content=content, update_time=metadata.update_time))
-            stmt = stmt.on_conflict_do_update(index_elements=[DownloadCache.illust_id, DownloadCache.page],
+                    .values(illust_id=illust_id, page=page, quantity=quantity.value,
+                            content=stored_content, size=len(content), digest=sha1(content).hexdigest(),
+                            update_time=metadata.update_time))
+            stmt = stmt.on_conflict_do_update(index_elements=[DownloadCache.illust_id, DownloadCache.page,
+                                                              DownloadCache.quantity],
                                               set_={
                                                   DownloadCache.content: stmt.excluded.content,
+                                                  DownloadCache.size: stmt.excluded.size,
+                                                  DownloadCache.digest: stmt.excluded.digest,
                                                   DownloadCache.update_time: stmt.excluded.update_time
                                               })
 
             await session.execute(stmt)
             await session.commit()
 
+    async def _delete_image_blobs(self, rows: Sequence[Row]):
+        if self._image_store is None:
+            return
+        for row in rows:
+            illust_id, page, quantity = row[:3]
+            await self._image_store.delete(image_key(illust_id, page, quantity))
+
+    # ================ negative_result ================
+    async def negative_result(self, res_type: str, id: int) -> Optional[str]:
+        async with data_source.start_session() as session:
+            stmt = (select(NegativeCache.reason, NegativeCache.update_time)
+                    .where(NegativeCache.res_type == res_type, NegativeCache.id == id))
+            row = (await session.execute(stmt)).one_or_none()
+
+        if row is None:
+            return None
+        update_time = row.update_time.replace(tzinfo=timezone.utc)
+        if datetime.now(timezone.utc) - update_time >= timedelta(seconds=conf.pixiv_negative_cache_expires_in):
+            return None
+        return row.reason
+
+    async def update_negative_result(self, res_type: str, id: int, reason: str):
+        logger.debug(f"[local] update negative_result {res_type} {id}: {reason}")
+
+        async with data_source.start_session(write=True) as session:
+            stmt = insert(NegativeCache).values(res_type=res_type, id=id, reason=reason,
+                                                update_time=datetime.now(timezone.utc))
+            stmt = stmt.on_conflict_do_update(index_elements=[NegativeCache.res_type, NegativeCache.id],
+                                              set_={
+                                                  NegativeCache.reason: stmt.excluded.reason,
+                                                  NegativeCache.update_time: stmt.excluded.update_time
+                                              })
+            await session.execute(stmt)
+            await session.commit()
+
     # ================ illust_ranking ================
     async def illust_ranking(self, mode: Union[str, RankingMode], *, offset: int = 0) \
             -> AsyncGenerator[Union[LazyIllust, PixivRepoMetadata], None]:
@@ -423,7 +618,7 @@ class SqlPixivRepo(LocalPixivRepo):
 
     async def invalidate_illust_ranking(self, mode: RankingMode):
         logger.debug("[local] invalidate illust_ranking")
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             await self._invalidate_illusts(session, "illust_ranking", {"mode": mode})
 
     async def append_illust_ranking(self, mode: RankingMode, content: List[Union[Illust, LazyIllust]],
@@ -431,7 +626,7 @@ class SqlPixivRepo(LocalPixivRepo):
         logger.debug(f"[local] append illust_ranking {mode} "
                      f"({len(content)} items) "
                      f"{metadata}")
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             return await self._append_and_check_illusts(session, "illust_ranking", {"mode": mode},
                                                         content=content, metadata=metadata)
 
@@ -446,7 +641,7 @@ class SqlPixivRepo(LocalPixivRepo):
 
     async def invalidate_search_illust(self, word: str):
         logger.debug(f"[local] invalidate search_illust {word}")
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             await self._invalidate_illusts(session, "search_illust", {"word": word})
 
     async def append_search_illust(self, word: str, content: List[Union[Illust, LazyIllust]],
@@ -455,7 +650,7 @@ class SqlPixivRepo(LocalPixivRepo):
         logger.debug(f"[local] append search_illust {word} "
                      f"({len(content)} items) "
                      f"{metadata}")
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             return await self._append_and_check_illusts(session, "search_illust", {"word": word},
                                                         content=content, metadata=metadata,append_at_begin=True)
 
@@ -470,7 +665,7 @@ class SqlPixivRepo(LocalPixivRepo):
 
     async def invalidate_user_illusts(self, user_id: int):
         logger.debug(f"[local] invalidate user_illusts {user_id}")
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             await self._invalidate_illusts(session, "user_illusts", {"user_id": user_id})
 
     async def append_user_illusts(self, user_id: int,
@@ -481,7 +676,7 @@ class SqlPixivRepo(LocalPixivRepo):
                      f"{'at begin ' if append_at_begin else ''}"
                      f"({len(content)} items) "
                      f"{metadata}")
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             return await self._append_and_check_illusts(session, "user_illusts", {"user_id": user_id},
                                                         content=content, metadata=metadata,
                                                         append_at_begin=append_at_begin)
@@ -497,7 +692,7 @@ class SqlPixivRepo(LocalPixivRepo):
 
     async def invalidate_user_bookmarks(self, user_id: int):
         logger.debug(f"[local] invalidate user_bookmarks {user_id}")
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             await self._invalidate_illusts(session, "user_bookmarks", {"user_id": user_id})
 
     async def append_user_bookmarks(self, user_id: int,
@@ -508,7 +703,7 @@ class SqlPixivRepo(LocalPixivRepo):
                      f"{'at begin ' if append_at_begin else ''} "
                      f"({len(content)} items) "
                      f"{metadata}")
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             return await self._append_and_check_illusts(session, "user_bookmarks", {"user_id": user_id},
                                                         content=content, metadata=metadata,
                                                         append_at_begin=append_at_begin)
@@ -524,7 +719,7 @@ class SqlPixivRepo(LocalPixivRepo):
 
     async def invalidate_recommended_illusts(self):
         logger.debug("[local] invalidate recommended_illusts")
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             await self._invalidate_illusts(session, "other", {"type": "recommended_illusts"})
 
     async def append_recommended_illusts(self, content: List[Union[Illust, LazyIllust]],
@@ -532,7 +727,7 @@ class SqlPixivRepo(LocalPixivRepo):
         logger.debug(f"[local] append recommended_illusts "
                      f"({len(content)} items) "
                      f"{metadata}")
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             return await self._append_and_check_illusts(session, "other", {"type": "recommended_illusts"},
                                                         content=content, metadata=metadata)
 
@@ -548,7 +743,7 @@ class SqlPixivRepo(LocalPixivRepo):
 
     async def invalidate_related_illusts(self, illust_id: int):
         logger.debug("[local] invalidate related_illusts")
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             await self._invalidate_illusts(session, "related_illusts", {"original_illust_id": illust_id})
 
     async def append_related_illusts(self, illust_id: int, content: List[Union[Illust, LazyIllust]],
@@ -556,7 +751,7 @@ class SqlPixivRepo(LocalPixivRepo):
         logger.debug(f"[local] append related_illusts {illust_id} "
                      f"({len(content)} items) "
                      f"{metadata}")
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             return await self._append_and_check_illusts(session, "related_illusts", {"original_illust_id": illust_id},
                                                         content=content, metadata=metadata)
 
@@ -571,7 +766,7 @@ class SqlPixivRepo(LocalPixivRepo):
 
     async def invalidate_search_user(self, word: str):
         logger.debug(f"[local] invalidate search_user {word}")
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             await self._invalidate_users(session, "search_user", {"word": word})
 
     async def append_search_user(self, word: str, content: List[User],
@@ -579,102 +774,184 @@ class SqlPixivRepo(LocalPixivRepo):
         logger.debug(f"[local] append search_user {word} "
                      f"({len(content)} items) "
                      f"{metadata}")
-        async with data_source.start_session() as session:
+        async with data_source.start_session(write=True) as session:
             return await self._append_and_check_users(session, "search_user", {"word": word},
                                                       content=content, metadata=metadata)
 
     async def invalidate_all(self):
         logger.debug("[local] invalidate_all")
 
-        async with data_source.start_session() as session:
-            if conf.pixiv_sql_dialect == 'sqlite':
-                await session.execute(text("PRAGMA foreign_keys = ON;"))
-
+        async with data_source.start_session(write=True) as session:
             result = await session.execute(delete(IllustSetCache))
             logger.success(f"[local] deleted {result.rowcount} illust_set cache")
             result = await session.execute(delete(UserSetCache))
             logger.success(f"[local] deleted {result.rowcount} user_set cache")
             result = await session.execute(delete(IllustDetailCache))
             logger.success(f"[local] deleted {result.rowcount} illust_detail cache")
+            await session.execute(delete(IllustLightCache))
             result = await session.execute(delete(UserDetailCache))
             logger.success(f"[local] deleted {result.rowcount} user_detail cache")
             result = await session.execute(delete(DownloadCache))
             logger.success(f"[local] deleted {result.rowcount} download cache")
+            await session.execute(delete(NegativeCache))
             await session.commit()
 
-    async def clean_expired(self):
-        logger.debug("[local] clean_expired")
-
-        async with data_source.start_session() as session:
-            if conf.pixiv_sql_dialect == 'sqlite':
-                await session.execute(text("PRAGMA foreign_keys = ON;"))
-
-            now = datetime.utcnow()
-            stmt = delete(IllustDetailCache).where(
-                IllustDetailCache.update_time <= now - timedelta(seconds=conf.pixiv_illust_detail_cache_expires_in)
-            )
-            result = await session.execute(stmt)
-            logger.success(f"[local] deleted {result.rowcount} illust_detail cache")
-
-            stmt = delete(UserDetailCache).where(
-                UserDetailCache.update_time <= now - timedelta(seconds=conf.pixiv_user_detail_cache_expires_in)
-            )
-            result = await session.execute(stmt)
-            logger.success(f"[local] deleted {result.rowcount} user_detail cache")
-
-            stmt = delete(DownloadCache).where(
-                DownloadCache.update_time <= now - timedelta(seconds=conf.pixiv_download_cache_expires_in)
-            )
-            result = await session.execute(stmt)
-            logger.success(f"[local] deleted {result.rowcount} download cache")
-
-            stmt = delete(IllustSetCache).where(
-                IllustSetCache.cache_type == 'illust_ranking',
-                IllustSetCache.update_time <= now - timedelta(seconds=conf.pixiv_illust_ranking_cache_expires_in)
-            )
-            result = await session.execute(stmt)
-            logger.success(f"[local] deleted {result.rowcount} illust_ranking cache")
-
-            stmt = delete(IllustSetCache).where(
-                IllustSetCache.cache_type == 'search_illust',
-                IllustSetCache.update_time <= now - timedelta(seconds=conf.pixiv_search_illust_cache_delete_in)
-            )
-            result = await session.execute(stmt)
-            logger.success(f"[local] deleted {result.rowcount} search_illust cache")
+        if self._image_store is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._image_store.clear)
+
+    async def _delete_in_batches(self, pk: Sequence[InstrumentedAttribute],
+                                 where: ColumnElement[bool],
+                                 size: Optional[ColumnElement[int]] = None,
+                                 on_deleted: Optional[Callable[[Sequence[Row]], Awaitable[None]]] = None) \
+            -> CleanResult:
+        """
+        分批删除满足条件的行，每批在单独的事务中完成，批与批之间让出事件循环，不会长时间锁住数据库
+        批大小不超过pixiv_sql_clean_batch_size，单批耗时超过pixiv_sql_clean_step_time_limit时减半
+
+        :param pk: 表的主键列
+        :param size: 用于统计回收字节数的表达式
+        :param on_deleted: 每批删除后以该批的行调用
+        """
+        result = CleanResult()
+
+        max_batch_size = max(1, conf.pixiv_sql_clean_batch_size)
+        time_limit = conf.pixiv_sql_clean_step_time_limit / 1000
+        batch_size = max_batch_size
+
+        pk_expr = tuple_(*pk) if len(pk) > 1 else pk[0]
+        columns = [*pk, size] if size is not None else pk
+
+        while True:
+            begin = perf_counter()
+            async with data_source.start_session(write=True) as session:
+                rows = (await session.execute(select(*columns).where(where).limit(batch_size))).all()
+                if len(rows) == 0:
+                    break
+
+                if len(pk) > 1:
+                    keys = [tuple(x[:len(pk)]) for x in rows]
+                else:
+                    keys = [x[0] for x in rows]
+
+                await session.execute(delete(pk[0].class_).where(pk_expr.in_(keys)))
+                await session.commit()
+
+            if on_deleted is not None:
+                await on_deleted(rows)
+
+            result.rows += len(rows)
+            if size is not None:
+                result.bytes += sum(x[-1] or 0 for x in rows)
+
+            if len(rows) < batch_size:
+                break
+
+            elapsed = perf_counter() - begin
+            if elapsed > time_limit:
+                batch_size = max(1, batch_size // 2)
+            elif elapsed < time_limit / 2:
+                batch_size = min(max_batch_size, batch_size * 2)
+
+            await asyncio.sleep(0)
+
+        return result
+
+    async def _delete_set_caches_in_batches(self, cache_table: type, item_table: type,
+                                            where: ColumnElement[bool]) -> CleanResult:
+        # 先分批删除集合中的条目，再删除集合本身，避免一次级联删除大量条目
+        item_pk = [getattr(item_table, x.name) for x in inspect(item_table).primary_key]
+        items_where = item_table.cache_id.in_(select(cache_table.id).where(where))
+        await self._delete_in_batches(item_pk, items_where)
+
+        return await self._delete_in_batches([cache_table.id], where)
+
+    async def _vacuum(self):
+        if conf.pixiv_sql_vacuum == 'none' or conf.pixiv_sql_dialect != 'sqlite':
+            return
+
+        # 只在没有其他会话时进行，否则留待下次清理
+        if data_source.active_sessions > 0:
+            logger.info("[local] database is busy, skip vacuum")
+            return
+
+        begin = perf_counter()
+        async with data_source.writer_lock(), data_source.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            if conf.pixiv_sql_vacuum == 'incremental':
+                auto_vacuum = (await conn.execute(text("PRAGMA auto_vacuum;"))).scalar_one()
+                if auto_vacuum != 2:
+                    logger.warning("[local] incremental vacuum requires auto_vacuum=INCREMENTAL, "
+                                   "run \"PRAGMA auto_vacuum = INCREMENTAL; VACUUM;\" on the database first")
+                    return
+                await conn.execute(text("PRAGMA incremental_vacuum;"))
+            else:
+                await conn.execute(text("VACUUM;"))
+        logger.success(f"[local] {conf.pixiv_sql_vacuum} vacuum done in {perf_counter() - begin:.2f}s")
 
-            stmt = delete(UserSetCache).where(
-                UserSetCache.cache_type == 'search_user',
-                UserSetCache.update_time <= now - timedelta(seconds=conf.pixiv_search_user_cache_delete_in)
-            )
-            result = await session.execute(stmt)
-            logger.success(f"[local] deleted {result.rowcount} search_user cache")
+    async def clean_expired(self) -> Dict[str, CleanResult]:
+        logger.debug("[local] clean_expired")
 
-            stmt = delete(IllustSetCache).where(
-                IllustSetCache.cache_type == 'user_illusts',
-                IllustSetCache.update_time <= now - timedelta(seconds=conf.pixiv_user_illusts_cache_delete_in)
+        now = datetime.now(timezone.utc)
+        grace = conf.pixiv_cache_stale_grace
+
+        def expired(model, expires_in: int, grace_type: Optional[str] = None) -> ColumnElement[bool]:
+            # 宽限期内的过期缓存仍会被使用，宽限期过后才删除
+            if grace_type is not None:
+                expires_in += grace.get(grace_type, 0)
+            return model.update_time <= now - timedelta(seconds=expires_in)
+
+        results = {
+            "illust_detail": await self._delete_in_batches(
+                [IllustDetailCache.illust_id],
+                expired(IllustDetailCache, conf.pixiv_illust_detail_cache_expires_in, "illust_detail"),
+                func.length(IllustDetailCache.illust)
+            ),
+            "illust_light": await self._delete_in_batches(
+                [IllustLightCache.illust_id],
+                expired(IllustLightCache, conf.pixiv_illust_detail_cache_expires_in, "illust_detail")
+            ),
+            "user_detail": await self._delete_in_batches(
+                [UserDetailCache.user_id],
+                expired(UserDetailCache, conf.pixiv_user_detail_cache_expires_in, "user_detail")
+            ),
+            "download": await self._delete_in_batches(
+                [DownloadCache.illust_id, DownloadCache.page, DownloadCache.quantity],
+                expired(DownloadCache, conf.pixiv_download_cache_expires_in, "image"),
+                func.coalesce(DownloadCache.size, func.length(DownloadCache.content)),
+                on_deleted=self._delete_image_blobs
+            ),
+            "negative": await self._delete_in_batches(
+                [NegativeCache.res_type, NegativeCache.id],
+                expired(NegativeCache, conf.pixiv_negative_cache_expires_in)
+            ),
+        }
+
+        for cache_type, expires_in, grace_type in [
+            ('illust_ranking', conf.pixiv_illust_ranking_cache_expires_in, 'illust_ranking'),
+            ('search_illust', conf.pixiv_search_illust_cache_delete_in, None),
+            ('user_illusts', conf.pixiv_user_illusts_cache_delete_in, None),
+            ('user_bookmarks', conf.pixiv_user_bookmarks_cache_delete_in, None),
+            ('related_illusts', conf.pixiv_related_illusts_cache_expires_in, 'related_illusts'),
+            ('other', conf.pixiv_other_cache_expires_in, 'recommended_illusts'),
+        ]:
+            results[cache_type] = await self._delete_set_caches_in_batches(
+                IllustSetCache, IllustSetCacheIllust,
+                and_(IllustSetCache.cache_type == cache_type, expired(IllustSetCache, expires_in, grace_type))
             )
-            result = await session.execute(stmt)
-            logger.success(f"[local] deleted {result.rowcount} user_illusts cache")
 
-            stmt = delete(IllustSetCache).where(
-                IllustSetCache.cache_type == 'user_bookmarks',
-                IllustSetCache.update_time <= now - timedelta(seconds=conf.pixiv_user_bookmarks_cache_delete_in)
-            )
-            result = await session.execute(stmt)
-            logger.success(f"[local] deleted {result.rowcount} user_bookmarks cache")
+        results['search_user'] = await self._delete_set_caches_in_batches(
+            UserSetCache, UserSetCacheUser,
+            and_(UserSetCache.cache_type == 'search_user',
+                 expired(UserSetCache, conf.pixiv_search_user_cache_delete_in))
+        )
 
-            stmt = delete(IllustSetCache).where(
-                IllustSetCache.cache_type == 'related_illusts',
-                IllustSetCache.update_time <= now - timedelta(seconds=conf.pixiv_related_illusts_cache_expires_in)
-            )
-            result = await session.execute(stmt)
-            logger.success(f"[local] deleted {result.rowcount} related_illusts cache")
+        for name, result in results.items():
+            if result.bytes > 0:
+                logger.success(f"[local] deleted {result.rows} {name} cache ({result.bytes} bytes)")
+            else:
+                logger.success(f"[local] deleted {result.rows} {name} cache")
 
-            stmt = delete(IllustSetCache).where(
-                IllustSetCache.cache_type == 'other',
-                IllustSetCache.update_time <= now - timedelta(seconds=conf.pixiv_other_cache_expires_in)
-            )
-            result = await session.execute(stmt)
-            logger.success(f"[local] deleted {result.rowcount} other cache")
+        if any(x.rows > 0 for x in results.values()):
+            await self._vacuum()
 
-            await session.commit()
+        return results
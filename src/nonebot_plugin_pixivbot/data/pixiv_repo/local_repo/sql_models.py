@@ -1,7 +1,7 @@
 from datetime import datetime
 from typing import Optional, List
 
-from sqlalchemy import ForeignKey, UniqueConstraint
+from sqlalchemy import ForeignKey, String, Index
 from sqlalchemy.orm import mapped_column, relationship, Mapped
 
 from ...source.sql import DataSource
@@ -14,7 +14,21 @@ class DownloadCache:
 
     illust_id: Mapped[int] = mapped_column(primary_key=True)
     page: Mapped[int] = mapped_column(primary_key=True, default=0)
-    content: Mapped[bytes] = mapped_column(BLOB)
+    quantity: Mapped[str] = mapped_column(String(16), primary_key=True, default="original")
+    content: Mapped[Optional[bytes]] = mapped_column(BLOB)  # 图片内容存放在文件中时为NULL
+    size: Mapped[Optional[int]]
+    digest: Mapped[Optional[str]] = mapped_column(String(40))  # 图片内容的SHA1
+
+    update_time: Mapped[datetime] = mapped_column(UTCDateTime, index=True)
+
+
+@DataSource.registry.mapped
+class NegativeCache:
+    __tablename__ = "negative_cache"
+
+    res_type: Mapped[str] = mapped_column(String(32), primary_key=True)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    reason: Mapped[str]
 
     update_time: Mapped[datetime] = mapped_column(UTCDateTime, index=True)
 
@@ -24,7 +38,24 @@ class IllustDetailCache:
     __tablename__ = "illust_detail_cache"
 
     illust_id: Mapped[int] = mapped_column(primary_key=True)
-    illust: Mapped[dict] = mapped_column(JSON)
+    illust: Mapped[bytes] = mapped_column(BLOB)  # 经codec编码的Illust
+
+    update_time: Mapped[datetime] = mapped_column(UTCDateTime, index=True)
+
+
+@DataSource.registry.mapped
+class IllustLightCache:
+    """
+    插画的投影（见LightIllust），与IllustDetailCache一同写入；随机选取插画时只需读取这张表
+    """
+    __tablename__ = "illust_light_cache"
+
+    illust_id: Mapped[int] = mapped_column(primary_key=True)
+    total_bookmarks: Mapped[int]
+    total_view: Mapped[int]
+    create_date: Mapped[datetime] = mapped_column(UTCDateTime)
+    tags: Mapped[list] = mapped_column(JSON)
+    illust_ai_type: Mapped[int] = mapped_column(default=0)
 
     update_time: Mapped[datetime] = mapped_column(UTCDateTime, index=True)
 
@@ -46,6 +77,7 @@ class IllustSetCache:
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     cache_type: Mapped[str]
     key: Mapped[dict] = mapped_column(JSON)
+    key_hash: Mapped[str] = mapped_column(String(40))  # hash_key(key)，按此查找
 
     update_time: Mapped[datetime] = mapped_column(UTCDateTime, index=True)
     pages: Mapped[Optional[int]]
@@ -58,7 +90,7 @@ class IllustSetCache:
     size: Mapped[int] = mapped_column(default=0)
 
     __table_args__ = (
-        UniqueConstraint('cache_type', 'key'),
+        Index("ix_illust_set_cache_cache_type_key_hash", "cache_type", "key_hash", unique=True),
     )
 
 
@@ -70,6 +102,11 @@ class IllustSetCacheIllust:
     illust_id: Mapped[int] = mapped_column(primary_key=True)
     rank: Mapped[int] = mapped_column(default=0)
 
+    __table_args__ = (
+        # 按(cache_id, rank)分页读取集合
+        Index("ix_illust_set_cache_illust_cache_id_rank", "cache_id", "rank"),
+    )
+
 
 @DataSource.registry.mapped
 class UserSetCache:
@@ -78,6 +115,7 @@ class UserSetCache:
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     cache_type: Mapped[str]
     key: Mapped[dict] = mapped_column(JSON)
+    key_hash: Mapped[str] = mapped_column(String(40))  # hash_key(key)，按此查找
 
     update_time: Mapped[datetime] = mapped_column(UTCDateTime, index=True)
     pages: Mapped[Optional[int]]
@@ -88,7 +126,7 @@ class UserSetCache:
                                                                passive_deletes=True)
 
     __table_args__ = (
-        UniqueConstraint('cache_type', 'key'),
+        Index("ix_user_set_cache_cache_type_key_hash", "cache_type", "key_hash", unique=True),
     )
 
 
@@ -1,10 +1,16 @@
 from datetime import datetime, timezone
-from typing import List, AsyncGenerator, TypeVar, Union, Callable, Awaitable, Optional, Any, Mapping, Protocol, Generic
+from functools import partial
+from typing import List, AsyncGenerator, TypeVar, Union, Callable, Awaitable, Optional, Any, Mapping, Protocol, \
+    Generic, Hashable
 
 from nonebot import logger
+from pydantic import BaseModel
 
 from .errors import NoSuchItemError, CacheExpiredError
 from .models import PixivRepoMetadata
+from .query_mode import use_stale_grace
+from .write_behind import WriteBehindQueue, WriteOp
+from ...utils.errors import ResourceGoneError
 from ...utils.format import format_kwargs
 
 T = TypeVar("T")
@@ -17,40 +23,108 @@ class Mediator(Protocol[T]):
         ...
 
 
-class SingleMediator(Mediator, Generic[T]):
+async def _iter_with_stale_grace(agen: AsyncGenerator[T, None], grace: int) -> AsyncGenerator[T, None]:
+    """
+    读取缓存时允许使用过期不超过grace秒的缓存（只在每次获取item期间设置，不影响消费者）
+    """
+    if grace <= 0:
+        async for x in agen:
+            yield x
+        return
+
+    try:
+        while True:
+            with use_stale_grace(grace):
+                try:
+                    x = await agen.__anext__()
+                except StopAsyncIteration:
+                    break
+            yield x
+    finally:
+        await agen.aclose()
+
+
+class _CacheWriterMixin:
+    tag: str
+    write_behind: Optional[WriteBehindQueue]
+
+    def _key_of(self, query_kwargs: T_KWARGS) -> Hashable:
+        return self.tag, tuple((k, v.id if isinstance(v, BaseModel) else v) for k, v in query_kwargs.items())
+
+    async def _wait_flushed(self, query_kwargs: T_KWARGS):
+        # 读取缓存之前等待尚未写入的数据写入
+        if self.write_behind is not None:
+            await self.write_behind.wait_flushed(self._key_of(query_kwargs))
+
+    async def _write_cache(self, query_kwargs: T_KWARGS, op: WriteOp):
+        if self.write_behind is not None:
+            await self.write_behind.put(self._key_of(query_kwargs), op)
+            logger.debug(f"[{self.tag}] cache {op.kind} enqueued  ({format_kwargs(**query_kwargs)})")
+        else:
+            await op()
+            logger.debug(f"[{self.tag}] cache {op.kind} done  ({format_kwargs(**query_kwargs)})")
+
+
+class SingleMediator(_CacheWriterMixin, Mediator, Generic[T]):
     def __init__(self, tag: str,
                  cache_factory: Callable[[T_KWARGS], AsyncGenerator[Union[T, PixivRepoMetadata], None]],
                  remote_factory: Callable[[T_KWARGS], AsyncGenerator[Union[T, PixivRepoMetadata], None]],
-                 cache_updater: Callable[[T_KWARGS, T, Optional[PixivRepoMetadata]], Awaitable[Any]]):
+                 cache_updater: Callable[[T_KWARGS, T, Optional[PixivRepoMetadata]], Awaitable[Any]],
+                 write_behind: Optional[WriteBehindQueue] = None,
+                 stale_grace: int = 0,
+                 negative_loader: Optional[Callable[[T_KWARGS], Awaitable[Optional[str]]]] = None,
+                 negative_updater: Optional[Callable[[T_KWARGS, str], Awaitable[Any]]] = None):
+        """
+        :param negative_loader: 读取缓存的查询失败的原因（没有时返回None），存在时不再向远程查询
+        :param negative_updater: 远程查询的资源不存在（ResourceGoneError）时记录失败的原因
+        """
         self.tag = tag
+        self.write_behind = write_behind
+        self.stale_grace = stale_grace
         self.cache_factory = cache_factory
         self.remote_factory = remote_factory
         self.cache_updater = cache_updater
+        self.negative_loader = negative_loader
+        self.negative_updater = negative_updater
 
     async def mediate(self, query_kwargs: T_KWARGS,
                       *, force_expiration: bool = False) -> AsyncGenerator[Union[T, PixivRepoMetadata], None]:
         try:
             if force_expiration:
                 raise NoSuchItemError()
-            async for x in self.cache_factory(query_kwargs):
+            await self._wait_flushed(query_kwargs)
+            async for x in _iter_with_stale_grace(self.cache_factory(query_kwargs), self.stale_grace):
                 yield x
             logger.info(f"[{self.tag}] cache loaded  ({format_kwargs(**query_kwargs)})")
         except (NoSuchItemError, CacheExpiredError):
             logger.info(f"[{self.tag}] no cache or cache expired  ({format_kwargs(**query_kwargs)})")
 
+            if not force_expiration and self.negative_loader is not None:
+                reason = await self.negative_loader(query_kwargs)
+                if reason is not None:
+                    logger.info(f"[{self.tag}] negative cache loaded: {reason}  ({format_kwargs(**query_kwargs)})")
+                    raise ResourceGoneError(reason)
+
             content = None
             metadata = None
 
-            async for x in self.remote_factory(query_kwargs):
-                if isinstance(x, PixivRepoMetadata):
-                    metadata = x
-                else:
-                    content = x
+            try:
+                async for x in self.remote_factory(query_kwargs):
+                    if isinstance(x, PixivRepoMetadata):
+                        metadata = x
+                    else:
+                        content = x
+            except ResourceGoneError as e:
+                # 只记录资源不存在的错误，网络错误、限流等暂时性的错误不记录
+                if self.negative_updater is not None:
+                    await self.negative_updater(query_kwargs, str(e))
+                raise
 
             if metadata:
-                # 先update再yield，受到SharedAsyncGeneratorManager的影响finally内的语句无法按时执行
-                await self.cache_updater(query_kwargs, content, metadata)
-                logger.debug(f"[{self.tag}] cache updated  ({format_kwargs(**query_kwargs)})")
+                # 先update（或入队）再yield，受到SharedAsyncGeneratorManager的影响finally内的语句无法按时执行
+                await self._write_cache(query_kwargs,
+                                        WriteOp("update", partial(self.cache_updater, query_kwargs),
+                                                content, metadata))
 
                 yield metadata
                 yield content
@@ -59,13 +133,17 @@ class SingleMediator(Mediator, Generic[T]):
                 raise RuntimeError("no metadata")
 
 
-class ManyMediator(Mediator, Generic[T]):
+class ManyMediator(_CacheWriterMixin, Mediator, Generic[T]):
     def __init__(self, tag: str,
                  cache_factory: Callable[[T_KWARGS], AsyncGenerator[Union[T, PixivRepoMetadata], None]],
                  remote_factory: Callable[[T_KWARGS], AsyncGenerator[Union[T, PixivRepoMetadata], None]],
                  cache_invalidator: Callable[[T_KWARGS], Awaitable[Any]],
-                 cache_appender: Callable[[T_KWARGS, List[T], Optional[PixivRepoMetadata]], Awaitable[Any]]):
+                 cache_appender: Callable[[T_KWARGS, List[T], Optional[PixivRepoMetadata]], Awaitable[Any]],
+                 write_behind: Optional[WriteBehindQueue] = None,
+                 stale_grace: int = 0):
         self.tag = tag
+        self.write_behind = write_behind
+        self.stale_grace = stale_grace
         self.cache_factory = cache_factory
         self.remote_factory = remote_factory
         self.cache_invalidator = cache_invalidator
@@ -78,6 +156,7 @@ class ManyMediator(Mediator, Generic[T]):
         loaded_pages = 0
 
         # first load from cache
+        await self._wait_flushed(query_kwargs)
         metadata = None
         async for x in self.cache_factory(query_kwargs):
             if isinstance(x, PixivRepoMetadata):
@@ -107,34 +186,49 @@ class ManyMediator(Mediator, Generic[T]):
     async def _load_many_from_remote_and_append(self, query_kwargs: T_KWARGS,
                                                 max_item: int,
                                                 max_page: int,
-                                                metadata_page_offset: int = 0):
+                                                metadata_page_offset: int = 0,
+                                                replace: bool = False):
+        """
+        :param replace: 是否替换原有的缓存。替换时在写入第一页之前才使原有的缓存失效，获取第一页期间仍可读取原有的缓存
+        """
         loaded_items = 0
         loaded_pages = 0
 
         buffer = []
 
-        async for item in self.remote_factory(query_kwargs):
-            if isinstance(item, PixivRepoMetadata):
-                item.pages += metadata_page_offset
-                loaded_pages = item.pages
+        # 提前返回时立即关闭remote，以便取消其预读
+        remote = self.remote_factory(query_kwargs)
+        try:
+            async for item in remote:
+                if isinstance(item, PixivRepoMetadata):
+                    item.pages += metadata_page_offset
+                    loaded_pages = item.pages
 
-                if len(buffer) > 0:
-                    await self.cache_appender(query_kwargs, buffer, item)
-                    logger.debug(f"[{self.tag}] cache appended  ({format_kwargs(**query_kwargs)})")
+                    if len(buffer) > 0:
+                        if replace:
+                            await self._write_cache(query_kwargs,
+                                                    WriteOp("invalidate", partial(self.cache_invalidator, query_kwargs)))
+                            replace = False
 
-                    for x in buffer:
-                        yield x
+                        await self._write_cache(query_kwargs,
+                                                WriteOp("append", partial(self.cache_appender, query_kwargs),
+                                                        list(buffer), item.copy()))
 
-                    buffer.clear()
+                        for x in buffer:
+                            yield x
 
-                    # check whether we approach limit
-                    if loaded_items >= max_item or loaded_pages >= max_page:
-                        return
+                        buffer.clear()
 
-                yield item
-            else:
-                loaded_items += 1
-                buffer.append(item)
+                        # check whether we approach limit
+                        if loaded_items >= max_item or loaded_pages >= max_page:
+                            return
+
+                    yield item
+                else:
+                    loaded_items += 1
+                    buffer.append(item)
+        finally:
+            await remote.aclose()
 
     async def mediate(self, query_kwargs: T_KWARGS,
                       *, force_expiration: bool = False,
@@ -142,9 +236,11 @@ class ManyMediator(Mediator, Generic[T]):
                       max_page: int = 2 ** 31, ) -> AsyncGenerator[Union[T, PixivRepoMetadata], None]:
         try:
             if force_expiration:
-                raise NoSuchItemError()
+                raise CacheExpiredError(PixivRepoMetadata())
 
-            async for x in self._load_many_from_local_and_remote_and_append(query_kwargs, max_item, max_page):
+            async for x in _iter_with_stale_grace(
+                    self._load_many_from_local_and_remote_and_append(query_kwargs, max_item, max_page),
+                    self.stale_grace):
                 yield x
         except NoSuchItemError:
             logger.info(f"[{self.tag}] no cache  ({format_kwargs(**query_kwargs)})")
@@ -152,9 +248,7 @@ class ManyMediator(Mediator, Generic[T]):
                 yield x
         except CacheExpiredError:
             logger.info(f"[{self.tag}] cache expired  ({format_kwargs(**query_kwargs)})")
-            await self.cache_invalidator(query_kwargs)
-            logger.info(f"[{self.tag}] cache invalidated  ({format_kwargs(**query_kwargs)})")
-            async for x in self._load_many_from_remote_and_append(query_kwargs, max_item, max_page):
+            async for x in self._load_many_from_remote_and_append(query_kwargs, max_item, max_page, replace=True):
                 yield x
 
 
@@ -164,8 +258,9 @@ class AppendMediator(ManyMediator):
                  remote_factory: Callable[[T_KWARGS], AsyncGenerator[Union[T, PixivRepoMetadata], None]],
                  cache_invalidator: Callable[[T_KWARGS], Awaitable[Any]],
                  cache_appender: Callable[[T_KWARGS, List[T], Optional[PixivRepoMetadata]], Awaitable[Any]],
-                 front_cache_appender: Callable[[T_KWARGS, List[T], Optional[PixivRepoMetadata]], Awaitable[bool]]):
-        super().__init__(tag, cache_factory, remote_factory, cache_invalidator, cache_appender)
+                 front_cache_appender: Callable[[T_KWARGS, List[T], Optional[PixivRepoMetadata]], Awaitable[bool]],
+                 write_behind: Optional[WriteBehindQueue] = None):
+        super().__init__(tag, cache_factory, remote_factory, cache_invalidator, cache_appender, write_behind)
         self.front_cache_appender = front_cache_appender
 
     async def mediate(self, query_kwargs: Mapping[str, Any],
@@ -174,6 +269,7 @@ class AppendMediator(ManyMediator):
                       max_page: int = 2 ** 31) -> AsyncGenerator[Union[T, PixivRepoMetadata], None]:
         try:
             if force_expiration:
+                await self._wait_flushed(query_kwargs)
                 metadata = None
                 async for x in self.cache_factory(query_kwargs):
                     if isinstance(x, PixivRepoMetadata):
@@ -201,23 +297,28 @@ class AppendMediator(ManyMediator):
             buffer = []
             metadata = e.metadata
 
-            async for x in self.remote_factory(query_kwargs):
-                if isinstance(x, PixivRepoMetadata):
-                    loaded_pages = x.pages
-                    # we don't use this metadata
-
-                    if len(buffer) > 0:
-                        metadata.update_time = datetime.now(timezone.utc)
-                        if await self.front_cache_appender(query_kwargs, buffer, metadata):
-                            break
-                        buffer = []
-
-                        # check whether we approach limit
-                        if loaded_items >= max_item or loaded_pages >= max_page:
-                            return
-                else:
-                    loaded_items += 1
-                    buffer.append(x)
+            remote = self.remote_factory(query_kwargs)
+            try:
+                async for x in remote:
+                    if isinstance(x, PixivRepoMetadata):
+                        loaded_pages = x.pages
+                        # we don't use this metadata
+
+                        if len(buffer) > 0:
+                            metadata.update_time = datetime.now(timezone.utc)
+                            # 需要根据结果决定是否继续，因此不经过延迟写入队列
+                            if await self.front_cache_appender(query_kwargs, buffer, metadata):
+                                break
+                            buffer = []
+
+                            # check whether we approach limit
+                            if loaded_items >= max_item or loaded_pages >= max_page:
+                                return
+                    else:
+                        loaded_items += 1
+                        buffer.append(x)
+            finally:
+                await remote.aclose()
 
             async for x in self._load_many_from_local_and_remote_and_append(query_kwargs, max_item, max_page):
                 yield x
@@ -1,15 +1,18 @@
+import asyncio
 from datetime import datetime, timedelta
-from typing import Any, AsyncGenerator, Union
+from typing import Any, AsyncGenerator, Union, Dict
 
+from cachetools import TTLCache
 from frozendict import frozendict
 from nonebot import logger
 from pydantic import BaseModel
 
 from nonebot.compat import PYDANTIC_V2
 from nonebot_plugin_pixivbot.config import Config
-from nonebot_plugin_pixivbot.enums import RankingMode
+from nonebot_plugin_pixivbot.enums import RankingMode, DownloadQuantity
 from nonebot_plugin_pixivbot.global_context import context
 from nonebot_plugin_pixivbot.model import Illust, User, UserPreview
+from nonebot_plugin_pixivbot.utils.errors import ResourceGoneError
 from nonebot_plugin_pixivbot.utils.shared_agen import SharedAsyncGeneratorManager
 from .base import PixivRepo
 from .enums import PixivResType, CacheStrategy
@@ -18,11 +21,51 @@ from .local_repo import LocalPixivRepo
 from .mediator import SingleMediator, AppendMediator, ManyMediator
 from .models import PixivRepoMetadata
 from .remote_repo import RemotePixivRepo
+from .write_behind import WriteBehindQueue
 from ...utils.format import format_kwargs
 
 conf = context.require(Config)
 local = context.require(LocalPixivRepo)
 remote = context.require(RemotePixivRepo)
+write_behind = context.require(WriteBehindQueue) if conf.pixiv_cache_write_behind else None
+
+
+# 原图超过pixiv_download_original_max_bytes而改为下载large时，在负缓存中记录（原因为当时的上限），
+# 在过期之前直接读取与下载large，不再每次都尝试下载原图
+def _original_too_large_res_type(page: int) -> str:
+    return f"original_too_large_{page}"
+
+
+async def _image_quantity(kwargs) -> DownloadQuantity:
+    quantity = kwargs["quantity"]
+    max_bytes = conf.pixiv_download_original_max_bytes
+    if quantity == DownloadQuantity.original and max_bytes > 0:
+        reason = await local.negative_result(_original_too_large_res_type(kwargs["page"]), kwargs["illust"].id)
+        # 上限调大后重新尝试下载原图
+        if reason is not None and max_bytes <= int(reason):
+            return DownloadQuantity.large
+    return quantity
+
+
+async def _local_image(kwargs) -> AsyncGenerator[Union[bytes, PixivRepoMetadata], None]:
+    quantity = await _image_quantity(kwargs)
+    async for x in local.image(kwargs["illust"], kwargs["page"], quantity):
+        yield x
+
+
+async def _remote_image(kwargs) -> AsyncGenerator[Union[bytes, PixivRepoMetadata], None]:
+    quantity = await _image_quantity(kwargs)
+    async for x in remote.image(kwargs["illust"], kwargs["page"], quantity):
+        yield x
+
+
+async def _update_image(kwargs, data: bytes, meta: PixivRepoMetadata):
+    # 按实际下载的质量缓存，而不是缓存为原图
+    quantity = meta.quantity or kwargs["quantity"]
+    await local.update_image(kwargs["illust"].id, kwargs["page"], data, meta, quantity)
+    if quantity != kwargs["quantity"]:
+        await local.update_negative_result(_original_too_large_res_type(kwargs["page"]), kwargs["illust"].id,
+                                           str(conf.pixiv_download_original_max_bytes))
 
 
 class SharedAgenIdentifier(BaseModel):
@@ -43,18 +86,42 @@ class SharedAgenIdentifier(BaseModel):
 class PixivSharedAsyncGeneratorManager(SharedAsyncGeneratorManager[SharedAgenIdentifier, Any]):
     log_tag = "pixiv_shared_agen"
 
+    def __init__(self):
+        super().__init__(max_bytes=conf.pixiv_shared_agen_max_bytes or None,
+                         group_budgets={PixivResType[k.upper()]: v
+                                        for k, v in conf.pixiv_shared_agen_max_bytes_by_type.items()})
+        self._revalidating: Dict[SharedAgenIdentifier, asyncio.Task] = {}
+        # 正在运行的agen在get()时传入的额外参数（如image的illust），后台刷新时需要原样传入
+        self._running_kwargs: Dict[SharedAgenIdentifier, Dict[str, Any]] = {}
+        # 查询失败的原因，在过期之前相同的查询直接失败，不再读取缓存或向远程查询
+        self._negative = TTLCache[SharedAgenIdentifier, str](maxsize=4096,
+                                                              ttl=conf.pixiv_negative_cache_expires_in)
+
+    def group_of(self, identifier: SharedAgenIdentifier) -> PixivResType:
+        return identifier.type
+
     mediators = {
         "illust_detail": SingleMediator(
             "illust_detail",
             cache_factory=lambda kwargs: local.illust_detail(kwargs["illust_id"]),
             remote_factory=lambda kwargs: remote.illust_detail(**kwargs),
-            cache_updater=lambda kwargs, data, meta: local.update_illust_detail(data, meta)
+            cache_updater=lambda kwargs, data, meta: local.update_illust_detail(data, meta),
+            write_behind=write_behind,
+            stale_grace=conf.pixiv_cache_stale_grace.get("illust_detail", 0),
+            negative_loader=lambda kwargs: local.negative_result("illust_detail", kwargs["illust_id"]),
+            negative_updater=lambda kwargs, reason: local.update_negative_result("illust_detail",
+                                                                                  kwargs["illust_id"], reason),
         ),
         "user_detail": SingleMediator(
             "user_detail",
             cache_factory=lambda kwargs: local.user_detail(kwargs["user_id"]),
             remote_factory=lambda kwargs: remote.user_detail(**kwargs),
-            cache_updater=lambda kwargs, data, meta: local.update_user_detail(data, meta)
+            cache_updater=lambda kwargs, data, meta: local.update_user_detail(data, meta),
+            write_behind=write_behind,
+            stale_grace=conf.pixiv_cache_stale_grace.get("user_detail", 0),
+            negative_loader=lambda kwargs: local.negative_result("user_detail", kwargs["user_id"]),
+            negative_updater=lambda kwargs, reason: local.update_negative_result("user_detail",
+                                                                                kwargs["user_id"], reason),
         ),
         "search_illust": AppendMediator(
             "search_illust",
@@ -63,6 +130,7 @@ class PixivSharedAsyncGeneratorManager(SharedAsyncGeneratorManager[SharedAgenIde
             cache_invalidator=lambda kwargs: local.invalidate_search_illust(kwargs["word"]),
             cache_appender=lambda kwargs, data, meta: local.append_search_illust(kwargs["word"], data, meta),
             front_cache_appender=lambda kwargs, data, meta: local.append_search_illust(kwargs["word"], data, meta),
+            write_behind=write_behind,
         ),
         "search_user": AppendMediator(
             "search_user",
@@ -71,6 +139,7 @@ class PixivSharedAsyncGeneratorManager(SharedAsyncGeneratorManager[SharedAgenIde
             cache_invalidator=lambda kwargs: local.invalidate_search_user(kwargs["word"]),
             cache_appender=lambda kwargs, data, meta: local.append_search_user(kwargs["word"], data, meta),
             front_cache_appender=lambda kwargs, data, meta: local.append_search_user(kwargs["word"], data, meta),
+            write_behind=write_behind,
         ),
         "user_illusts": AppendMediator(
             "user_illusts",
@@ -80,6 +149,7 @@ class PixivSharedAsyncGeneratorManager(SharedAsyncGeneratorManager[SharedAgenIde
             cache_appender=lambda kwargs, data, meta: local.append_user_illusts(kwargs["user_id"], data, meta),
             front_cache_appender=lambda kwargs, data, meta: local.append_user_illusts(kwargs["user_id"], data, meta,
                                                                                       append_at_begin=True),
+            write_behind=write_behind,
         ),
         "user_bookmarks": AppendMediator(
             "user_bookmarks",
@@ -89,6 +159,7 @@ class PixivSharedAsyncGeneratorManager(SharedAsyncGeneratorManager[SharedAgenIde
             cache_appender=lambda kwargs, data, meta: local.append_user_bookmarks(kwargs["user_id"], data, meta),
             front_cache_appender=lambda kwargs, data, meta: local.append_user_bookmarks(kwargs["user_id"], data, meta,
                                                                                         append_at_begin=True),
+            write_behind=write_behind,
         ),
         "recommended_illusts": ManyMediator(
             "recommended_illusts",
@@ -96,6 +167,8 @@ class PixivSharedAsyncGeneratorManager(SharedAsyncGeneratorManager[SharedAgenIde
             remote_factory=lambda kwargs: remote.recommended_illusts(**kwargs),
             cache_invalidator=lambda kwargs: local.invalidate_recommended_illusts(),
             cache_appender=lambda kwargs, data, meta: local.append_recommended_illusts(data, meta),
+            write_behind=write_behind,
+            stale_grace=conf.pixiv_cache_stale_grace.get("recommended_illusts", 0),
         ),
         "related_illusts": ManyMediator(
             "related_illusts",
@@ -103,6 +176,8 @@ class PixivSharedAsyncGeneratorManager(SharedAsyncGeneratorManager[SharedAgenIde
             remote_factory=lambda kwargs: remote.related_illusts(**kwargs),
             cache_invalidator=lambda kwargs: local.invalidate_related_illusts(kwargs["illust_id"]),
             cache_appender=lambda kwargs, data, meta: local.append_related_illusts(kwargs["illust_id"], data, meta),
+            write_behind=write_behind,
+            stale_grace=conf.pixiv_cache_stale_grace.get("related_illusts", 0),
         ),
         "illust_ranking": ManyMediator(
             "illust_ranking",
@@ -110,12 +185,16 @@ class PixivSharedAsyncGeneratorManager(SharedAsyncGeneratorManager[SharedAgenIde
             remote_factory=lambda kwargs: remote.illust_ranking(**kwargs),
             cache_invalidator=lambda kwargs: local.invalidate_illust_ranking(kwargs["mode"]),
             cache_appender=lambda kwargs, data, meta: local.append_illust_ranking(kwargs["mode"], data, meta),
+            write_behind=write_behind,
+            stale_grace=conf.pixiv_cache_stale_grace.get("illust_ranking", 0),
         ),
         "image": SingleMediator(
             "image",
-            cache_factory=lambda kwargs: local.image(kwargs["illust"], kwargs["page"]),
-            remote_factory=lambda kwargs: remote.image(**kwargs),
-            cache_updater=lambda kwargs, data, meta: local.update_image(kwargs["illust"].id, kwargs["page"], data, meta)
+            cache_factory=_local_image,
+            remote_factory=_remote_image,
+            cache_updater=_update_image,
+            write_behind=write_behind,
+            stale_grace=conf.pixiv_cache_stale_grace.get("image", 0),
         ),
     }
 
@@ -193,10 +272,10 @@ class PixivSharedAsyncGeneratorManager(SharedAsyncGeneratorManager[SharedAgenIde
             force_expiration=cache_strategy == CacheStrategy.FORCE_EXPIRATION,
         )
 
-    def image_factory(self, illust_id: int, illust: Illust, page: int,
+    def image_factory(self, illust_id: int, illust: Illust, page: int, quantity: DownloadQuantity,
                       cache_strategy: CacheStrategy) -> AsyncGenerator[bytes, None]:
         return self.mediators["image"].mediate(
-            query_kwargs={"illust": illust, "page": page},
+            query_kwargs={"illust": illust, "page": page, "quantity": quantity},
             force_expiration=cache_strategy == CacheStrategy.FORCE_EXPIRATION,
         )
 
@@ -216,12 +295,31 @@ class PixivSharedAsyncGeneratorManager(SharedAsyncGeneratorManager[SharedAgenIde
     def agen(self, identifier: SharedAgenIdentifier,
              cache_strategy: CacheStrategy, **kwargs) -> AsyncGenerator[Any, None]:
         if identifier.type in self.factories:
+            if cache_strategy == CacheStrategy.FORCE_EXPIRATION:
+                self._negative.pop(identifier, None)
+            elif identifier in self._negative:
+                return self._negative_agen(identifier, self._negative[identifier])
+
             merged_kwargs = identifier.kwargs | kwargs
             # noinspection PyTypeChecker
-            return self.factories[identifier.type](self, cache_strategy=cache_strategy, **merged_kwargs)
+            gen = self.factories[identifier.type](self, cache_strategy=cache_strategy, **merged_kwargs)
+            if len(kwargs) != 0 and cache_strategy != CacheStrategy.FORCE_EXPIRATION:
+                gen = self._remember_kwargs(identifier, kwargs, gen)
+            return gen
         else:
             raise ValueError("invalid identifier: " + str(identifier))
 
+    async def _remember_kwargs(self, identifier: SharedAgenIdentifier, kwargs: Dict[str, Any],
+                               gen: AsyncGenerator[Any, None]) -> AsyncGenerator[Any, None]:
+        self._running_kwargs[identifier] = kwargs
+        try:
+            async for x in gen:
+                yield x
+        finally:
+            await gen.aclose()
+            if self._running_kwargs.get(identifier) is kwargs:
+                del self._running_kwargs[identifier]
+
     expires_in = {
         PixivResType.ILLUST_DETAIL: timedelta(seconds=context.require(Config).pixiv_illust_detail_cache_expires_in),
         PixivResType.USER_DETAIL: timedelta(seconds=context.require(Config).pixiv_user_detail_cache_expires_in),
@@ -247,6 +345,54 @@ class PixivSharedAsyncGeneratorManager(SharedAsyncGeneratorManager[SharedAgenIde
             expires_time = self.calc_expires_time(identifier, item.update_time)
             await self.set_expires_time(identifier, expires_time.timestamp())
 
+            # 使用了宽限期内的过期缓存，在后台刷新
+            if item.stale:
+                self.revalidate(identifier)
+
+    negative_types = {PixivResType.ILLUST_DETAIL, PixivResType.USER_DETAIL}
+
+    async def _negative_agen(self, identifier: SharedAgenIdentifier, reason: str) -> AsyncGenerator[Any, None]:
+        logger.debug(f"[{self.log_tag}] {identifier} failed recently: {reason}")
+        raise ResourceGoneError(reason)
+        yield
+
+    async def on_agen_error(self, identifier: SharedAgenIdentifier, e: Exception):
+        await super().on_agen_error(identifier, e)
+        if identifier.type in self.negative_types and isinstance(e, ResourceGoneError) \
+                and identifier not in self._negative:
+            self._negative[identifier] = str(e)
+
+    async def invalidate_all(self):
+        await super().invalidate_all()
+        self._negative.clear()
+
+    def revalidate(self, identifier: SharedAgenIdentifier):
+        """
+        在后台从远程重新获取并写入缓存，同一个identifier同时只有一次刷新
+        """
+        if identifier in self._revalidating:
+            return
+
+        kwargs = self._running_kwargs.get(identifier, {})
+
+        async def revalidate():
+            try:
+                # 不经过shared_agen，刷新期间相同的查询仍然读取过期的缓存，而不是等待刷新完成
+                agen = self.agen(identifier, CacheStrategy.FORCE_EXPIRATION, **kwargs)
+                try:
+                    async for _ in agen:
+                        pass
+                finally:
+                    await agen.aclose()
+                logger.info(f"[{self.log_tag}] {identifier} was revalidated")
+            except Exception as e:
+                logger.opt(exception=e).warning(f"[{self.log_tag}] failed to revalidate {identifier}")
+            finally:
+                del self._revalidating[identifier]
+
+        logger.info(f"[{self.log_tag}] {identifier} is stale, revalidating in background")
+        self._revalidating[identifier] = asyncio.create_task(revalidate())
+
 
 @context.root.register_singleton()
 class MediatorPixivRepo(PixivRepo):
@@ -414,10 +560,12 @@ class MediatorPixivRepo(PixivRepo):
                     yield x
 
     async def image(self, illust: Illust, page: int = 0,
+                    quantity: DownloadQuantity = DownloadQuantity.original,
                     cache_strategy: CacheStrategy = CacheStrategy.NORMAL) -> AsyncGenerator[bytes, None]:
-        logger.debug(f"[mediator] image {illust.id}[{page}] "
+        logger.debug(f"[mediator] image {illust.id}[{page}] {quantity.value} "
                      f"cache_strategy={cache_strategy.name}")
-        async with self.shared_agen_mgr.get(SharedAgenIdentifier(PixivResType.IMAGE, illust_id=illust.id, page=page),
+        async with self.shared_agen_mgr.get(SharedAgenIdentifier(PixivResType.IMAGE, illust_id=illust.id, page=page,
+                                                                 quantity=quantity),
                                             cache_strategy, illust=illust) as gen:
             data = None
             async for x in gen:
@@ -1,7 +1,9 @@
 from datetime import datetime, timezone, timedelta
 from typing import Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
+
+from nonebot_plugin_pixivbot.enums import DownloadQuantity
 
 
 class PixivRepoMetadata(BaseModel):
@@ -9,11 +11,39 @@ class PixivRepoMetadata(BaseModel):
     pages: Optional[int] = None
     next_qs: Optional[dict] = None
 
+    _stale: bool = PrivateAttr(default=False)
+    _quantity: Optional[DownloadQuantity] = PrivateAttr(default=None)
+
+    @property
+    def stale(self) -> bool:
+        """
+        缓存已过期，但仍在允许使用的宽限期内（见query_mode.use_stale_grace）
+        """
+        return self._stale
+
+    @property
+    def quantity(self) -> Optional[DownloadQuantity]:
+        """
+        实际下载的图片质量（原图过大时改为下载large），只在从远程下载图片时设置
+        """
+        return self._quantity
+
     def check_is_expired(self, expires_in: int) -> "PixivRepoMetadata":
-        if datetime.now(timezone.utc) - self.update_time >= timedelta(seconds=expires_in):
-            from .errors import CacheExpiredError
-            raise CacheExpiredError(self)
+        age = datetime.now(timezone.utc) - self.update_time
+        if age >= timedelta(seconds=expires_in):
+            from .query_mode import get_stale_grace
+            if age >= timedelta(seconds=expires_in + get_stale_grace()):
+                from .errors import CacheExpiredError
+                raise CacheExpiredError(self)
+            self._stale = True
         return self
 
 
-__all__ = ("PixivRepoMetadata",)
+class NegativeResult(BaseModel):
+    """
+    查询失败的结果（已删除、不可见或不存在），在一段时间内不再重复查询
+    """
+    reason: str
+
+
+__all__ = ("PixivRepoMetadata", "NegativeResult")
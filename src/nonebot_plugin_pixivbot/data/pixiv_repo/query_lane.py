@@ -0,0 +1,30 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from .enums import QueryLane
+
+_current_query_lane: ContextVar[QueryLane] = ContextVar("pixivbot_query_lane", default=QueryLane.INTERACTIVE)
+
+
+def get_query_lane() -> QueryLane:
+    return _current_query_lane.get()
+
+
+@contextmanager
+def use_query_lane(lane: Optional[QueryLane]):
+    """
+    在上下文内以指定通道向Pixiv发起查询（为None时沿用外层的通道）
+    """
+    if lane is None:
+        yield
+        return
+
+    token = _current_query_lane.set(lane)
+    try:
+        yield
+    finally:
+        _current_query_lane.reset(token)
+
+
+__all__ = ("get_query_lane", "use_query_lane")
@@ -0,0 +1,41 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_light_query: ContextVar[bool] = ContextVar("pixivbot_light_query", default=False)
+_stale_grace: ContextVar[int] = ContextVar("pixivbot_stale_grace", default=0)
+
+
+def is_light_query() -> bool:
+    return _light_query.get()
+
+
+@contextmanager
+def use_light_query():
+    """
+    在上下文内从本地缓存读取插画列表时，只读取插画的投影（LazyIllust.light），完整的插画在调用get()时再加载
+    仅对支持的本地缓存生效；与其他查询共享同一个列表时，以首先开始读取的查询为准
+    """
+    token = _light_query.set(True)
+    try:
+        yield
+    finally:
+        _light_query.reset(token)
+
+
+def get_stale_grace() -> int:
+    return _stale_grace.get()
+
+
+@contextmanager
+def use_stale_grace(grace: int):
+    """
+    在上下文内从本地缓存读取时，过期不超过grace秒的缓存视为仍然可用（元数据的stale为True）
+    """
+    token = _stale_grace.set(grace)
+    try:
+        yield
+    finally:
+        _stale_grace.reset(token)
+
+
+__all__ = ("is_light_query", "use_light_query", "get_stale_grace", "use_stale_grace")
@@ -1,8 +1,7 @@
 import asyncio
 from asyncio import sleep, create_task, CancelledError, Semaphore, Task
 from contextlib import asynccontextmanager
-from datetime import datetime, timedelta
-from io import BytesIO
+from time import monotonic
 from typing import TypeVar, Optional, Awaitable, List, Callable, Tuple, AsyncGenerator, Union
 
 import aiohttp
@@ -12,33 +11,53 @@ from pixivpy_async import *
 from pixivpy_async.error import TokenError
 
 from nonebot_plugin_pixivbot.config import Config
-from nonebot_plugin_pixivbot.enums import RankingMode
+from nonebot_plugin_pixivbot.enums import RankingMode, DownloadQuantity
 from nonebot_plugin_pixivbot.global_context import context
 from nonebot_plugin_pixivbot.model import Illust, User, UserPreview
-from nonebot_plugin_pixivbot.utils.errors import QueryError, RateLimitError
+from nonebot_plugin_pixivbot.utils.errors import QueryError, RateLimitError, ResourceGoneError
+from nonebot_plugin_pixivbot.utils.lane_semaphore import LaneSemaphore
 from nonebot_plugin_pixivbot.utils.lifecycler import on_startup, on_shutdown
+from nonebot_plugin_pixivbot.utils.rate_limiter import AIMDTokenBucket
 from .base import PixivRepo
 from .compressor import Compressor
+from .enums import QueryLane
 from .lazy_illust import LazyIllust
 from .models import PixivRepoMetadata
+from .query_lane import get_query_lane
 
 _conf = context.require(Config)
 _compressor = context.require(Compressor)
 
 T = TypeVar("T")
 
+_DOWNLOAD_REFERER = "https://app-api.pixiv.net/"
+_DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# 下载遇到网络错误或超时时的重试次数与间隔（单位：秒，每次重试递增）
+_DOWNLOAD_RETRIES = 3
+_DOWNLOAD_RETRY_COOLDOWN = 1.0
+
+# 资源不存在时的错误信息（请求时Accept-Language为zh-CN）
+_GONE_MESSAGE_PATTERNS = ("不存在", "已被删除", "已删除", "非公开", "退会", "停止账号", "好P友")
+
+
+class _ImageTooLargeError(QueryError):
+    def __init__(self, size: int):
+        super().__init__(f"图片过大（超过{size}字节）")
+        self.size = size
+
 
 @context.register_eager_singleton()
 class RemotePixivRepo(PixivRepo):
 
     # noinspection PyTypeChecker
     def __init__(self):
-        self._sema: Semaphore = None
+        self._sema: LaneSemaphore[QueryLane] = None
         self._pclient: PixivClient = None
         self._papi: AppPixivAPI = None
         self._refresh_daemon: Task = None
-
-        self._got_rate_limit: Optional[datetime] = None
+        self._rate_limiter = AIMDTokenBucket(max_rate=_conf.pixiv_query_max_rate,
+                                             min_rate=_conf.pixiv_query_min_rate,
+                                             burst=_conf.pixiv_query_burst)
 
         self.user_id = 0
 
@@ -104,43 +123,70 @@ class RemotePixivRepo(PixivRepo):
         self._papi = AppPixivAPI(client=self._pclient.start())
         self._papi.set_additional_headers({'Accept-Language': 'zh-CN'})
         self._refresh_daemon = create_task(self._refresh_daemon_worker())
-        self._sema = Semaphore(_conf.pixiv_simultaneous_query)
+        self._sema = LaneSemaphore(
+            _conf.pixiv_simultaneous_query,
+            weights={
+                QueryLane.INTERACTIVE: _conf.pixiv_query_interactive_weight,
+                QueryLane.SUBSCRIPTION: _conf.pixiv_query_subscription_weight,
+                QueryLane.WATCH: _conf.pixiv_query_watch_weight,
+            },
+            reserved={
+                QueryLane.INTERACTIVE: min(_conf.pixiv_query_interactive_reserved,
+                                           _conf.pixiv_simultaneous_query - 1),
+            }
+        )
 
     async def shutdown(self):
         await self._pclient.close()
         self._refresh_daemon.cancel()
 
-    def _check_error_in_raw_result(self, raw_result: dict):
+    @property
+    def rate_limiter(self) -> AIMDTokenBucket:
+        """查询限流器，可通过其rate与queue_depth属性观察当前的查询速率与排队请求数"""
+        return self._rate_limiter
+
+    @staticmethod
+    def _check_error_in_raw_result(raw_result: dict):
         if "error" in raw_result:
             message = raw_result["error"]["user_message"] \
                       or raw_result["error"]["message"] \
                       or raw_result["error"]["reason"]
             if message == "Rate Limit":
-                # 处理RateLimit
-                self._got_rate_limit = datetime.utcnow()
                 raise RateLimitError()
+            elif any(p in message for p in _GONE_MESSAGE_PATTERNS):
+                raise ResourceGoneError(message)
             else:
                 raise QueryError(message)
 
     @asynccontextmanager
-    async def _query(self):
-        # RateLimit期间不进行查询
-        if self._got_rate_limit is not None:
-            now = datetime.utcnow()
-            if now - self._got_rate_limit >= timedelta(minutes=2):
-                self._got_rate_limit = None
-            else:
-                raise RateLimitError()
+    async def _query(self, timeout: Optional[float] = None):
+        # 先按通道优先级获得并发名额，再在限流器中排队，直到获得令牌或超过timeout
+        if timeout is None:
+            timeout = _conf.pixiv_query_queue_timeout
 
-        async with self._sema:
+        async with self._sema.use(get_query_lane()):
+            await self._rate_limiter.acquire(timeout)
             yield
 
+    async def _call_api(self, papi_func: Callable[..., Awaitable[dict]], *args, **kwargs) -> dict:
+        deadline = monotonic() + _conf.pixiv_query_queue_timeout
+
+        while True:
+            async with self._query(max(0.0, deadline - monotonic())):
+                raw_result = await papi_func(*args, **kwargs)
+            try:
+                self._check_error_in_raw_result(raw_result)
+                self._rate_limiter.on_success()
+                return raw_result
+            except RateLimitError:
+                # 减速后重新排队，直到超过deadline
+                self._rate_limiter.on_rate_limited()
+                if monotonic() >= deadline:
+                    raise
+
     async def _load_raw_page(self, papi_search_func: Callable[..., Awaitable[dict]],
                              **kwargs):
-        async with self._query():
-            raw_result = await papi_search_func(**kwargs)
-            self._check_error_in_raw_result(raw_result)
-            return raw_result
+        return await self._call_api(papi_search_func, **kwargs)
 
     @staticmethod
     @rr_cache()  # 因为size足够就不会发生替换，所以缓存用random replacement算法最快
@@ -205,7 +251,36 @@ class RemotePixivRepo(PixivRepo):
         :param kwargs: 传给papi_search_func的参数
         :return: 加载结果
         """
-        loaded_items = 0
+        if _conf.pixiv_query_prefetch_pages <= 0:
+            pages = self._load_many_pages_sequentially(papi_search_func, element_list_name,
+                                                       mapper=mapper, filter_item=filter_item, **kwargs)
+        else:
+            pages = self._load_many_pages_with_prefetch(papi_search_func, element_list_name,
+                                                        _conf.pixiv_query_prefetch_pages,
+                                                        mapper=mapper, filter_item=filter_item, **kwargs)
+
+        loaded_pages = 0
+        try:
+            async for page, metadata in pages:
+                loaded_pages = loaded_pages + 1
+                metadata.pages = loaded_pages
+                yield page, metadata
+        finally:
+            await pages.aclose()
+
+    @staticmethod
+    def _prepare_next_qs(metadata: PixivRepoMetadata) -> Optional[dict]:
+        next_qs = metadata.next_qs
+        if next_qs and 'viewed' in next_qs:
+            # 由于pixivpy-async的illust_recommended的bug，需要删掉这个参数
+            del next_qs['viewed']
+        return next_qs
+
+    async def _load_many_pages_sequentially(self, papi_search_func: Callable[..., Awaitable[dict]],
+                                            element_list_name: str,
+                                            *, mapper: Optional[Callable[[dict], T]] = None,
+                                            filter_item: Optional[Callable[[T], bool]] = None,
+                                            **kwargs) -> AsyncGenerator[Tuple[List[T], PixivRepoMetadata], None]:
         loaded_pages = 0
         next_qs = kwargs
 
@@ -213,21 +288,71 @@ class RemotePixivRepo(PixivRepo):
             logger.info(f"[remote] loading page {loaded_pages}")
             page, metadata = await self._load_page(papi_search_func, element_list_name, mapper=mapper,
                                                    filter_item=filter_item, **next_qs)
+            loaded_pages += 1
 
-            loaded_pages = loaded_pages + 1
-            loaded_items += len(page)
-
-            metadata.pages = loaded_pages
             yield page, metadata
 
-            next_qs = metadata.next_qs
-            if next_qs:
-                if 'viewed' in next_qs:
-                    # 由于pixivpy-async的illust_recommended的bug，需要删掉这个参数
-                    del next_qs['viewed']
-            else:
+            # 第一页总是加载（kwargs可能为空，如recommended_illusts）
+            next_qs = self._prepare_next_qs(metadata)
+            if not next_qs:
                 break
 
+    async def _load_many_pages_with_prefetch(self, papi_search_func: Callable[..., Awaitable[dict]],
+                                             element_list_name: str,
+                                             prefetch_pages: int,
+                                             *, mapper: Optional[Callable[[dict], T]] = None,
+                                             filter_item: Optional[Callable[[T], bool]] = None,
+                                             **kwargs) -> AsyncGenerator[Tuple[List[T], PixivRepoMetadata], None]:
+        """
+        预读模式：消费者处理第N页时，后台最多再加载prefetch_pages页
+        每页仍通过_load_page加载，因此同样受并发数与RateLimit的限制
+        """
+        # 生产者每加载一页消耗一个额度，消费者每处理完一页归还一个额度
+        credits = Semaphore(prefetch_pages + 1)
+        queue = asyncio.Queue()
+        end = object()
+
+        async def producer():
+            loaded_pages = 0
+            next_qs = kwargs
+            try:
+                while True:
+                    await credits.acquire()
+                    logger.info(f"[remote] loading page {loaded_pages}")
+                    page, metadata = await self._load_page(papi_search_func, element_list_name, mapper=mapper,
+                                                           filter_item=filter_item, **next_qs)
+                    loaded_pages += 1
+                    queue.put_nowait((page, metadata))
+                    next_qs = self._prepare_next_qs(metadata)
+                    if not next_qs:
+                        break
+                queue.put_nowait(end)
+            except CancelledError:
+                raise
+            except BaseException as e:
+                # 把异常交给消费者抛出
+                queue.put_nowait(e)
+
+        producer_task = create_task(producer())
+        try:
+            while True:
+                x = await queue.get()
+                if x is end:
+                    break
+                elif isinstance(x, BaseException):
+                    raise x
+
+                yield x
+                credits.release()
+        finally:
+            # 消费者提前结束（达到max_item或max_page）时取消预读
+            if not producer_task.done():
+                producer_task.cancel()
+                try:
+                    await producer_task
+                except CancelledError:
+                    pass
+
     async def _get_illusts(self, papi_search_func: Callable[[], Awaitable[dict]],
                            *, min_bookmark: int = 0,
                            min_view: int = 0,
@@ -243,14 +368,15 @@ class RemotePixivRepo(PixivRepo):
         """
         total = 0
         broken = 0
+        pages = None
 
         try:
             yield PixivRepoMetadata(pages=0, next_qs=kwargs)
-            async for page, metadata in self._load_many_pages(papi_search_func, "illusts",
-                                                              mapper=lambda x: Illust.parse_obj(x),
-                                                              filter_item=self._make_illust_filter(min_view,
-                                                                                                   min_bookmark),
-                                                              **kwargs):
+            pages = self._load_many_pages(papi_search_func, "illusts",
+                                          mapper=lambda x: Illust.parse_obj(x),
+                                          filter_item=self._make_illust_filter(min_view, min_bookmark),
+                                          **kwargs)
+            async for page, metadata in pages:
                 for item in page:
                     total += 1
                     if "limit_unknown_360.png" in item.image_urls.large:
@@ -260,33 +386,41 @@ class RemotePixivRepo(PixivRepo):
                         yield LazyIllust(item.id, item)
                 yield metadata
         finally:
+            # 提前结束时立即关闭，以便取消预读
+            if pages is not None:
+                await pages.aclose()
             logger.info(f"[remote] got {total} illusts, illust_detail of {broken} are missed")
 
     async def _get_user_previews(self, papi_search_func: Callable[[], Awaitable[dict]], **kwargs) \
             -> AsyncGenerator[Union[PixivRepoMetadata, UserPreview], None]:
         yield PixivRepoMetadata(pages=0, next_qs=kwargs)
-        async for page, metadata in self._load_many_pages(papi_search_func, "user_previews",
-                                                          mapper=lambda x: UserPreview.parse_obj(x), **kwargs):
-            for item in page:
-                item: UserPreview
-                item.illusts = list(filter(self._make_illust_filter(), item.illusts))
-                yield item
-            yield metadata
+        pages = self._load_many_pages(papi_search_func, "user_previews",
+                                      mapper=lambda x: UserPreview.parse_obj(x), **kwargs)
+        try:
+            async for page, metadata in pages:
+                for item in page:
+                    item: UserPreview
+                    item.illusts = list(filter(self._make_illust_filter(), item.illusts))
+                    yield item
+                yield metadata
+        finally:
+            await pages.aclose()
 
     async def _get_users(self, papi_search_func: Callable[[], Awaitable[dict]], **kwargs) \
             -> AsyncGenerator[Union[PixivRepoMetadata, User], None]:
         yield PixivRepoMetadata(pages=0, next_qs=kwargs)
-        async for page, metadata in self._load_many_pages(papi_search_func, "user_previews",
-                                                          mapper=lambda x: User.parse_obj(x["user"]), **kwargs):
-            for item in page:
-                yield item
-            yield metadata
+        pages = self._load_many_pages(papi_search_func, "user_previews",
+                                      mapper=lambda x: User.parse_obj(x["user"]), **kwargs)
+        try:
+            async for page, metadata in pages:
+                for item in page:
+                    yield item
+                yield metadata
+        finally:
+            await pages.aclose()
 
     async def _raw_illust_detail(self, illust_id: int, **kwargs) -> dict:
-        async with self._query():
-            raw_result = await self._papi.illust_detail(illust_id, **kwargs)
-            self._check_error_in_raw_result(raw_result)
-            return raw_result
+        return await self._call_api(self._papi.illust_detail, illust_id, **kwargs)
 
     async def illust_detail(self, illust_id: int, **kwargs) -> AsyncGenerator[Illust, None]:
         logger.debug(f"[remote] illust_detail {illust_id}")
@@ -295,10 +429,7 @@ class RemotePixivRepo(PixivRepo):
         yield Illust.parse_obj(raw_result["illust"])
 
     async def _raw_user_detail(self, user_id: int, **kwargs) -> dict:
-        async with self._query():
-            raw_result = await self._papi.user_detail(user_id, **kwargs)
-            self._check_error_in_raw_result(raw_result)
-            return raw_result
+        return await self._call_api(self._papi.user_detail, user_id, **kwargs)
 
     async def user_detail(self, user_id: int, **kwargs) -> AsyncGenerator[User, None]:
         logger.debug(f"[remote] user_detail {user_id}")
@@ -390,25 +521,83 @@ class RemotePixivRepo(PixivRepo):
         return self._get_illusts(self._papi.illust_ranking,
                                  mode=mode.name, **kwargs)
 
-    async def _raw_image(self, illust: Illust, page: int, **kwargs) -> bytes:
-        custom_domain = _conf.pixiv_download_custom_domain
+    async def _download(self, url: str, max_bytes: int = 0) -> bytes:
+        """
+        分块下载，超过max_bytes或pixiv_download_max_bytes时中止
+        各块只在最后拼接一次，不经过BytesIO等中间缓冲区
+        """
+        if _conf.pixiv_download_max_bytes > 0 and (max_bytes <= 0 or _conf.pixiv_download_max_bytes < max_bytes):
+            max_bytes = _conf.pixiv_download_max_bytes
 
-        url = illust.page_image_url(page)
+        # 只重试网络错误与超时，图片过大与HTTP错误不重试
+        for i in range(_DOWNLOAD_RETRIES + 1):
+            try:
+                return await self._download_once(url, max_bytes)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if i == _DOWNLOAD_RETRIES:
+                    raise
+                logger.warning(f"[remote] failed to download {url} ({type(e).__name__}: {e}), "
+                               f"retry {i + 1}/{_DOWNLOAD_RETRIES}")
+                await sleep(_DOWNLOAD_RETRY_COOLDOWN * (i + 1))
+
+    async def _download_once(self, url: str, max_bytes: int) -> bytes:
+        async with self._pclient.client.get(url, headers={"Referer": _DOWNLOAD_REFERER}) as resp:
+            if resp.status != 200:
+                raise QueryError(f"下载图片失败（HTTP {resp.status}）")
+
+            if max_bytes > 0 and resp.content_length is not None and resp.content_length > max_bytes:
+                raise _ImageTooLargeError(max_bytes)
+
+            chunks = []
+            size = 0
+            async for chunk in resp.content.iter_chunked(_DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if 0 < max_bytes < size:
+                    raise _ImageTooLargeError(max_bytes)
+                chunks.append(chunk)
+
+        if len(chunks) == 1:
+            return chunks[0]
+        return b"".join(chunks)
+
+    @staticmethod
+    def _image_url(illust: Illust, page: int, quantity: DownloadQuantity) -> str:
+        url = illust.page_image_url(page, quantity)
+        custom_domain = _conf.pixiv_download_custom_domain
         if custom_domain is not None:
             url = url.replace("i.pximg.net", custom_domain)
+        return url
 
-        async with self._query():
-            with BytesIO() as bio:
-                await self._papi.download(url, fname=bio, **kwargs)
-                content = bio.getvalue()
-                return content
-
-    async def image(self, illust: Illust, page: int = 0, **kwargs) \
+    async def _raw_image(self, illust: Illust, page: int,
+                         quantity: DownloadQuantity = DownloadQuantity.original) \
+            -> Tuple[bytes, DownloadQuantity]:
+        """
+        :return: 图片内容与实际下载的质量
+        """
+        # 下载走i.pximg.net，不受API的RateLimit限制，只限制并发数
+        async with self._sema.use(get_query_lane()):
+            if quantity == DownloadQuantity.original and _conf.pixiv_download_original_max_bytes > 0:
+                # 原图超过指定大小时改为下载large
+                try:
+                    return await self._download(self._image_url(illust, page, quantity),
+                                                _conf.pixiv_download_original_max_bytes), quantity
+                except _ImageTooLargeError:
+                    logger.info(f"[remote] original image of {illust.id}[{page}] is too large, "
+                                f"fall back to large")
+                    quantity = DownloadQuantity.large
+
+            return await self._download(self._image_url(illust, page, quantity)), quantity
+
+    async def image(self, illust: Illust, page: int = 0,
+                    quantity: DownloadQuantity = DownloadQuantity.original) \
             -> AsyncGenerator[Union[bytes, PixivRepoMetadata], None]:
-        logger.debug(f"[remote] image {illust.id}")
-        content = await self._raw_image(illust, page, **kwargs)
+        logger.debug(f"[remote] image {illust.id}[{page}] {quantity.value}")
+        content, quantity = await self._raw_image(illust, page, quantity)
         content = await _compressor.compress(content)
-        yield PixivRepoMetadata()
+
+        metadata = PixivRepoMetadata()
+        metadata._quantity = quantity
+        yield metadata
         yield content
 
 
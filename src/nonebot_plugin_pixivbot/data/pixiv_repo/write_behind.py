@@ -0,0 +1,204 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Any, AsyncContextManager, Awaitable, Callable, Dict, Hashable, List, Literal, Optional
+
+from nonebot import logger
+
+from ..source.sql import DataSource
+from ...config import Config
+from ...global_context import context
+from ...utils.lifecycler import on_shutdown
+
+conf = context.require(Config)
+
+
+@dataclass
+class WriteOp:
+    """
+    一次缓存写入
+    update：整体覆盖，同一个键上后来的update取代之前的update
+    append：追加，同一个键上相邻的append合并为一次（内容拼接，元数据取后者）
+    invalidate：使缓存失效，同一个键上之前尚未写入的update与append不再需要写入
+    """
+    kind: Literal["update", "append", "invalidate"]
+    func: Callable[..., Awaitable[Any]]
+    content: Any = None
+    metadata: Any = None
+
+    async def __call__(self):
+        if self.kind == "invalidate":
+            await self.func()
+        else:
+            await self.func(self.content, self.metadata)
+
+
+@dataclass
+class WriteBehindStats:
+    enqueued: int = 0
+    coalesced: int = 0  # 被合并或取代而不需要单独写入的次数
+    flushed: int = 0
+    failed: int = 0
+    max_pending: int = 0
+    flush_time: float = 0.0  # 单位：秒
+
+
+@dataclass
+class _KeyState:
+    ops: List[WriteOp] = field(default_factory=list)
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+@context.register_singleton()
+class WriteBehindQueue:
+    """
+    缓存的延迟写入队列：调用方入队后立即返回，由后台任务每隔flush_interval把积累的写入依次写入缓存
+    使用SQL缓存时，同一次写入的所有操作在同一个事务内进行
+    同一个键上的写入按入队顺序进行，并尽可能合并；队列满时入队需要等待（背压）
+    读取某个键的缓存之前应调用wait_flushed，保证能读到尚未写入的数据
+    """
+
+    def __init__(self):
+        self.maxsize = max(1, conf.pixiv_cache_write_behind_queue_size)
+        self.flush_interval = conf.pixiv_cache_write_behind_flush_interval
+        self.stats = WriteBehindStats()
+
+        self._pending: OrderedDict[Hashable, _KeyState] = OrderedDict()
+        self._flushing: Dict[Hashable, _KeyState] = {}
+        self._size = 0
+        self._cond: Optional[asyncio.Condition] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+
+        on_shutdown()(self.close)
+        if conf.pixiv_local_cache_type == "sql":
+            # 必须在数据库关闭之前写入
+            context.require(DataSource).on_closing(self.flush)
+
+    @property
+    def pending(self) -> int:
+        return self._size
+
+    def _ensure_started(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+            self._flush_lock = asyncio.Lock()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def put(self, key: Hashable, op: WriteOp):
+        self._ensure_started()
+
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._size < self.maxsize)
+
+            state = self._pending.get(key)
+            if state is None:
+                state = _KeyState()
+                self._pending[key] = state
+
+            self._size -= len(state.ops)
+            self.stats.coalesced += _coalesce(state.ops, op)
+            self._size += len(state.ops)
+
+            self.stats.enqueued += 1
+            self.stats.max_pending = max(self.stats.max_pending, self._size)
+            self._cond.notify_all()
+
+    async def wait_flushed(self, key: Hashable):
+        """
+        等待该键上所有已入队的写入完成
+        """
+        for states in (self._pending, self._flushing):
+            state = states.get(key)
+            if state is not None:
+                await state.done.wait()
+
+    async def _flush_loop(self):
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self._size > 0)
+            # 等待一段时间，积累更多可以合并的写入
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """
+        立即写入所有已入队的写入
+        """
+        if self._cond is None:
+            return
+
+        async with self._flush_lock:
+            while len(self._pending) > 0:
+                async with self._cond:
+                    self._flushing, self._pending = self._pending, OrderedDict()
+
+                begin = perf_counter()
+                total = sum(len(state.ops) for state in self._flushing.values())
+                failed = 0
+                try:
+                    async with self._batch():
+                        for key, state in self._flushing.items():
+                            for op in state.ops:
+                                try:
+                                    await op()
+                                except Exception as e:
+                                    failed += 1
+                                    logger.opt(exception=e).error(f"[write_behind] failed to write {key}")
+                    self.stats.flushed += total - failed
+                    self.stats.failed += failed
+                except Exception as e:
+                    self.stats.failed += total
+                    logger.opt(exception=e).error(f"[write_behind] failed to commit {total} writes")
+                finally:
+                    # 提交之后才能读到写入的数据
+                    async with self._cond:
+                        for state in self._flushing.values():
+                            self._size -= len(state.ops)
+                            state.done.set()
+                        self._cond.notify_all()
+
+                self._flushing = {}
+                self.stats.flush_time += perf_counter() - begin
+                logger.trace(f"[write_behind] {self.stats}")
+
+    @staticmethod
+    def _batch() -> AsyncContextManager:
+        if conf.pixiv_local_cache_type == "sql":
+            return context.require(DataSource).batch_write()
+        return nullcontext()
+
+    async def close(self):
+        await self.flush()
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+
+
+def _coalesce(ops: List[WriteOp], op: WriteOp) -> int:
+    """
+    把op加入ops，返回因合并而省去的写入次数
+    """
+    if op.kind == "invalidate":
+        n = len(ops)
+        ops.clear()
+        ops.append(op)
+        return n
+
+    if len(ops) > 0 and ops[-1].kind == op.kind:
+        last = ops[-1]
+        if op.kind == "update":
+            ops[-1] = op
+            return 1
+        elif op.kind == "append":
+            ops[-1] = WriteOp("append", op.func, [*last.content, *op.content], op.metadata)
+            return 1
+
+    ops.append(op)
+    return 0
+
+
+__all__ = ("WriteOp", "WriteBehindQueue", "WriteBehindStats")
@@ -1,13 +1,16 @@
+import asyncio
 import json
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime, date
-from typing import AsyncContextManager
+from typing import AsyncContextManager, Optional, Tuple
 
 from nonebot import get_driver, logger
-from sqlalchemy import select, inspect
+from sqlalchemy import select, inspect, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine, AsyncConnection
 from sqlalchemy.orm import registry, sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import StaticPool, AsyncAdaptedQueuePool
 
 from ..lifecycle_mixin import DataSourceLifecycle
 from ...errors import DataSourceNotReadyError
@@ -29,9 +32,51 @@ def json_serializer(obj):
     return json.dumps(obj, default=default_dumps)
 
 
+class _WriterLock:
+    """
+    写入锁，同一个Task内可重入（写入会话中可能调用其他同样需要写入的仓库）
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._owner: Optional[asyncio.Task] = None
+        self._depth = 0
+
+    async def __aenter__(self):
+        task = asyncio.current_task()
+        if self._owner is not task:
+            await self._lock.acquire()
+            self._owner = task
+        self._depth += 1
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+            self._lock.release()
+
+
+def _is_sqlite_memory(url: str) -> bool:
+    database = make_url(url).database
+    return not database or database == ":memory:" or database.startswith("file::memory:")
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # 每个连接建立时设置一次
+    cursor = dbapi_connection.cursor()
+    if conf.pixiv_sql_sqlite_wal:
+        cursor.execute("PRAGMA journal_mode = WAL;")
+        cursor.execute("PRAGMA synchronous = NORMAL;")
+    cursor.execute(f"PRAGMA busy_timeout = {int(conf.pixiv_sql_sqlite_busy_timeout)};")
+    cursor.execute(f"PRAGMA mmap_size = {int(conf.pixiv_sql_sqlite_mmap_size)};")
+    cursor.execute(f"PRAGMA cache_size = {-int(conf.pixiv_sql_sqlite_cache_size)};")
+    cursor.execute("PRAGMA foreign_keys = ON;")
+    cursor.close()
+
+
 @context.register_eager_singleton()
 class DataSource(DataSourceLifecycle):
-    app_db_version = 5
+    app_db_version = 10
     registry = registry()
 
     def __init__(self):
@@ -39,6 +84,10 @@ class DataSource(DataSourceLifecycle):
 
         self._engine = None
         self._sessionmaker = None
+        self._active_sessions = 0
+        self._writer = _WriterLock()
+        # batch_write期间的(Task, 连接)
+        self._batch: ContextVar[Optional[Tuple[asyncio.Task, AsyncConnection]]] = ContextVar("batch", default=None)
 
         on_startup(replay=True)(self.initialize)
         on_shutdown()(self.close)
@@ -90,13 +139,19 @@ class DataSource(DataSourceLifecycle):
         }
 
         if conf.pixiv_sql_dialect == 'sqlite':
-            # 使用 SQLite 数据库时，如果在写入时遇到 (sqlite3.OperationalError) database is locked 错误。
-            # 可尝试将 poolclass 设置为 StaticPool，保持有且仅有一个连接。
-            # 不过这样设置之后，在程序运行期间，你的数据库文件都将被占用。
-            params['poolclass'] = StaticPool
+            if _is_sqlite_memory(conf.pixiv_sql_conn_url):
+                # 内存数据库只能有一个连接
+                params['poolclass'] = StaticPool
+            else:
+                # 多个连接并发读取（WAL模式下读取不会被写入阻塞），写入由start_session(write=True)串行化
+                params['poolclass'] = AsyncAdaptedQueuePool
+                params['pool_size'] = conf.pixiv_sql_sqlite_pool_size
+                params['max_overflow'] = conf.pixiv_sql_sqlite_pool_size
 
         logger.info("[data source] sql conn url: " + conf.pixiv_sql_conn_url)
         self._engine = create_async_engine(conf.pixiv_sql_conn_url, **params)
+        if conf.pixiv_sql_dialect == 'sqlite':
+            event.listen(self._engine.sync_engine, "connect", _set_sqlite_pragmas)
 
         async with self._engine.begin() as conn:
             from .migration import SqlMigrationManager
@@ -132,11 +187,66 @@ class DataSource(DataSourceLifecycle):
         await self._fire_closed()
 
     @asynccontextmanager
-    async def start_session(self) -> AsyncContextManager[AsyncSession]:
+    async def start_session(self, write: bool = False) -> AsyncContextManager[AsyncSession]:
+        """
+        :param write: 会话中是否有写入。使用SQLite时，写入会话在整个会话期间持有写入锁，同一时刻只有一个写入会话
+        """
         if self._engine is None:
             raise DataSourceNotReadyError()
-        async with self._sessionmaker() as session:
-            yield session
+        self._active_sessions += 1
+        try:
+            batch = self._batch.get()
+            if batch is not None and batch[0] is asyncio.current_task():
+                # 加入batch_write的事务，会话的commit与rollback只作用于各自的保存点
+                async with AsyncSession(batch[1], expire_on_commit=False,
+                                        join_transaction_mode="create_savepoint") as session:
+                    yield session
+            elif write and conf.pixiv_sql_dialect == 'sqlite':
+                async with self._writer:
+                    async with self._sessionmaker() as session:
+                        yield session
+            else:
+                async with self._sessionmaker() as session:
+                    yield session
+        finally:
+            self._active_sessions -= 1
+
+    @asynccontextmanager
+    async def batch_write(self) -> AsyncContextManager[None]:
+        """
+        在同一个事务内进行多次写入：期间当前Task打开的会话都加入该事务，退出时一次性提交
+        """
+        if self._engine is None:
+            raise DataSourceNotReadyError()
+        batch = self._batch.get()
+        if batch is not None and batch[0] is asyncio.current_task():
+            yield
+            return
+
+        async with self._writer:
+            async with self._engine.connect() as conn:
+                async with conn.begin():
+                    if conf.pixiv_sql_dialect == 'sqlite':
+                        # pysqlite直到第一条DML才开启事务，若由保存点开启事务，释放该保存点时就会提交
+                        await conn.exec_driver_sql("BEGIN")
+                    token = self._batch.set((asyncio.current_task(), conn))
+                    try:
+                        yield
+                    finally:
+                        self._batch.reset(token)
+
+    def writer_lock(self) -> AsyncContextManager:
+        """
+        在会话之外直接使用连接写入时（如VACUUM），需要持有的写入锁
+        """
+        return self._writer
+
+    @property
+    def active_sessions(self) -> int:
+        """
+        当前打开的会话数
+        """
+        return self._active_sessions
 
     @property
     def engine(self) -> AsyncEngine:
@@ -4,6 +4,11 @@ from .sql_v1_to_v2 import SqlV1ToV2
 from .sql_v2_to_v3 import SqlV2ToV3
 from .sql_v3_to_v4 import SqlV3ToV4
 from .sql_v4_to_v5 import SqlV4ToV5
+from .sql_v5_to_v6 import SqlV5ToV6
+from .sql_v6_to_v7 import SqlV6ToV7
+from .sql_v7_to_v8 import SqlV7ToV8
+from .sql_v8_to_v9 import SqlV8ToV9
+from .sql_v9_to_v10 import SqlV9ToV10
 from ...migration_manager import MigrationManager
 
 
@@ -14,3 +19,8 @@ class SqlMigrationManager(MigrationManager):
         self.add(SqlV2ToV3)
         self.add(SqlV3ToV4)
         self.add(SqlV4ToV5)
+        self.add(SqlV5ToV6)
+        self.add(SqlV6ToV7)
+        self.add(SqlV7ToV8)
+        self.add(SqlV8ToV9)
+        self.add(SqlV9ToV10)
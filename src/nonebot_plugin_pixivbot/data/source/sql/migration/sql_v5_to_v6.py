@@ -0,0 +1,13 @@
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from ...migration_manager import Migration
+
+
+class SqlV5ToV6(Migration):
+    from_db_version = 5
+    to_db_version = 6
+
+    async def migrate(self, conn: AsyncConnection):
+        # download_cache的主键增加了quantity列，直接丢弃旧缓存
+        await conn.execute(text("drop table download_cache;"))
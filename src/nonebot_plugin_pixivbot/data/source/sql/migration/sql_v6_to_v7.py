@@ -0,0 +1,38 @@
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from nonebot_plugin_pixivbot import Config
+from nonebot_plugin_pixivbot.global_context import context
+from ...migration_manager import Migration
+
+conf = context.require(Config)
+
+
+class SqlV6ToV7(Migration):
+    from_db_version = 6
+    to_db_version = 7
+
+    async def migrate(self, conn: AsyncConnection):
+        # illust_detail_cache.illust由JSON改为经codec编码的BLOB
+        # 旧数据原样转为UTF-8编码的JSON文本，codec能够识别没有标记的JSON，因此不需要重新编码
+        if conf.pixiv_sql_dialect == 'postgresql':
+            await conn.execute(text("alter table illust_detail_cache "
+                                    "alter column illust type bytea using convert_to(illust::text, 'UTF8');"))
+        else:
+            await conn.execute(text("alter table illust_detail_cache rename to illust_detail_cache_old;"))
+            await conn.execute(text("drop index if exists ix_illust_detail_cache_update_time;"))
+            await conn.execute(text("""
+                create table illust_detail_cache
+                (
+                    illust_id   INTEGER  not null
+                        primary key,
+                    illust      BLOB     not null,
+                    update_time DATETIME not null
+                );
+            """))
+            await conn.execute(text("create index ix_illust_detail_cache_update_time "
+                                    "on illust_detail_cache (update_time);"))
+            await conn.execute(text("insert into illust_detail_cache (illust_id, illust, update_time) "
+                                    "select illust_id, cast(illust as blob), update_time "
+                                    "from illust_detail_cache_old;"))
+            await conn.execute(text("drop table illust_detail_cache_old;"))
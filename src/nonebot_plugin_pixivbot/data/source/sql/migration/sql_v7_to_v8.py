@@ -0,0 +1,14 @@
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from ...migration_manager import Migration
+
+
+class SqlV7ToV8(Migration):
+    from_db_version = 7
+    to_db_version = 8
+
+    async def migrate(self, conn: AsyncConnection):
+        # 按(cache_id, rank)分页读取illust_set_cache_illust
+        await conn.execute(text("create index if not exists ix_illust_set_cache_illust_cache_id_rank "
+                                "on illust_set_cache_illust (cache_id, rank);"))
@@ -0,0 +1,53 @@
+import json
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from nonebot_plugin_pixivbot import Config
+from nonebot_plugin_pixivbot.global_context import context
+from ...migration_manager import Migration
+from ....utils.sql import hash_key
+
+conf = context.require(Config)
+
+
+class SqlV8ToV9(Migration):
+    from_db_version = 8
+    to_db_version = 9
+
+    async def migrate(self, conn: AsyncConnection):
+        # illust_set_cache与user_set_cache增加key_hash列，按(cache_type, key_hash)查找，代替对JSON列的比较
+        await self._migrate_table(conn, "illust_set_cache", "illust_set_cache_illust")
+        await self._migrate_table(conn, "user_set_cache", "user_set_cache_user")
+
+    @staticmethod
+    async def _migrate_table(conn: AsyncConnection, table: str, item_table: str):
+        await conn.execute(text(f"alter table {table} add column key_hash varchar(40);"))
+
+        # 回填key_hash；键相同而字段顺序不同的集合只保留最新的一个
+        result = await conn.execute(text(f"select id, cache_type, key from {table} order by update_time desc;"))
+
+        seen = set()
+        duplicated = []
+        for cache_id, cache_type, key in result.all():
+            if isinstance(key, str):
+                key = json.loads(key)
+
+            h = hash_key(key)
+            if (cache_type, h) in seen:
+                duplicated.append(cache_id)
+            else:
+                seen.add((cache_type, h))
+                await conn.execute(text(f"update {table} set key_hash = :h where id = :id;"),
+                                   {"h": h, "id": cache_id})
+
+        for cache_id in duplicated:
+            await conn.execute(text(f"delete from {item_table} where cache_id = :id;"), {"id": cache_id})
+            await conn.execute(text(f"delete from {table} where id = :id;"), {"id": cache_id})
+
+        if conf.pixiv_sql_dialect == 'postgresql':
+            await conn.execute(text(f"alter table {table} drop constraint if exists {table}_cache_type_key_key;"))
+            await conn.execute(text(f"alter table {table} alter column key_hash set not null;"))
+
+        await conn.execute(text(f"create unique index ix_{table}_cache_type_key_hash "
+                                f"on {table} (cache_type, key_hash);"))
@@ -0,0 +1,92 @@
+from datetime import datetime, timezone
+from hashlib import sha1
+
+from nonebot import logger
+from sqlalchemy import text, inspect
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from nonebot_plugin_pixivbot import Config
+from nonebot_plugin_pixivbot.global_context import context
+from ...migration_manager import Migration
+from ....pixiv_repo.local_repo.image_store import image_key, create_sql_image_store
+
+conf = context.require(Config)
+
+_MOVE_BATCH_SIZE = 100
+
+
+class SqlV9ToV10(Migration):
+    from_db_version = 9
+    to_db_version = 10
+
+    async def migrate(self, conn: AsyncConnection):
+        # 从v5及更早的版本升级时download_cache已在v5->v6中被删除，由create_all按新的结构重建
+        if not await conn.run_sync(lambda conn: inspect(conn).has_table("download_cache")):
+            return
+
+        # download_cache增加size与digest列，content改为可空（图片内容存放在文件中时为NULL）
+        if conf.pixiv_sql_dialect == 'postgresql':
+            await conn.execute(text("alter table download_cache alter column content drop not null;"))
+            await conn.execute(text("alter table download_cache add column size integer;"))
+            await conn.execute(text("alter table download_cache add column digest varchar(40);"))
+        else:
+            await conn.execute(text("alter table download_cache rename to download_cache_old;"))
+            await conn.execute(text("drop index if exists ix_download_cache_update_time;"))
+            await conn.execute(text("""
+                create table download_cache
+                (
+                    illust_id   INTEGER     not null,
+                    page        INTEGER     not null,
+                    quantity    VARCHAR(16) not null,
+                    content     BLOB,
+                    size        INTEGER,
+                    digest      VARCHAR(40),
+                    update_time DATETIME    not null,
+                    primary key (illust_id, page, quantity)
+                );
+            """))
+            await conn.execute(text("create index ix_download_cache_update_time "
+                                    "on download_cache (update_time);"))
+            await conn.execute(text("insert into download_cache (illust_id, page, quantity, content, update_time) "
+                                    "select illust_id, page, quantity, content, update_time "
+                                    "from download_cache_old;"))
+            await conn.execute(text("drop table download_cache_old;"))
+
+        if conf.pixiv_local_cache_type == 'sql' and conf.pixiv_sql_image_storage == 'file':
+            await self._move_to_file(conn)
+        else:
+            await conn.execute(text("update download_cache "
+                                    "set size = length(content) "
+                                    "where content is not null;"))
+
+    @staticmethod
+    async def _move_to_file(conn: AsyncConnection):
+        # 把图片内容移动到文件中，分批进行，每批最多读取_MOVE_BATCH_SIZE张图片
+        store = create_sql_image_store()
+        moved = 0
+
+        while True:
+            result = await conn.execute(text("select illust_id, page, quantity, content, update_time "
+                                             "from download_cache "
+                                             "where content is not null "
+                                             "limit :limit;"), {"limit": _MOVE_BATCH_SIZE})
+            rows = result.all()
+            if len(rows) == 0:
+                break
+
+            for illust_id, page, quantity, content, update_time in rows:
+                if isinstance(update_time, str):
+                    update_time = datetime.fromisoformat(update_time)
+                if update_time.tzinfo is None:
+                    update_time = update_time.replace(tzinfo=timezone.utc)
+
+                content = bytes(content)
+                await store.write(image_key(illust_id, page, quantity), content, update_time)
+                await conn.execute(text("update download_cache "
+                                        "set content = null, size = :size, digest = :digest "
+                                        "where illust_id = :illust_id and page = :page and quantity = :quantity;"),
+                                   {"size": len(content), "digest": sha1(content).hexdigest(),
+                                    "illust_id": illust_id, "page": page, "quantity": quantity})
+
+            moved += len(rows)
+            logger.info(f"[migration] moved {moved} images from download_cache to {store.root}")
@@ -95,7 +95,7 @@ class SubscriptionRepo(IntervalTaskRepo[Subscription]):
         item.subscriber = process_subscriber(item.subscriber)
         session_id = await nb_session_repo.get_id(item.subscriber)
 
-        async with data_source.start_session() as db_sess:
+        async with data_source.start_session(write=True) as db_sess:
             stmt = (insert(SubscriptionOrm)
                     .values(session_id=session_id,
                             code=item.code,
@@ -111,7 +111,7 @@ class SubscriptionRepo(IntervalTaskRepo[Subscription]):
     async def delete_one(self, session: Session, code: str) -> Optional[Subscription]:
         session = process_subscriber(session)
         session_id = await nb_session_repo.get_id(session)
-        async with data_source.start_session() as db_sess:
+        async with data_source.start_session(write=True) as db_sess:
             stmt = (select(SubscriptionOrm)
                     .where(SubscriptionOrm.bot_id == session.bot_id,
                            SubscriptionOrm.session_id == session_id,
@@ -129,7 +129,7 @@ class SubscriptionRepo(IntervalTaskRepo[Subscription]):
     async def delete_many_by_session(self, session: Session) -> Collection[Subscription]:
         session = process_subscriber(session)
         session_id = await nb_session_repo.get_id(session)
-        async with data_source.start_session() as db_sess:
+        async with data_source.start_session(write=True) as db_sess:
             stmt = (select(SubscriptionOrm)
                     .where(SubscriptionOrm.bot_id == session.bot_id,
                            SubscriptionOrm.session_id == session_id))
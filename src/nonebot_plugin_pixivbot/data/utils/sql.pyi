@@ -14,4 +14,8 @@ JSON = StandardJSON
 BLOB = Union[StandardBLOB, PostgresqlBYTEA]
 UTCDateTime = StandardDateTime
 
-__all__ = ("insert", "JSON", "BLOB", "UTCDateTime")
+
+def hash_key(key: dict) -> str: ...
+
+
+__all__ = ("insert", "JSON", "BLOB", "UTCDateTime", "hash_key")
@@ -17,6 +17,7 @@ insert = _insert
 JSON = _JSON
 BLOB = _BLOB
 
+from .key_hash import hash_key
 from .utc_datetime import UTCDateTime
 
-__all__ = ("insert", "JSON", "BLOB", "UTCDateTime")
+__all__ = ("insert", "JSON", "BLOB", "UTCDateTime", "hash_key")
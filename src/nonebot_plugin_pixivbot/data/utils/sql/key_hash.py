@@ -0,0 +1,10 @@
+import json
+from hashlib import sha1
+
+
+def hash_key(key: dict) -> str:
+    """
+    集合缓存的键的摘要：对键按字段名排序后序列化为JSON再取SHA1，与字段顺序无关
+    """
+    s = json.dumps(key, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return sha1(s.encode("utf-8")).hexdigest()
@@ -89,7 +89,7 @@ class WatchTaskRepo(IntervalTaskRepo[WatchTask]):
         item.subscriber = process_subscriber(item.subscriber)
         session_id = await nb_session_repo.get_id(item.subscriber)
 
-        async with data_source.start_session() as db_session:
+        async with data_source.start_session(write=True) as db_session:
             stmt = (insert(WatchTaskOrm)
                     .values(session_id=session_id,
                             code=item.code,
@@ -106,7 +106,7 @@ class WatchTaskRepo(IntervalTaskRepo[WatchTask]):
     async def update(self, item: WatchTask) -> bool:
         item.subscriber = process_subscriber(item.subscriber)
         session_id = await nb_session_repo.get_id(item.subscriber)
-        async with data_source.start_session() as db_session:
+        async with data_source.start_session(write=True) as db_session:
             stmt = (update(WatchTaskOrm)
                     .values(type=item.type,
                             kwargs=item.kwargs,
@@ -121,7 +121,7 @@ class WatchTaskRepo(IntervalTaskRepo[WatchTask]):
     async def delete_one(self, session: Session, code: str) -> Optional[WatchTask]:
         session = process_subscriber(session)
         session_id = await nb_session_repo.get_id(session)
-        async with data_source.start_session() as db_sess:
+        async with data_source.start_session(write=True) as db_sess:
             stmt = (select(WatchTaskOrm)
                     .where(WatchTaskOrm.bot_id == session.bot_id,
                            WatchTaskOrm.session_id == session_id,
@@ -139,7 +139,7 @@ class WatchTaskRepo(IntervalTaskRepo[WatchTask]):
     async def delete_many_by_session(self, session: Session) -> Collection[WatchTask]:
         session = process_subscriber(session)
         session_id = await nb_session_repo.get_id(session)
-        async with data_source.start_session() as db_sess:
+        async with data_source.start_session(write=True) as db_sess:
             stmt = (select(WatchTaskOrm)
                     .where(WatchTaskOrm.bot_id == session.bot_id,
                            WatchTaskOrm.session_id == session_id))
@@ -13,6 +13,9 @@ from .interceptor.default_error_interceptor import DefaultErrorInterceptor
 from .interceptor.service_interceptor import ServiceInterceptor
 from .pkg_context import context
 from ..config import Config
+from ..data.pixiv_repo.enums import QueryLane
+from ..data.pixiv_repo.query_lane import use_query_lane
+from ..enums import DownloadQuantity
 from ..model import Illust
 from ..model.message import IllustMessagesModel
 from ..plugin_service import r18_service, r18g_service
@@ -98,6 +101,11 @@ class Handler(ABC, metaclass=HandlerMeta):
     def enabled(cls) -> bool:
         return True
 
+    @property
+    def query_lane(self) -> Optional[QueryLane]:
+        # 非静默（用户主动触发）的查询走交互通道，静默的查询沿用调用方（Scheduler/Watchman）设置的通道
+        return None if self.silently else QueryLane.INTERACTIVE
+
     async def parse_args(self, args: Sequence[str]) -> dict:
         """
         将位置参数转化为命名参数
@@ -107,16 +115,18 @@ class Handler(ABC, metaclass=HandlerMeta):
         return {}
 
     async def handle(self, *args, **kwargs):
-        if not self.disable_interceptors:
-            await self.interceptor.intercept(self, self._parse_args_and_actual_handle, *args, **kwargs)
-        else:
-            await self._parse_args_and_actual_handle(*args, **kwargs)
+        with use_query_lane(self.query_lane):
+            if not self.disable_interceptors:
+                await self.interceptor.intercept(self, self._parse_args_and_actual_handle, *args, **kwargs)
+            else:
+                await self._parse_args_and_actual_handle(*args, **kwargs)
 
     async def handle_with_parsed_args(self, **kwargs):
-        if not self.disable_interceptors:
-            await self.interceptor.intercept(self, self.actual_handle, **kwargs)
-        else:
-            await self.actual_handle(**kwargs)
+        with use_query_lane(self.query_lane):
+            if not self.disable_interceptors:
+                await self.interceptor.intercept(self, self.actual_handle, **kwargs)
+            else:
+                await self.actual_handle(**kwargs)
 
     async def _parse_args_and_actual_handle(self, *args, **kwargs):
         parsed_kwargs = await self.parse_args(args)
@@ -203,6 +213,10 @@ class Handler(ABC, metaclass=HandlerMeta):
         return await r18g_service.check_by_subject(*extract_subjects_from_session(self.session),
                                                    acquire_rate_limit_token=False)
 
+    @property
+    def download_quantity(self) -> DownloadQuantity:
+        return conf.pixiv_download_quantity_by_platform.get(self.session.platform, conf.pixiv_download_quantity)
+
     async def post_plain_text(self, message: str):
         await context.require(Postman).post_plain_text(message, self.session, self.event)
 
@@ -212,7 +226,8 @@ class Handler(ABC, metaclass=HandlerMeta):
         model = await IllustMessagesModel.from_illust(illust, header=header, number=number,
                                                       max_page=conf.pixiv_max_page_per_illust,
                                                       block_r18=(not await self.is_r18_allowed()),
-                                                      block_r18g=(not await self.is_r18g_allowed()))
+                                                      block_r18g=(not await self.is_r18g_allowed()),
+                                                      quantity=self.download_quantity)
         if model:
             await context.require(Postman).post_illusts(model, self.session, self.event)
 
@@ -224,7 +239,8 @@ class Handler(ABC, metaclass=HandlerMeta):
         else:
             model = await IllustMessagesModel.from_illusts(illusts, header=header, number=number,
                                                            block_r18=(not await self.is_r18_allowed()),
-                                                           block_r18g=(not await self.is_r18g_allowed()))
+                                                           block_r18g=(not await self.is_r18g_allowed()),
+                                                           quantity=self.download_quantity)
             if model:
                 await context.require(Postman).post_illusts(model, self.session, self.event)
 
@@ -32,12 +32,19 @@ class RandomIllustHandler(RecordCommonHandler, service=random_illust_service):
     # noinspection PyMethodOverriding
     async def actual_handle(self, *, word: str,
                             count: int = 1):
+        header = f"这是您点的{word}图"
+
+        # 关键字不是已知的标签时按拼写相似的标签搜索，并告知用户
+        similar = await service.find_similar_tag(word)
+        if similar is not None:
+            header = f"这是您点的{similar}图（{word}不是已知的标签，已按相似的标签搜索）"
+            word = similar
+
         illusts = await service.random_illust(word, count=count,
                                               exclude_r18=(not await self.is_r18_allowed()),
                                               exclude_r18g=(not await self.is_r18g_allowed()))
 
-        await self.post_illusts(illusts,
-                                header=f"这是您点的{word}图")
+        await self.post_illusts(illusts, header=header)
 
 
 @on_regex("^来(.*)?张(.+)图$", rule=get_common_query_rule(), priority=5).handle()
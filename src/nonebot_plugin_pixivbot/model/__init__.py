@@ -1,4 +1,5 @@
 from .illust import Illust
+from .light_illust import LightIllust
 from .pixiv_binding import PixivBinding
 from .subscription import Subscription, ScheduleType
 from .tag import Tag
@@ -6,5 +7,5 @@ from .user import User
 from .user_preview import UserPreview
 from .watch_task import WatchTask, WatchType
 
-__all__ = ("Illust", "User", "UserPreview", "Tag", "Subscription", "ScheduleType",
+__all__ = ("Illust", "LightIllust", "User", "UserPreview", "Tag", "Subscription", "ScheduleType",
            "PixivBinding", "WatchTask", "WatchType")
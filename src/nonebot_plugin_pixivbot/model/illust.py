@@ -4,6 +4,7 @@ import typing
 from pydantic import *
 
 from .tag import Tag
+from ..enums import DownloadQuantity
 from .user import User
 
 
@@ -58,12 +59,15 @@ class Illust(BaseModel):
                 return True
         return False
 
-    def page_image_url(self, page: int) -> str:
+    def page_image_url(self, page: int, quantity: DownloadQuantity = DownloadQuantity.original) -> str:
         if len(self.meta_pages) > 0:
-            return self.meta_pages[page].image_urls.original
+            return getattr(self.meta_pages[page].image_urls, quantity.value)
         else:
             if page == 0:
-                return self.meta_single_page.original_image_url
+                if quantity == DownloadQuantity.original:
+                    return self.meta_single_page.original_image_url
+                else:
+                    return getattr(self.image_urls, quantity.value)
             else:
                 raise IndexError(page)
 
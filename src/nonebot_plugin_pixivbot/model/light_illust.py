@@ -0,0 +1,39 @@
+import datetime
+import typing
+
+from pydantic import *
+
+from .illust import Illust
+
+
+class LightIllust(BaseModel):
+    """
+    插画的投影，只包含随机选取插画与过滤R-18所需的字段
+    """
+    id: int
+    total_bookmarks: int
+    total_view: int
+    create_date: datetime.datetime
+    tags: typing.List[str]  # 标签名与标签翻译
+    illust_ai_type: int = 0
+
+    @classmethod
+    def from_illust(cls, illust: Illust) -> "LightIllust":
+        tags = []
+        for t in illust.tags:
+            tags.append(t.name)
+            if t.translated_name:
+                tags.append(t.translated_name)
+
+        return cls(id=illust.id,
+                   total_bookmarks=illust.total_bookmarks,
+                   total_view=illust.total_view,
+                   create_date=illust.create_date,
+                   tags=tags,
+                   illust_ai_type=illust.illust_ai_type)
+
+    def has_tag(self, tag: str) -> bool:
+        return tag in self.tags
+
+
+__all__ = ("LightIllust",)
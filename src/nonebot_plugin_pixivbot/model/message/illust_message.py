@@ -1,4 +1,3 @@
-from io import BytesIO
 from typing import Optional
 
 from pydantic import BaseModel
@@ -7,19 +6,19 @@ from tzlocal import get_localzone
 from .. import Illust
 from ...config import Config
 from ...data.pixiv_repo import PixivRepo
-from ...enums import BlockAction
+from ...enums import BlockAction, DownloadQuantity
 from ...global_context import context
 
 conf = context.require(Config)
 
 
-async def download_image(illust: Illust, page: int):
-    with BytesIO() as bio:
-        repo = context.require(PixivRepo)
-        async for x in repo.image(illust, page):
-            bio.write(x)
-            break
-        return bio.getvalue()
+async def download_image(illust: Illust, page: int,
+                         quantity: DownloadQuantity = DownloadQuantity.original) -> bytes:
+    repo = context.require(PixivRepo)
+    async for x in repo.image(illust, page, quantity):
+        # 直接使用缓存/下载得到的bytes，不再复制
+        return x
+    return bytes(0)
 
 
 class IllustMessageModel(BaseModel):
@@ -45,7 +44,8 @@ class IllustMessageModel(BaseModel):
                           number: Optional[int] = None,
                           page: int = 0,
                           block_r18: bool = False,
-                          block_r18g: bool = False) -> Optional["IllustMessageModel"]:
+                          block_r18g: bool = False,
+                          quantity: Optional[DownloadQuantity] = None) -> Optional["IllustMessageModel"]:
         model = IllustMessageModel(id=illust.id, header=header, number=number, page=page, total=illust.page_count)
 
         block_tags = [*conf.pixiv_block_tags]
@@ -64,7 +64,7 @@ class IllustMessageModel(BaseModel):
             elif conf.pixiv_block_action == BlockAction.no_reply:
                 return None
         else:
-            model.image = await download_image(illust, page)
+            model.image = await download_image(illust, page, quantity or conf.pixiv_download_quantity)
         model.title = illust.title
         model.author = f"{illust.user.name} ({illust.user.id})"
         model.create_time = illust.create_date.astimezone(get_localzone()).strftime('%Y-%m-%d %H:%M:%S')
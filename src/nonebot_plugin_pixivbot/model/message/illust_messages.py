@@ -5,6 +5,7 @@ from pydantic import BaseModel
 
 from .illust_message import IllustMessageModel
 from .. import Illust
+from ...enums import DownloadQuantity
 
 
 class IllustMessagesModel(BaseModel):
@@ -16,11 +17,13 @@ class IllustMessagesModel(BaseModel):
                            header: Optional[str] = None,
                            number: Optional[int] = None,
                            block_r18: bool = False,
-                           block_r18g: bool = False) -> Optional["IllustMessagesModel"]:
+                           block_r18g: bool = False,
+                           quantity: Optional[DownloadQuantity] = None) -> Optional["IllustMessagesModel"]:
         tasks = [
             create_task(
                 IllustMessageModel.from_illust(x, number=number + i if number is not None else None,
-                                               block_r18=block_r18, block_r18g=block_r18g)
+                                               block_r18=block_r18, block_r18g=block_r18g,
+                                               quantity=quantity)
             ) for i, x in enumerate(illusts)
         ]
         await gather(*tasks)
@@ -40,11 +43,13 @@ class IllustMessagesModel(BaseModel):
                           number: Optional[int] = None,
                           max_page: Optional[int] = 2 ** 31 - 1,
                           block_r18: bool = False,
-                          block_r18g: bool = False) -> Optional["IllustMessagesModel"]:
+                          block_r18g: bool = False,
+                          quantity: Optional[DownloadQuantity] = None) -> Optional["IllustMessagesModel"]:
         tasks = [
             create_task(
                 IllustMessageModel.from_illust(illust, page=i, number=number,
-                                               block_r18=block_r18, block_r18g=block_r18g)
+                                               block_r18=block_r18, block_r18g=block_r18g,
+                                               quantity=quantity)
             ) for i in range(min(illust.page_count, max_page))
         ]
         await gather(*tasks)
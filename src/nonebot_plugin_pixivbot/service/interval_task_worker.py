@@ -10,6 +10,8 @@ from ssttkkl_nonebot_utils.platform import platform_func
 from ssttkkl_nonebot_utils.platform.func_manager import UnsupportedBotError
 
 from ..data.interval_task_repo import IntervalTaskRepo
+from ..data.pixiv_repo.enums import QueryLane
+from ..data.pixiv_repo.query_lane import use_query_lane
 from ..model.interval_task import IntervalTask
 from ..utils.lifecycler import on_bot_connect, on_bot_disconnect
 
@@ -18,6 +20,7 @@ T = TypeVar("T", bound=IntervalTask)
 
 class IntervalTaskWorker(ABC, Generic[T]):
     tag: str = ""
+    query_lane: QueryLane = QueryLane.SUBSCRIPTION
 
     @property
     @abstractmethod
@@ -53,7 +56,8 @@ class IntervalTaskWorker(ABC, Generic[T]):
         logger.info(f"[{self.tag}] triggered \"{item}\"")
 
         try:
-            await self._handle_trigger(item)
+            with use_query_lane(self.query_lane):
+                await self._handle_trigger(item)
         except ActionFailed as e:
             logger.opt(exception=e).error(f"[{self.tag}] action failed when handling task \"{item.code}\"")
 
@@ -1,14 +1,16 @@
-from typing import List, Union, Tuple, Iterable, Sequence
+import asyncio
+from typing import List, Union, Tuple, AsyncIterable, Optional
 
 from nonebot import logger
 
 from nonebot_plugin_pixivbot.config import Config
 from nonebot_plugin_pixivbot.data.local_tag import LocalTagRepo
 from nonebot_plugin_pixivbot.data.pixiv_repo import LazyIllust, PixivRepo
+from nonebot_plugin_pixivbot.data.pixiv_repo.query_mode import use_light_query
 from nonebot_plugin_pixivbot.enums import RandomIllustMethod, RankingMode
 from nonebot_plugin_pixivbot.global_context import context
 from nonebot_plugin_pixivbot.model import Illust, User
-from nonebot_plugin_pixivbot.service.roulette import roulette
+from nonebot_plugin_pixivbot.service.roulette import roulette_stream
 from nonebot_plugin_pixivbot.utils.errors import BadRequestError, QueryError
 
 conf = context.require(Config)
@@ -20,36 +22,36 @@ local_tags = context.require(LocalTagRepo)
 class PixivService:
 
     @staticmethod
-    def _handle_r18(illusts: Iterable[LazyIllust],
-                    exclude_r18: bool = False,
-                    exclude_r18g: bool = False) -> Iterable[LazyIllust]:
-        if not exclude_r18 and not exclude_r18g:
-            return illusts
-        else:
-            def _():
-                for x in illusts:
-                    if not x.loaded:
-                        continue
-                    if x.content.has_tag("R-18") and exclude_r18:
-                        continue
-                    if x.content.has_tag("R-18G") and exclude_r18g:
-                        continue
-                    yield x
-
-            return _()
-
-    async def _choice_and_load(self, illusts: Sequence[LazyIllust], random_method: RandomIllustMethod, count: int) \
-            -> List[Illust]:
+    async def _handle_r18(illusts: AsyncIterable[LazyIllust],
+                          exclude_r18: bool = False,
+                          exclude_r18g: bool = False) -> AsyncIterable[LazyIllust]:
+        async for x in illusts:
+            if exclude_r18 or exclude_r18g:
+                light = x.light
+                if light is None:
+                    continue
+                if light.has_tag("R-18") and exclude_r18:
+                    continue
+                if light.has_tag("R-18G") and exclude_r18g:
+                    continue
+            yield x
+
+    async def _choice_and_load(self, illusts: AsyncIterable[LazyIllust], random_method: RandomIllustMethod,
+                               count: int) -> List[Illust]:
         if count <= 0:
             raise BadRequestError("不合法的请求数量")
         if count > conf.pixiv_max_item_per_query:
             raise BadRequestError("数量超过单次请求上限")
-        if count > len(illusts):
+
+        # 边读取边抽样，只读取插画的投影
+        with use_light_query():
+            winners, n = await roulette_stream(illusts, random_method, count)
+        if count > n:
             raise QueryError("别看了，没有的。")
 
-        winners = roulette(illusts, random_method, count)
         logger.info(f"[pixiv_service] choice {[x.id for x in winners]}")
-        return [await x.get() for x in winners]
+        # 并发地加载，由loader合并为一批查询
+        return list(await asyncio.gather(*[x.get() for x in winners]))
 
     async def illust_ranking(self, mode: RankingMode, range: Tuple[int, int]) -> List[Illust]:
         # range 下标从1开始 闭区间
@@ -59,9 +61,9 @@ class PixivService:
             if i > range[1]:
                 break
             elif i >= range[0]:
-                li.append(await x.get())
+                li.append(x)
             i += 1
-        return li
+        return list(await asyncio.gather(*[x.get() for x in li]))
 
     async def illust_detail(self, illust: int) -> Illust:
         async for x in repo.illust_detail(illust):
@@ -80,9 +82,26 @@ class PixivService:
                     logger.info(f"[pixiv_service] found translation {word} -> {tag.name}")
                     word = tag.name
 
-        illusts = [x async for x in repo.search_illust(word)]
-        illusts = self._handle_r18(illusts, exclude_r18, exclude_r18g)
-        return await self._choice_and_load(list(illusts), conf.pixiv_random_illust_method, count)
+        illusts = self._handle_r18(repo.search_illust(word), exclude_r18, exclude_r18g)
+        return await self._choice_and_load(illusts, conf.pixiv_random_illust_method, count)
+
+    async def find_similar_tag(self, word: str) -> Optional[str]:
+        """
+        word既不是已知的标签也不是标签的翻译时，查找拼写相似的已知标签
+
+        :return: 相似的标签名，没有时返回None
+        """
+        if not conf.pixiv_tag_translation_enabled or not conf.pixiv_tag_fuzzy_search_enabled:
+            return None
+
+        if await local_tags.find_by_name(word) or await local_tags.find_by_translated_name(word):
+            return None
+
+        tag = await local_tags.find_similar(word)
+        if tag and tag.name != word:
+            logger.info(f"[pixiv_service] found similar tag {word} -> {tag.name}")
+            return tag.name
+        return None
 
     async def get_user(self, user: Union[str, int]) -> User:
         if isinstance(user, str):
@@ -100,24 +119,22 @@ class PixivService:
                                  exclude_r18g: bool = False) -> Tuple[User, List[Illust]]:
         user = await self.get_user(user)
 
-        illusts = [x async for x in repo.user_illusts(user.id)]
-        illusts = self._handle_r18(illusts, exclude_r18, exclude_r18g)
-        illust = await self._choice_and_load(list(illusts), conf.pixiv_random_user_illust_method, count)
+        illusts = self._handle_r18(repo.user_illusts(user.id), exclude_r18, exclude_r18g)
+        illust = await self._choice_and_load(illusts, conf.pixiv_random_user_illust_method, count)
         return user, illust
 
     async def random_recommended_illust(self, *, count: int = 1,
                                         exclude_r18: bool = False,
                                         exclude_r18g: bool = False) -> List[Illust]:
-        illusts = [x async for x in repo.recommended_illusts()]
+        illusts = repo.recommended_illusts()
         return await self._choice_and_load(illusts, conf.pixiv_random_recommended_illust_method, count)
 
     async def random_bookmark(self, pixiv_user_id: int = 0,
                               *, count: int = 1,
                               exclude_r18: bool = False,
                               exclude_r18g: bool = False) -> List[Illust]:
-        illusts = [x async for x in repo.user_bookmarks(pixiv_user_id)]
-        illusts = self._handle_r18(illusts, exclude_r18, exclude_r18g)
-        return await self._choice_and_load(list(illusts), conf.pixiv_random_bookmark_method, count)
+        illusts = self._handle_r18(repo.user_bookmarks(pixiv_user_id), exclude_r18, exclude_r18g)
+        return await self._choice_and_load(illusts, conf.pixiv_random_bookmark_method, count)
 
     async def random_related_illust(self, illust_id: int,
                                     *, count: int = 1,
@@ -126,9 +143,8 @@ class PixivService:
         if illust_id == 0:
             raise BadRequestError("你还没有发送过请求")
 
-        illusts = [x async for x in repo.related_illusts(illust_id)]
-        illusts = self._handle_r18(illusts, exclude_r18, exclude_r18g)
-        return await self._choice_and_load(list(illusts), conf.pixiv_random_related_illust_method, count)
+        illusts = self._handle_r18(repo.related_illusts(illust_id), exclude_r18, exclude_r18g)
+        return await self._choice_and_load(illusts, conf.pixiv_random_related_illust_method, count)
 
 
 __all__ = ("PixivService",)
@@ -1,5 +1,8 @@
+import heapq
+import math
+import random
 from time import time
-from typing import Sequence
+from typing import Sequence, AsyncIterable, Callable, Optional, List, Tuple
 
 import numpy as np
 
@@ -19,8 +22,9 @@ def bookmark_proportion(illusts: Sequence[LazyIllust]) -> np.ndarray:
     p = np.zeros(n)
 
     for i, x in enumerate(illusts):
-        if x.loaded:
-            p[i] = x.content.total_bookmarks + 10  # 加10平滑
+        light = x.light
+        if light is not None:
+            p[i] = light.total_bookmarks + 10  # 加10平滑
         else:
             p[i] = 10
 
@@ -34,8 +38,9 @@ def view_proportion(illusts: Sequence[LazyIllust]) -> np.ndarray:
     p = np.zeros(n)
 
     for i, x in enumerate(illusts):
-        if x.loaded:
-            p[i] = x.content.total_view + 10  # 加10平滑
+        light = x.light
+        if light is not None:
+            p[i] = light.total_view + 10  # 加10平滑
         else:
             p[i] = 10
 
@@ -51,8 +56,9 @@ def timedelta_proportion(illusts: Sequence[LazyIllust]) -> np.ndarray:
     now = time()
     min_p = 0
     for i, x in enumerate(illusts):
-        if x.loaded:
-            p[i] = x.create_date.timestamp() - now
+        light = x.light
+        if light is not None:
+            p[i] = light.create_date.timestamp() - now
             if p[i] < min_p:
                 min_p = p[i]
         else:
@@ -84,3 +90,62 @@ def roulette(illusts: Sequence[LazyIllust], random_method: RandomIllustMethod, k
     rng = np.random.default_rng()
     winners = rng.choice(n, k, False, p)
     return [illusts[c] for c in winners]
+
+
+# ================ 流式抽样 ================
+# 以下权重与上面的概率只差一个归一化系数
+_weight_gen = {
+    RandomIllustMethod.uniform: lambda x: 1.0,
+    RandomIllustMethod.bookmark_proportion:
+        lambda x: (x.light.total_bookmarks + 10) if x.light is not None else 10,  # 加10平滑
+    RandomIllustMethod.view_proportion:
+        lambda x: (x.light.total_view + 10) if x.light is not None else 10,  # 加10平滑
+}
+
+
+class RouletteReservoir:
+    """
+    加权无放回抽样（Efraimidis-Spirakis）：每个候选取键 log(u)/w（u为(0,1]上的均匀随机数），保留键最大的k个
+    只需遍历一次，内存占用为O(k)，与候选总数无关
+    """
+
+    def __init__(self, weight: Callable[[LazyIllust], float], k: int):
+        self.weight = weight
+        self.k = k
+        self.n = 0
+        self._heap: List[Tuple[float, int, LazyIllust]] = []
+
+    def push(self, x: LazyIllust):
+        self.n += 1
+        w = self.weight(x)
+        if w <= 0:
+            return
+
+        key = math.log(1.0 - random.random()) / w
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, (key, self.n, x))
+        elif key > self._heap[0][0]:
+            heapq.heapreplace(self._heap, (key, self.n, x))
+
+    def result(self) -> List[LazyIllust]:
+        # 按键从大到小排列，相当于依次抽取的顺序
+        return [x for _, _, x in sorted(self._heap, reverse=True)]
+
+
+async def roulette_stream(illusts: AsyncIterable[LazyIllust], random_method: RandomIllustMethod, k: int) \
+        -> Tuple[Sequence[LazyIllust], int]:
+    """
+    从异步迭代的候选中抽取k个，不需要先把全部候选读入列表
+    timedelta_proportion需要全部候选的最早发布时间才能归一化，仍然读入全部候选后调用roulette
+
+    :return: (抽中的插画, 候选总数)
+    """
+    weight: Optional[Callable[[LazyIllust], float]] = _weight_gen.get(random_method)
+    if weight is None:
+        li = [x async for x in illusts]
+        return roulette(li, random_method, k), len(li)
+
+    reservoir = RouletteReservoir(weight, k)
+    async for x in illusts:
+        reservoir.push(x)
+    return reservoir.result(), reservoir.n
@@ -12,6 +12,7 @@ from apscheduler.triggers.interval import IntervalTrigger
 from nonebot_plugin_session import Session
 
 from .interval_task_worker import IntervalTaskWorker
+from ..data.pixiv_repo.enums import QueryLane
 from ..data.subscription import SubscriptionRepo
 from ..global_context import context
 from ..model import Subscription
@@ -93,6 +94,7 @@ def parse_schedule(raw_schedule: str) -> Union[IntervalSchedule, CronSchedule]:
 @context.register_eager_singleton()
 class Scheduler(IntervalTaskWorker[Subscription]):
     tag = "scheduler"
+    query_lane = QueryLane.SUBSCRIPTION
 
     @property
     def repo(self) -> SubscriptionRepo:
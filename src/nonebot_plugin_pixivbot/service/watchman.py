@@ -6,6 +6,7 @@ from nonebot_plugin_session import Session
 
 from .interval_task_worker import IntervalTaskWorker
 from ..config import Config
+from ..data.pixiv_repo.enums import QueryLane
 from ..data.watch_task import WatchTaskRepo
 from ..global_context import context
 from ..model import WatchTask, WatchType
@@ -19,6 +20,7 @@ conf = context.require(Config)
 @context.root.register_eager_singleton()
 class Watchman(IntervalTaskWorker[WatchTask]):
     tag = "watchman"
+    query_lane = QueryLane.WATCH
 
     _trigger_hasher_mapper = {
         WatchType.user_illusts: lambda item: item.kwargs["user_id"],
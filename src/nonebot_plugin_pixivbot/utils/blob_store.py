@@ -0,0 +1,112 @@
+import asyncio
+import mmap
+import os
+import shutil
+import struct
+import zlib
+from datetime import datetime, timezone
+from hashlib import sha1
+from pathlib import Path
+from typing import Optional, Tuple
+from uuid import uuid4
+
+import aiofiles
+import aiofiles.os
+from nonebot import logger
+
+# 文件头：魔数、更新时间（UTC时间戳）、内容长度、内容的CRC32
+_MAGIC = b"PXB2"
+_HEADER = struct.Struct("<4sdQI")
+
+HEADER_SIZE = _HEADER.size
+
+
+class FileBlobStore:
+    """
+    按键的哈希值分两级目录存放的Blob存储
+    每个Blob为一个文件，元数据存放在文件头中，读取只需打开一个文件；
+    写入先写临时文件再原子地rename，不会留下写了一半的文件
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+
+        self.hits = 0
+        self.misses = 0
+        self.corrupted = 0
+
+    def path_of(self, key: str) -> Path:
+        h = sha1(key.encode("utf-8")).hexdigest()
+        return self.root / h[:2] / h[2:4] / h
+
+    @staticmethod
+    def _read_sync(path: Path) -> Optional[Tuple[float, bytes]]:
+        # 通过mmap读取，校验长度与CRC32，不需要解析任何JSON
+        # 内容从文件的HEADER_SIZE偏移处开始，也可以直接对path_of(key)使用sendfile
+        with open(path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            if file_size < HEADER_SIZE:
+                return None
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                magic, update_time, size, crc = _HEADER.unpack_from(mm)
+                if magic != _MAGIC or file_size - HEADER_SIZE != size:
+                    return None
+                content = mm[HEADER_SIZE:]
+
+        if zlib.crc32(content) != crc:
+            return None
+        return update_time, content
+
+    async def read(self, key: str) -> Optional[Tuple[datetime, bytes]]:
+        """
+        :return: (更新时间, 内容)，不存在或文件损坏时返回None（损坏的文件会被删除）
+        """
+        path = self.path_of(key)
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(None, self._read_sync, path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        if result is None:
+            logger.warning(f"[blob_store] deleting corrupted blob {path}")
+            self.corrupted += 1
+            self.misses += 1
+            await self._remove(path)
+            return None
+
+        self.hits += 1
+        update_time, content = result
+        return datetime.fromtimestamp(update_time, timezone.utc), content
+
+    async def write(self, key: str, content: bytes, update_time: datetime):
+        path = self.path_of(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        header = _HEADER.pack(_MAGIC, update_time.timestamp(), len(content), zlib.crc32(content))
+        tmp = path.with_name(f".{path.name}.{uuid4().hex}.tmp")
+        try:
+            async with aiofiles.open(tmp, 'wb') as f:
+                await f.write(header)
+                await f.write(content)
+            await aiofiles.os.replace(tmp, path)
+        except BaseException:
+            await self._remove(tmp)
+            raise
+
+    @staticmethod
+    async def _remove(path: Path):
+        try:
+            await aiofiles.os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    async def delete(self, key: str):
+        await self._remove(self.path_of(key))
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+__all__ = ("FileBlobStore", "HEADER_SIZE")
@@ -9,9 +9,16 @@ class RateLimitError(QueryError):
         super().__init__("Rate Limit")
 
 
+class ResourceGoneError(QueryError):
+    """
+    查询的资源不存在（已删除、非公开等），重试也不会成功
+    """
+    pass
+
+
 class PostIllustError(QueryError):
     def __str__(self):
         super().__init__("发送图片失败")
 
 
-__all__ = ("QueryError", "RateLimitError", "BadRequestError", "PostIllustError")
+__all__ = ("QueryError", "RateLimitError", "ResourceGoneError", "BadRequestError", "PostIllustError")
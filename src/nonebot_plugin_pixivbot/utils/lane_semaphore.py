@@ -0,0 +1,114 @@
+from asyncio import Future, get_running_loop
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import TypeVar, Generic, Mapping, Dict, Deque, Optional
+
+K = TypeVar("K")
+
+
+class LaneSemaphore(Generic[K]):
+    """
+    分通道的信号量：
+    各通道的等待者按平滑加权轮询（smooth weighted round-robin）获得空闲名额，
+    并且可以为通道保留一部分名额，其他通道不能占用这部分名额。
+    """
+
+    def __init__(self, value: int,
+                 weights: Mapping[K, int],
+                 reserved: Optional[Mapping[K, int]] = None):
+        if value <= 0:
+            raise ValueError("value must be positive")
+
+        self._value = value
+        self._free = value
+        self._weights: Dict[K, int] = {lane: max(1, w) for lane, w in weights.items()}
+        self._reserved: Dict[K, int] = {lane: 0 for lane in self._weights}
+        if reserved:
+            for lane, r in reserved.items():
+                self._reserved[lane] = max(0, r)
+        if sum(self._reserved.values()) >= value:
+            raise ValueError("reserved slots must be less than value")
+
+        self._current_weight: Dict[K, int] = {lane: 0 for lane in self._weights}
+        self._waiters: Dict[K, Deque[Future]] = {lane: deque() for lane in self._weights}
+        self._in_use: Dict[K, int] = {lane: 0 for lane in self._weights}
+
+    def in_use(self, lane: K) -> int:
+        return self._in_use[lane]
+
+    def waiting(self, lane: K) -> int:
+        return len(self._waiters[lane])
+
+    def _unused_reserved(self, excluding: K) -> int:
+        return sum(max(0, r - self._in_use[lane])
+                   for lane, r in self._reserved.items() if lane != excluding)
+
+    def _eligible(self, lane: K) -> bool:
+        # 空闲名额必须多于其他通道尚未用掉的保留名额
+        return self._free > self._unused_reserved(lane)
+
+    def _take(self, lane: K):
+        self._free -= 1
+        self._in_use[lane] += 1
+
+    def _wake_up_next(self):
+        while self._free > 0:
+            for waiters in self._waiters.values():
+                while waiters and waiters[0].done():
+                    waiters.popleft()
+
+            candidates = [lane for lane, waiters in self._waiters.items()
+                          if waiters and self._eligible(lane)]
+            if not candidates:
+                return
+
+            total = 0
+            selected = None
+            for lane in candidates:
+                self._current_weight[lane] += self._weights[lane]
+                total += self._weights[lane]
+                if selected is None or self._current_weight[lane] > self._current_weight[selected]:
+                    selected = lane
+            self._current_weight[selected] -= total
+
+            self._take(selected)
+            self._waiters[selected].popleft().set_result(None)
+
+    async def acquire(self, lane: K):
+        if not any(self._waiters.values()) and self._eligible(lane):
+            self._take(lane)
+            return
+
+        fut = get_running_loop().create_future()
+        self._waiters[lane].append(fut)
+        self._wake_up_next()
+        try:
+            await fut
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                # 已经分配了名额但被取消
+                self.release(lane)
+            else:
+                fut.cancel()
+                try:
+                    self._waiters[lane].remove(fut)
+                except ValueError:
+                    pass
+                self._wake_up_next()
+            raise
+
+    def release(self, lane: K):
+        self._in_use[lane] -= 1
+        self._free += 1
+        self._wake_up_next()
+
+    @asynccontextmanager
+    async def use(self, lane: K):
+        await self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+
+__all__ = ("LaneSemaphore",)
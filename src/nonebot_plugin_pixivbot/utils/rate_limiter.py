@@ -0,0 +1,124 @@
+import asyncio
+from time import monotonic
+from typing import Optional
+
+from nonebot import logger
+
+from .errors import RateLimitError
+
+
+class AIMDTokenBucket:
+    """
+    令牌桶限流器，速率按AIMD调整：
+    每次请求成功后加性增加速率，遇到RateLimit时乘性减小速率。
+    获取令牌的请求按FIFO顺序排队等待，超过deadline仍未获得令牌时抛出RateLimitError。
+    """
+
+    def __init__(self, max_rate: float,
+                 min_rate: float,
+                 burst: int,
+                 *, increase_step: float = 0.05,
+                 decrease_factor: float = 0.5,
+                 decrease_cooldown: float = 5.0):
+        """
+        :param max_rate: 最大速率（单位：请求/秒）
+        :param min_rate: 最小速率（单位：请求/秒）
+        :param burst: 令牌桶容量
+        :param increase_step: 每次成功后速率的增量
+        :param decrease_factor: 每次RateLimit后速率的乘数
+        :param decrease_cooldown: 两次减速之间的最小间隔（单位：秒），避免同一时刻发出的请求把速率连续压低
+        """
+        if min_rate <= 0 or max_rate < min_rate:
+            raise ValueError(f"illegal rate range: [{min_rate}, {max_rate}]")
+
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.burst = max(1, burst)
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+
+        self._rate = max_rate
+        self._tokens = float(self.burst)
+        self._last_refill = monotonic()
+        self._last_decrease: Optional[float] = None
+
+        # asyncio.Lock的等待者按FIFO顺序唤醒
+        self._lock = asyncio.Lock()
+        self._queue_depth = 0
+
+    @property
+    def rate(self) -> float:
+        """当前速率（单位：请求/秒）"""
+        return self._rate
+
+    @property
+    def queue_depth(self) -> int:
+        """正在等待令牌的请求数"""
+        return self._queue_depth
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(float(self.burst), self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+    async def acquire(self, timeout: Optional[float] = None):
+        """
+        获取一个令牌
+        :param timeout: 最长等待时间（单位：秒），为None时无限等待
+        :raise RateLimitError: 无法在timeout内获得令牌
+        """
+        deadline = monotonic() + timeout if timeout is not None else None
+
+        self._queue_depth += 1
+        try:
+            try:
+                if deadline is None:
+                    await self._lock.acquire()
+                else:
+                    await asyncio.wait_for(self._lock.acquire(), max(0.0, deadline - monotonic()))
+            except asyncio.TimeoutError:
+                raise RateLimitError()
+
+            try:
+                while True:
+                    self._refill()
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+
+                    # 速率可能在等待期间被调整，因此醒来后需要重新计算
+                    wait = (1 - self._tokens) / self._rate
+                    if deadline is not None and monotonic() + wait > deadline:
+                        raise RateLimitError()
+                    await asyncio.sleep(wait)
+            finally:
+                self._lock.release()
+        finally:
+            self._queue_depth -= 1
+
+    def on_success(self):
+        if self._rate < self.max_rate:
+            self._refill()
+            self._rate = min(self.max_rate, self._rate + self.increase_step)
+
+    def on_rate_limited(self):
+        now = monotonic()
+        if self._last_decrease is not None and now - self._last_decrease < self.decrease_cooldown:
+            return
+
+        self._refill()
+        self._last_decrease = now
+        self._rate = max(self.min_rate, self._rate * self.decrease_factor)
+        # 清空令牌桶，让排队中的请求按新的速率发出
+        self._tokens = min(self._tokens, 0.0)
+        logger.warning(f"[rate_limiter] got rate limit, slow down to {self._rate:.2f} req/s "
+                       f"(queue depth: {self._queue_depth})")
+
+
+__all__ = ("AIMDTokenBucket",)
@@ -1,11 +1,16 @@
+import sys
 import time
 from abc import ABC, abstractmethod
-from asyncio import Lock
+from asyncio import Event, Task, CancelledError, create_task, current_task
+from collections import OrderedDict
+from collections.abc import Mapping
 from contextlib import AbstractAsyncContextManager, asynccontextmanager
+from dataclasses import dataclass, field
+from enum import Enum
 from types import TracebackType
-from typing import Any, Generic, TypeVar, AsyncGenerator, List, Type, Optional, AsyncContextManager
+from typing import Any, Generic, TypeVar, AsyncGenerator, List, Type, Optional, AsyncContextManager, Callable, \
+    Dict, Hashable
 
-from cachetools import TLRUCache
 from nonebot import logger
 
 from nonebot_plugin_pixivbot.data.pixiv_repo.enums import CacheStrategy
@@ -13,61 +18,138 @@ from nonebot_plugin_pixivbot.data.pixiv_repo.enums import CacheStrategy
 T_ID = TypeVar("T_ID")
 T_ITEM = TypeVar("T_ITEM")
 
+_LEAF_TYPES = (str, int, float, bool, type(None))
+
+
+def estimate_size(obj: Any, _seen: Optional[set] = None) -> int:
+    """
+    粗略估计对象占用的内存（单位：字节）：bytes按长度计算，容器、模型与普通对象递归计算
+    """
+    if isinstance(obj, (bytes, bytearray)):
+        return sys.getsizeof(obj)
+    if isinstance(obj, memoryview):
+        return obj.nbytes
+    if isinstance(obj, _LEAF_TYPES) or isinstance(obj, (Enum, type)):
+        return sys.getsizeof(obj)
+
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, Mapping):
+        for k, v in obj.items():
+            size += estimate_size(k, _seen) + estimate_size(v, _seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for x in obj:
+            size += estimate_size(x, _seen)
+    elif hasattr(obj, "__dict__"):
+        size += estimate_size(vars(obj), _seen)
+    return size
+
+
+@dataclass
+class SharedAgenStats:
+    resident_bytes: int = 0  # 所有holder保存的item的大小
+    running: int = 0
+    cached: int = 0
+    evicted: int = 0  # 因超出内存预算而被淘汰的holder数
+    resident_bytes_by_group: Dict[Hashable, int] = field(default_factory=dict)
+
 
 class SharedAsyncGeneratorManager(ABC, Generic[T_ID, T_ITEM]):
+    """
+    :param max_bytes: 所有holder保存的item的总大小上限，超出时按最近使用淘汰已结束的holder（None表示不限制）
+    :param group_budgets: 每组holder（见group_of）的总大小上限
+    :param sizer: 估计每个item的大小
+    :param maxsize: 最多缓存的已结束的holder数
+    """
     log_tag = "shared_agen"
 
     class _AgenHolder(AbstractAsyncContextManager):
+        """
+        由一个pump任务从origin获取item并追加到缓冲区，每获取一个item就通知所有等待的消费者（广播）
+        消费者各自从缓冲区读取，不需要加锁；只有在有消费者等待下一个item时pump才会向origin获取
+        消费者被取消不影响pump与其他消费者；所有消费者都在origin结束前退出时，pump被取消、origin被关闭
+        """
+
         def __init__(self, origin: AsyncGenerator[T_ITEM, None],
                      identifier: T_ID,
                      manager: "SharedAsyncGeneratorManager"):
             super().__init__()
             self._origin = origin
-            self._stopped = False  # whether origin has raised a StopIteration
+            self._stopped = False  # whether origin has raised a StopIteration (or an error)
+            self._error: Optional[BaseException] = None
             self._got_items = []  # items got from origin, used to replay
-            self._got = 0  # count of items got from origin
-            self._mutex = Lock()  # to solve race
             self._consumers = 0  # count of consumer
 
+            self._pump: Optional[Task] = None
+            self._demand = Event()  # some consumer is waiting for the next item
+            self._published = Event()  # replaced after each item is published
+
             self._identifier = identifier
             self._manager = manager
 
+            self.size = 0  # total size of got items (in bytes)
+            self.expires: Optional[float] = None  # set when cached
+
         @property
         def consumers(self) -> int:
             return self._consumers
 
+        def _publish(self):
+            published, self._published = self._published, Event()
+            published.set()
+
+        async def _pump_loop(self):
+            try:
+                while True:
+                    await self._demand.wait()
+                    self._demand.clear()
+
+                    try:
+                        new_data = await self._origin.__anext__()
+                    except StopAsyncIteration:
+                        self._stopped = True
+                        await self._manager.on_agen_stop(self._identifier, self._got_items)
+                        break
+
+                    await self._manager.on_agen_next(self._identifier, new_data)
+
+                    self._got_items.append(new_data)
+                    self._manager._on_holder_grown(self, new_data)
+                    self._publish()
+            except Exception as e:
+                # origin或manager的回调出错时，消费者都收到该错误，而不是得到截断的结果
+                self._error = e
+                self._stopped = True
+                try:
+                    await self._manager.on_agen_error(self._identifier, e)
+                except Exception as e2:
+                    logger.opt(exception=e2).error(f"[{self._manager.log_tag}] {self._identifier} on_agen_error failed")
+            finally:
+                # 被取消（invalidate）时，正在等待的消费者也随之结束
+                self._stopped = True
+                self._publish()
+
         async def _generator(self) -> AsyncGenerator[T_ITEM, None]:
             cur = 0
             while True:
-                if cur < self._got:
+                if cur < len(self._got_items):
                     yield self._got_items[cur]
                     cur += 1
+                elif self._stopped:
+                    if self._error is not None:
+                        raise self._error
+                    break
                 else:
-                    if self._stopped:
-                        break
-
-                    async with self._mutex:
-                        if self._stopped:
-                            break
-
-                        if cur == self._got:
-                            try:
-                                new_data = await self._origin.__anext__()
-                            except StopAsyncIteration:
-                                self._stopped = True
-                                await self._manager.on_agen_stop(self._identifier, self._got_items)
-                                break
-                            except Exception as e:
-                                await self._manager.on_agen_error(self._identifier, e)
-                                raise e
-
-                            await self._manager.on_agen_next(self._identifier, new_data)
-
-                            self._got_items.append(new_data)
-                            self._got += 1
-
-                        yield self._got_items[cur]
-                        cur += 1
+                    published = self._published
+                    self._demand.set()
+                    if self._pump is None:
+                        self._pump = create_task(self._pump_loop())
+                    await published.wait()
 
         async def __aenter__(self) -> AsyncGenerator[T_ITEM, None]:
             self._consumers += 1
@@ -81,15 +163,35 @@ class SharedAsyncGeneratorManager(ABC, Generic[T_ID, T_ITEM]):
             await self._manager._on_consumers_changed(self._identifier, self, self._consumers)
 
         async def aclose(self):
-            return await self._origin.aclose()
+            pump = self._pump
+            # pump自身出错时也会调用到这里（on_agen_error -> invalidate），此时不能等待自己
+            if pump is not None and pump is not current_task() and not pump.done():
+                pump.cancel()
+                try:
+                    await pump
+                except CancelledError:
+                    pass
+            if pump is None or pump is not current_task():
+                return await self._origin.aclose()
+
+    def __init__(self, *, max_bytes: Optional[int] = None,
+                 group_budgets: Optional[Dict[Hashable, int]] = None,
+                 sizer: Callable[[Any], int] = estimate_size,
+                 maxsize: int = 2048):
+        self.max_bytes = max_bytes
+        self.group_budgets = group_budgets or {}
+        self.sizer = sizer
+        self.maxsize = maxsize
 
-    def __init__(self):
         self._running_holders = dict[T_ID, self._AgenHolder]()
         self._expires_time = dict[T_ID, float]()
 
-        self._stopped_holders = TLRUCache[T_ID, self._AgenHolder](maxsize=2048,
-                                                                  ttu=lambda k, v, now: self._expires_time[k],
-                                                                  timer=time.time)
+        # 按最近使用排列，最早使用的在前
+        self._stopped_holders = OrderedDict[T_ID, self._AgenHolder]()
+
+        self._resident_bytes = 0
+        self._resident_bytes_by_group: Dict[Hashable, int] = {}
+        self._evicted = 0
 
     @abstractmethod
     def agen(self, identifier: T_ID,
@@ -97,6 +199,89 @@ class SharedAsyncGeneratorManager(ABC, Generic[T_ID, T_ITEM]):
              **kwargs) -> AsyncGenerator[T_ITEM, None]:
         raise NotImplementedError()
 
+    def group_of(self, identifier: T_ID) -> Hashable:
+        """
+        holder所属的组，用于按组限制内存
+        """
+        return None
+
+    @property
+    def stats(self) -> SharedAgenStats:
+        return SharedAgenStats(resident_bytes=self._resident_bytes,
+                               running=len(self._running_holders),
+                               cached=len(self._stopped_holders),
+                               evicted=self._evicted,
+                               resident_bytes_by_group=dict(self._resident_bytes_by_group))
+
+    # ================ 内存统计 ================
+    def _account(self, holder: _AgenHolder, size: int):
+        self._resident_bytes += size
+        group = self.group_of(holder._identifier)
+        self._resident_bytes_by_group[group] = self._resident_bytes_by_group.get(group, 0) + size
+
+    def _release(self, holder: _AgenHolder):
+        """
+        holder不再被管理（其占用的内存在消费者退出后即可回收）
+        """
+        self._account(holder, -holder.size)
+        holder.size = 0
+
+    def _on_holder_grown(self, holder: _AgenHolder, item: T_ITEM):
+        # 已被invalidate的holder不再统计
+        if self._running_holders.get(holder._identifier) is not holder:
+            return
+
+        try:
+            size = self.sizer(item)
+        except Exception as e:
+            logger.opt(exception=e).warning(f"[{self.log_tag}] failed to estimate size of item")
+            return
+
+        holder.size += size
+        self._account(holder, size)
+        self._evict(self.group_of(holder._identifier))
+
+    def _over_budget(self, group: Hashable) -> bool:
+        if self.max_bytes is not None and self._resident_bytes > self.max_bytes:
+            return True
+        budget = self.group_budgets.get(group)
+        return budget is not None and self._resident_bytes_by_group.get(group, 0) > budget
+
+    def _too_large(self, holder: _AgenHolder) -> bool:
+        if self.max_bytes is not None and holder.size > self.max_bytes:
+            return True
+        budget = self.group_budgets.get(self.group_of(holder._identifier))
+        return budget is not None and holder.size > budget
+
+    def _evict(self, group: Hashable):
+        """
+        超出内存预算时按最近使用淘汰已结束的holder（运行中的holder无法淘汰）
+        """
+        if not self._over_budget(group):
+            return
+
+        for identifier in list(self._stopped_holders.keys()):
+            # 只超出组预算时只淘汰该组的holder
+            over_global = self.max_bytes is not None and self._resident_bytes > self.max_bytes
+            if not over_global and self.group_of(identifier) != group:
+                continue
+
+            holder = self._stopped_holders.pop(identifier)
+            self._release(holder)
+            self._evicted += 1
+            logger.debug(f"[{self.log_tag}] {identifier} was evicted")
+
+            if not self._over_budget(group):
+                break
+
+    def _expire(self):
+        now = time.time()
+        for identifier, holder in list(self._stopped_holders.items()):
+            if holder.expires <= now:
+                del self._stopped_holders[identifier]
+                self._release(holder)
+
+    # ================ 回调 ================
     async def on_agen_next(self, identifier: T_ID, item: T_ITEM):
         pass
 
@@ -105,10 +290,21 @@ class SharedAsyncGeneratorManager(ABC, Generic[T_ID, T_ITEM]):
         # 自然也不需要缓存到self._stopped_holders中
         if identifier in self._running_holders:
             holder = self._running_holders.pop(identifier)
-            if identifier in self._expires_time:
+            if identifier in self._expires_time and not self._too_large(holder):
+                holder.expires = self._expires_time.pop(identifier)
+
+                self._expire()
+                while len(self._stopped_holders) >= self.maxsize:
+                    _, x = self._stopped_holders.popitem(last=False)
+                    self._release(x)
+
                 self._stopped_holders[identifier] = holder
-                logger.debug(f"[{self.log_tag}] {identifier} was stopped and cached")
+                self._evict(self.group_of(identifier))
+                if identifier in self._stopped_holders:
+                    logger.debug(f"[{self.log_tag}] {identifier} was stopped and cached")
             else:
+                self._expires_time.pop(identifier, None)
+                self._release(holder)
                 logger.debug(f"[{self.log_tag}] {identifier} was stopped but not cached")
 
     async def on_agen_error(self, identifier: T_ID, e: Exception):
@@ -117,12 +313,13 @@ class SharedAsyncGeneratorManager(ABC, Generic[T_ID, T_ITEM]):
     async def _on_consumers_changed(self, identifier: T_ID,
                                     holder: _AgenHolder,
                                     consumers: int):
-        if identifier in self._running_holders and consumers == 0:
+        if self._running_holders.get(identifier) is holder and consumers == 0:
             del self._running_holders[identifier]
 
             if identifier in self._expires_time:
                 del self._expires_time[identifier]
 
+            self._release(holder)
             await holder.aclose()
             logger.debug(f"[{self.log_tag}] {identifier} cannot be reused "
                          "(the origin agen hasn't stopped when all consumers exited)")
@@ -130,10 +327,12 @@ class SharedAsyncGeneratorManager(ABC, Generic[T_ID, T_ITEM]):
     async def invalidate(self, identifier: T_ID):
         if identifier in self._stopped_holders:
             logger.debug(f"[{self.log_tag}] {identifier} was invalidated from cached state")
-            del self._stopped_holders[identifier]
+            holder = self._stopped_holders.pop(identifier)
+            self._release(holder)
         elif identifier in self._running_holders:
             logger.debug(f"[{self.log_tag}] {identifier} was invalidated from running state")
             holder = self._running_holders.pop(identifier)
+            self._release(holder)
             await holder.aclose()
 
             if identifier in self._expires_time:
@@ -147,13 +346,20 @@ class SharedAsyncGeneratorManager(ABC, Generic[T_ID, T_ITEM]):
         for k in keys:
             await self.invalidate(k)
 
+    def _get_cached(self, identifier: T_ID) -> Optional[_AgenHolder]:
+        holder = self._stopped_holders.get(identifier, None)
+        if holder is not None and holder.expires <= time.time():
+            del self._stopped_holders[identifier]
+            self._release(holder)
+            return None
+        return holder
+
     def get_expires_time(self, identifier: T_ID) -> Optional[float]:
-        if identifier in self._stopped_holders:
-            t = self._stopped_holders.__getitem(identifier).expires
-            return t
+        holder = self._get_cached(identifier)
+        if holder is not None:
+            return holder.expires
         elif identifier in self._running_holders:
-            t = self._expires_time.get(identifier, None)
-            return t
+            return self._expires_time.get(identifier, None)
         else:
             return None
 
@@ -166,14 +372,8 @@ class SharedAsyncGeneratorManager(ABC, Generic[T_ID, T_ITEM]):
             return
 
         if identifier in self._stopped_holders:
-            holder = self._stopped_holders.pop(identifier)
-
-            if expires_time > now:
-                self._expires_time[identifier] = expires_time
-                self._stopped_holders[identifier] = holder
-                del self._expires_time[identifier]
-
-                logger.debug(f"[{self.log_tag}] {identifier} will expires at {expires_time}")
+            self._stopped_holders[identifier].expires = expires_time
+            logger.debug(f"[{self.log_tag}] {identifier} will expires at {expires_time}")
         elif identifier in self._running_holders:
             self._expires_time[identifier] = expires_time
             logger.debug(f"[{self.log_tag}] {identifier} will expire at {expires_time}")
@@ -187,8 +387,10 @@ class SharedAsyncGeneratorManager(ABC, Generic[T_ID, T_ITEM]):
         if cache_strategy == CacheStrategy.FORCE_EXPIRATION:
             await self.invalidate(identifier)
 
-        holder = self._stopped_holders.get(identifier, None)
-        if holder is None:
+        holder = self._get_cached(identifier)
+        if holder is not None:
+            self._stopped_holders.move_to_end(identifier)
+        else:
             holder = self._running_holders.get(identifier, None)
             if holder is None:
                 origin = self.agen(identifier, cache_strategy, **kwargs)
@@ -200,4 +402,4 @@ class SharedAsyncGeneratorManager(ABC, Generic[T_ID, T_ITEM]):
             yield x
 
 
-__all__ = ("SharedAsyncGeneratorManager",)
+__all__ = ("SharedAsyncGeneratorManager", "SharedAgenStats", "estimate_size")
@@ -0,0 +1,121 @@
+import re
+import unicodedata
+from collections import OrderedDict, Counter
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+_IGNORED = re.compile(r"[\s\W_]+")
+
+
+def normalize_tag(word: str) -> str:
+    """
+    全半角、大小写统一，去掉空白与标点（只由标点组成的标签保留原样）
+    """
+    word = unicodedata.normalize("NFKC", word).casefold()
+    return _IGNORED.sub("", word) or word
+
+
+def _grams(term: str) -> Set[str]:
+    # 首尾加上标记后取bigram，使首尾字符也有足够的权重
+    term = f"^{term}$"
+    return {term[i:i + 2] for i in range(len(term) - 1)}
+
+
+def _max_typos(word: str) -> int:
+    # 每4个字符允许一处差异，至少一处
+    return max(1, len(word) // 4)
+
+
+def _edit_distance(a: str, b: str) -> int:
+    if len(a) < len(b):
+        a, b = b, a
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+
+@dataclass
+class _Entry:
+    name: str
+    grams: Set[str]
+    popularity: int = 0
+
+
+class TagSearchIndex:
+    """
+    标签的模糊搜索索引（bigram倒排索引），按最近使用淘汰
+    每个词条（标签名或翻译，归一化后）指向一个标签名，并记录该标签的热度
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._postings: Dict[str, Set[str]] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, term: str, name: str, hits: int = 0):
+        term = normalize_tag(term)
+        entry = self._entries.get(term)
+        if entry is None:
+            entry = _Entry(name, _grams(term))
+            self._entries[term] = entry
+            for g in entry.grams:
+                self._postings.setdefault(g, set()).add(term)
+
+            while len(self._entries) > self.maxsize:
+                self._remove(*self._entries.popitem(last=False))
+        else:
+            entry.name = name
+            self._entries.move_to_end(term)
+
+        entry.popularity += hits
+
+    def _remove(self, term: str, entry: _Entry):
+        for g in entry.grams:
+            postings = self._postings.get(g)
+            if postings is not None:
+                postings.discard(term)
+                if len(postings) == 0:
+                    del self._postings[g]
+
+    def search(self, word: str, threshold: float, limit: int = 5) -> List[Tuple[str, float]]:
+        """
+        :return: [(标签名, 相似度)]，按相似度、热度降序排列，同一个标签只出现一次
+        """
+        word = normalize_tag(word)
+        entry = self._entries.get(word)
+        if entry is not None:
+            return [(entry.name, 1.0)]
+
+        grams = _grams(word)
+        shared = Counter()
+        for g in grams:
+            shared.update(self._postings.get(g, ()))
+
+        best: Dict[str, Tuple[float, int]] = {}
+        for term, n in shared.items():
+            entry = self._entries[term]
+            # Dice系数，并且只接受拼写错误程度的差异（较短的关键字不会匹配到以其为前缀的较长的标签）
+            score = 2 * n / (len(grams) + len(entry.grams))
+            if score < threshold or _edit_distance(word, term) > _max_typos(word):
+                continue
+
+            old = best.get(entry.name)
+            if old is None or (score, entry.popularity) > old:
+                best[entry.name] = (score, entry.popularity)
+
+        result = sorted(best.items(), key=lambda x: x[1], reverse=True)[:limit]
+        return [(name, score) for name, (score, _) in result]
+
+    def best_match(self, word: str, threshold: float) -> Optional[str]:
+        result = self.search(word, threshold, limit=1)
+        return result[0][0] if len(result) > 0 else None
+
+
+__all__ = ("TagSearchIndex", "normalize_tag")
@@ -0,0 +1,65 @@
+import pytest
+
+from tests import MyTest
+
+
+class TestCodec(MyTest):
+    @pytest.fixture
+    def illust_obj(self):
+        return {
+            "id": 123, "title": "title", "type": "illust", "caption": "",
+            "image_urls": {"square_medium": "a", "medium": "b", "large": "c"},
+            "user": {"id": 1, "name": "name", "account": "account"},
+            "tags": [{"name": "tag", "translated_name": "标签"}, {"name": "tag2"}],
+            "create_date": "2023-01-01T00:00:00+09:00", "page_count": 2,
+            "meta_single_page": {},
+            "meta_pages": [{"image_urls": {"square_medium": "a", "medium": "b", "large": "c", "original": "d"}}] * 2,
+            "total_view": 0, "total_bookmarks": 0,
+        }
+
+    @pytest.mark.parametrize("codec_name", ["json", "orjson", "msgpack"])
+    def test_round_trip(self, illust_obj, codec_name):
+        if codec_name != "json":
+            # 未安装时get_codec会回退到json，需要跳过而不是测试回退后的结果
+            pytest.importorskip(codec_name)
+
+        from nonebot_plugin_pixivbot.data.pixiv_repo.local_repo.codec import get_codec, encode_model, decode_model, \
+            encode_models, decode_models
+        from nonebot_plugin_pixivbot.model import Illust
+
+        codec = get_codec(codec_name)
+        illust = Illust.parse_obj(illust_obj)
+
+        assert decode_model(Illust, encode_model(illust, codec)) == illust
+        assert decode_models(Illust, encode_models([illust, illust], codec)) == [illust, illust]
+
+    def test_construct(self, illust_obj):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.local_repo.codec import construct_model
+        from nonebot_plugin_pixivbot.model import Illust
+
+        illust = construct_model(Illust, illust_obj)
+        assert illust == Illust.parse_obj(illust_obj)
+        assert illust.create_date == Illust.parse_obj(illust_obj).create_date
+        assert illust.meta_pages[1].image_urls.original == "d"
+        assert illust.tags[1].translated_name is None
+
+        del illust_obj["user"]
+        with pytest.raises(ValueError):
+            construct_model(Illust, illust_obj)
+
+    def test_legacy_json(self, illust_obj):
+        import json
+        from nonebot_plugin_pixivbot.data.pixiv_repo.local_repo.codec import decode_model
+        from nonebot_plugin_pixivbot.model import Illust
+
+        # 没有标记的JSON（切换为codec之前写入的缓存）
+        illust = decode_model(Illust, json.dumps(illust_obj).encode("utf-8"))
+        assert illust.id == 123
+
+    def test_decode_many(self, illust_obj):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.local_repo.codec import get_codec, encode_models, decode_models
+        from nonebot_plugin_pixivbot.model import Illust
+
+        # 整批解码与逐个解析并校验的结果相同
+        illusts = [Illust.parse_obj({**illust_obj, "id": i}) for i in range(1000)]
+        assert decode_models(Illust, encode_models(illusts, get_codec("orjson"))) == illusts
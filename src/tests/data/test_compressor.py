@@ -0,0 +1,95 @@
+from io import BytesIO
+
+import pytest
+
+from tests import MyTest
+
+
+def make_image(size=(2000, 1000), format="PNG") -> bytes:
+    from PIL import Image
+
+    with BytesIO() as bio:
+        Image.new("RGB", size, (255, 0, 0)).save(bio, format=format)
+        return bio.getvalue()
+
+
+class TestCompressor(MyTest):
+    @pytest.fixture
+    def compressor_factory(self, monkeypatch):
+        from nonebot_plugin_pixivbot.config import Config
+        from nonebot_plugin_pixivbot.data.pixiv_repo.compressor import Compressor
+        from nonebot_plugin_pixivbot.global_context import context
+
+        conf = context.require(Config)
+        created = []
+
+        def factory(**kwargs):
+            monkeypatch.setattr(conf, "pixiv_compression_enabled", True)
+            monkeypatch.setattr(conf, "pixiv_compression_workers", 1)
+            for k, v in kwargs.items():
+                monkeypatch.setattr(conf, f"pixiv_compression_{k}", v)
+            compressor = Compressor()
+            created.append(compressor)
+            return compressor
+
+        yield factory
+
+        for x in created:
+            x._executor.shutdown(wait=True)
+
+    @pytest.mark.asyncio
+    async def test_thread(self, compressor_factory):
+        from PIL import Image
+
+        compressor = compressor_factory(executor="thread", max_size=500)
+        result, stats = await compressor.compress_with_stats(make_image())
+
+        img = Image.open(BytesIO(result))
+        assert img.format == "JPEG"
+        assert img.size == (500, 250)
+        assert stats.output_size == len(result)
+        assert compressor.stats.jobs == 1
+
+    @pytest.mark.asyncio
+    async def test_process(self, compressor_factory):
+        from PIL import Image
+
+        import sys
+
+        # 工作进程不以fork方式启动，需要能够在不导入插件的情况下导入压缩函数
+        compressor = compressor_factory(executor="process", max_size=500)
+        assert not any(p.endswith("compress_worker") for p in sys.path)
+        assert compressor._executor._mp_context.get_start_method() != "fork"
+
+        result = await compressor.compress(make_image())
+        assert Image.open(BytesIO(result)).size == (500, 250)
+
+    @pytest.mark.asyncio
+    async def test_format_fallback(self, compressor_factory, monkeypatch):
+        from PIL import Image, features
+
+        compressor = compressor_factory(executor="thread", format="webp")
+        assert compressor.format == "webp"
+        assert Image.open(BytesIO(await compressor.compress(make_image()))).format == "WEBP"
+
+        # Pillow不支持时使用jpeg
+        monkeypatch.setattr(features, "check", lambda feature: False)
+        compressor = compressor_factory(executor="thread", format="avif")
+        assert compressor.format == "jpeg"
+        assert Image.open(BytesIO(await compressor.compress(make_image()))).format == "JPEG"
+
+    @pytest.mark.asyncio
+    async def test_max_pixels(self, compressor_factory, monkeypatch):
+        from PIL import Image
+
+        # 超过max_pixels时原样返回
+        compressor = compressor_factory(executor="thread", max_pixels=1000 * 1000)
+        content = make_image()
+        assert await compressor.compress(content) is content
+        assert compressor.stats.skipped == 1
+
+        # 超过Pillow的上限时open就会失败，同样原样返回
+        monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+        compressor = compressor_factory(executor="thread", max_pixels=0)
+        assert await compressor.compress(content) is content
+        assert compressor.stats.skipped == 1
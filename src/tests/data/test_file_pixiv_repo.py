@@ -0,0 +1,131 @@
+import pytest
+
+from tests import MyTest
+
+
+class TestFilePixivRepo(MyTest):
+    @pytest.fixture
+    def repo(self, tmp_path):
+        from nonebot_plugin_pixivbot.global_context import context
+        from nonebot_plugin_pixivbot.data.pixiv_repo.local_repo.file import FilePixivRepo
+        from nonebot_plugin_pixivbot.utils.blob_store import FileBlobStore
+
+        repo = context.require(FilePixivRepo)
+        repo.root = tmp_path
+        repo._list_keys.clear()
+        repo._image_store = FileBlobStore(tmp_path / "image")
+        return repo
+
+    @staticmethod
+    def make_illust(illust_id: int):
+        from nonebot_plugin_pixivbot.model import Illust
+
+        return Illust.parse_obj({
+            "id": illust_id, "title": "", "type": "illust", "caption": "",
+            "image_urls": {"square_medium": "", "medium": "", "large": ""},
+            "user": {"id": 1, "name": "", "account": ""},
+            "tags": [], "create_date": "2023-01-01T00:00:00+09:00", "page_count": 1,
+            "meta_single_page": {"original_image_url": ""}, "meta_pages": [],
+            "total_view": 0, "total_bookmarks": 0,
+        })
+
+    @pytest.fixture
+    def illust(self):
+        return self.make_illust(123)
+
+    @pytest.mark.asyncio
+    async def test_image_cache_hit(self, repo, illust):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.errors import NoSuchItemError
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.enums import DownloadQuantity
+
+        with pytest.raises(NoSuchItemError):
+            async for _ in repo.image(illust, 0):
+                pass
+
+        metadata = PixivRepoMetadata()
+        await repo.update_image(illust.id, 0, b"image", metadata)
+
+        result = [x async for x in repo.image(illust, 0)]
+        assert result[0].update_time == metadata.update_time
+        assert result[1] == b"image"
+        assert repo._image_store.hits == 1
+        assert repo._image_store.misses == 1
+
+        # 不同尺寸分开缓存
+        with pytest.raises(NoSuchItemError):
+            async for _ in repo.image(illust, 0, DownloadQuantity.large):
+                pass
+
+    @pytest.mark.asyncio
+    async def test_image_cache_expired(self, repo, illust):
+        from datetime import datetime, timezone, timedelta
+        from nonebot_plugin_pixivbot.data.pixiv_repo.errors import CacheExpiredError
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+
+        update_time = datetime.now(timezone.utc) - timedelta(days=30)
+        await repo.update_image(illust.id, 0, b"image", PixivRepoMetadata(update_time=update_time))
+
+        with pytest.raises(CacheExpiredError):
+            async for _ in repo.image(illust, 0):
+                pass
+
+    @pytest.mark.asyncio
+    async def test_list_append(self, repo):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.errors import NoSuchItemError
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+
+        async def read(offset=0):
+            return [x.id async for x in repo.user_bookmarks(1, offset=offset)
+                    if not isinstance(x, PixivRepoMetadata)]
+
+        with pytest.raises(NoSuchItemError):
+            await read()
+
+        assert not await repo.append_user_bookmarks(1, [self.make_illust(i) for i in (3, 4)],
+                                                    PixivRepoMetadata(pages=1))
+        assert not await repo.append_user_bookmarks(1, [self.make_illust(i) for i in (5, 6)],
+                                                    PixivRepoMetadata(pages=2))
+        assert await read() == [3, 4, 5, 6]
+
+        # 在开头追加时保持页内顺序，并且去重
+        assert await repo.append_user_bookmarks(1, [self.make_illust(i) for i in (1, 2, 3)],
+                                                PixivRepoMetadata(pages=2), append_at_begin=True)
+        assert await read() == [1, 2, 3, 4, 5, 6]
+        assert await read(offset=3) == [4, 5, 6]
+        assert await read(offset=1) == [2, 3, 4, 5, 6]
+
+        await repo.invalidate_user_bookmarks(1)
+        with pytest.raises(NoSuchItemError):
+            await read()
+
+    @pytest.mark.asyncio
+    async def test_list_append_concurrently(self, repo):
+        from asyncio import gather
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+
+        # 并发追加到同一个列表时不会覆盖彼此的段
+        await gather(*[repo.append_user_bookmarks(1, [self.make_illust(i)], PixivRepoMetadata(pages=1))
+                       for i in range(10)])
+
+        result = [x.id async for x in repo.user_bookmarks(1) if not isinstance(x, PixivRepoMetadata)]
+        assert sorted(result) == list(range(10))
+
+    @pytest.mark.asyncio
+    async def test_remove_legacy_files(self, repo, tmp_path):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+
+        legacy = [tmp_path / "image" / "1_0.jpg", tmp_path / "image" / "1_0_metadata.json",
+                  tmp_path / "search_illust" / "abc.json", tmp_path / "other" / "recommended_illusts.json"]
+        for file in legacy:
+            file.parent.mkdir(parents=True, exist_ok=True)
+            file.write_text("{}")
+
+        await repo.append_search_illust("abc", [self.make_illust(1)], PixivRepoMetadata(pages=1))
+        await repo.update_illust_detail(self.make_illust(2), PixivRepoMetadata())
+
+        await repo.remove_legacy_files()
+
+        assert not any(x.exists() for x in legacy)
+        assert len([x async for x in repo.search_illust("abc")]) == 3
+        assert len([x async for x in repo.illust_detail(2)]) == 2
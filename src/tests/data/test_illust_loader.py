@@ -0,0 +1,71 @@
+from asyncio import gather, sleep
+
+import pytest
+
+from tests import MyTest
+
+
+class TestIllustDetailLoader(MyTest):
+    @pytest.mark.asyncio
+    async def test_batch(self):
+        from nonebot_plugin_pixivbot.data.pixiv_repo import LazyIllust
+        from nonebot_plugin_pixivbot.data.pixiv_repo.illust_loader import IllustDetailLoader
+        from nonebot_plugin_pixivbot.utils.errors import QueryError
+
+        calls = {"local": [], "remote": [], "running": 0, "max_running": 0}
+
+        class Local:
+            async def illust_details(self, illust_ids):
+                calls["local"].append(sorted(illust_ids))
+                return {x: f"local{x}" for x in illust_ids if x % 2 == 0}
+
+        class Repo:
+            async def illust_detail(self, illust_id):
+                calls["remote"].append(illust_id)
+                calls["running"] += 1
+                calls["max_running"] = max(calls["max_running"], calls["running"])
+                await sleep(0.01)
+                calls["running"] -= 1
+                if illust_id == 5:
+                    raise QueryError("该作品已被删除，或作品ID不存在。")
+                yield f"remote{illust_id}"
+
+        loader = IllustDetailLoader()
+        loader.local = Local()
+        loader.repo = Repo()
+
+        illusts = [LazyIllust(i) for i in [1, 2, 3, 4, 1]]
+        for x in illusts:
+            x.loader = loader
+
+        result = await gather(*[x.get() for x in illusts])
+        assert result == ["remote1", "local2", "remote3", "local4", "remote1"]
+        # 本地缓存只查询一次，未命中的插画并发地查询且不重复
+        assert calls["local"] == [[1, 2, 3, 4]]
+        assert sorted(calls["remote"]) == [1, 3]
+        assert calls["max_running"] == 2
+
+        # 查询失败只影响对应的插画
+        illusts = [LazyIllust(i) for i in [5, 6]]
+        for x in illusts:
+            x.loader = loader
+        result = await gather(*[x.get() for x in illusts], return_exceptions=True)
+        assert isinstance(result[0], QueryError)
+        assert result[1] == "local6"
+
+    @pytest.mark.asyncio
+    async def test_unexpected_error(self, monkeypatch):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.illust_loader import IllustDetailLoader
+
+        loader = IllustDetailLoader()
+
+        async def load_batch(batch):
+            raise RuntimeError()
+
+        monkeypatch.setattr(loader, "_load_batch", load_batch)
+
+        # 批次出现意外的异常时所有请求都失败，而不是一直等待
+        result = await gather(loader.load(1), loader.load(2), return_exceptions=True)
+        assert all(isinstance(x, RuntimeError) for x in result)
+        await sleep(0)
+        assert len(loader._tasks) == 0
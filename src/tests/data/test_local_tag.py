@@ -0,0 +1,82 @@
+import pytest
+import pytest_asyncio
+
+from tests import MyTest
+
+
+class TestLocalTagRepo(MyTest):
+    @pytest_asyncio.fixture
+    async def data_source(self, tmp_path):
+        from nonebot_plugin_pixivbot.config import Config
+        from nonebot_plugin_pixivbot.data.source.sql import DataSource
+        from nonebot_plugin_pixivbot.global_context import context
+
+        conf = context.require(Config)
+        conf.pixiv_sql_conn_url = "sqlite+aiosqlite:///" + str(tmp_path / "pixiv_bot.db")
+
+        data_source = context.require(DataSource)
+        await data_source.initialize()
+        yield data_source
+
+        await data_source.close()
+
+    @staticmethod
+    async def count_rows(data_source) -> int:
+        from sqlalchemy import select, func
+        from nonebot_plugin_pixivbot.data.local_tag import LocalTag
+
+        async with data_source.start_session() as session:
+            return (await session.execute(select(func.count()).select_from(LocalTag))).scalar_one()
+
+    @pytest.mark.asyncio
+    async def test_batched_flush(self, data_source):
+        from nonebot_plugin_pixivbot.data.local_tag import LocalTagRepo
+        from nonebot_plugin_pixivbot.global_context import context
+        from nonebot_plugin_pixivbot.model import Tag
+
+        repo = context.require(LocalTagRepo)
+        await repo.update_many([Tag(name="ラブライブ!", translated_name="LoveLive!"),
+                                Tag(name="唐可可", translated_name="唐可可"),
+                                Tag(name="no_translation")])
+
+        # 尚未写入数据库，但可以从内存中查到
+        assert await self.count_rows(data_source) == 0
+        assert (await repo.find_by_name("ラブライブ!")).translated_name == "LoveLive!"
+        assert (await repo.find_by_translated_name("LoveLive!")).name == "ラブライブ!"
+        assert await repo.find_by_name("no_translation") is None
+
+        await repo.flush()
+        assert await self.count_rows(data_source) == 2
+
+        # 翻译没有变化时不再写入；变化后旧的翻译不再指向该标签
+        await repo.update_one(Tag(name="唐可可", translated_name="唐可可"))
+        assert len(repo._dirty) == 0
+        await repo.update_one(Tag(name="ラブライブ!", translated_name="Love Live!"))
+        assert await repo.find_by_translated_name("LoveLive!") is None
+        assert (await repo.find_by_translated_name("Love Live!")).name == "ラブライブ!"
+
+    @pytest.mark.asyncio
+    async def test_warm_up(self, data_source):
+        from nonebot_plugin_pixivbot.data.local_tag import LocalTagRepo
+        from nonebot_plugin_pixivbot.global_context import context
+        from nonebot_plugin_pixivbot.model import Tag
+
+        repo = context.require(LocalTagRepo)
+        await repo.update_one(Tag(name="唐可可", translated_name="Tang Keke"))
+        # 关闭数据库前写入
+        await data_source.close()
+        await data_source.initialize()
+
+        repo._by_name.clear()
+        repo._by_translated.clear()
+        await repo.warm_up()
+
+        async def fail():
+            raise AssertionError("should not start a session")
+
+        data_source.start_session = fail
+        try:
+            assert (await repo.find_by_name("唐可可")).translated_name == "Tang Keke"
+            assert (await repo.find_by_translated_name("Tang Keke")).name == "唐可可"
+        finally:
+            del data_source.start_session
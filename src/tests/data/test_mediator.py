@@ -0,0 +1,231 @@
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+from tests import MyTest
+
+
+class TestStaleWhileRevalidate(MyTest):
+    @pytest.fixture
+    def single_mediator_factory(self):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.mediator import SingleMediator
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+
+        def factory(age: int, stale_grace: int):
+            calls = {"remote": 0, "update": 0}
+
+            async def cache_factory(kwargs):
+                update_time = datetime.now(timezone.utc) - timedelta(seconds=age)
+                yield PixivRepoMetadata(update_time=update_time).check_is_expired(100)
+                yield "cached"
+
+            async def remote_factory(kwargs):
+                calls["remote"] += 1
+                yield PixivRepoMetadata()
+                yield "remote"
+
+            async def cache_updater(kwargs, data, meta):
+                calls["update"] += 1
+
+            mediator = SingleMediator("test", cache_factory=cache_factory, remote_factory=remote_factory,
+                                      cache_updater=cache_updater, stale_grace=stale_grace)
+            return mediator, calls
+
+        return factory
+
+    @pytest.mark.asyncio
+    async def test_single(self, single_mediator_factory):
+        # 宽限期内：直接返回过期的缓存，元数据标记为stale
+        mediator, calls = single_mediator_factory(age=150, stale_grace=100)
+        result = [x async for x in mediator.mediate({})]
+        assert result[0].stale
+        assert result[1] == "cached"
+        assert calls["remote"] == 0
+
+        # 超出宽限期
+        mediator, calls = single_mediator_factory(age=250, stale_grace=100)
+        result = [x async for x in mediator.mediate({})]
+        assert not result[0].stale
+        assert result[1] == "remote"
+        assert calls["remote"] == 1
+
+        # 宽限期只在读取缓存期间生效
+        from nonebot_plugin_pixivbot.data.pixiv_repo.query_mode import get_stale_grace
+        assert get_stale_grace() == 0
+
+    @pytest.mark.asyncio
+    async def test_many_replace(self):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.errors import CacheExpiredError
+        from nonebot_plugin_pixivbot.data.pixiv_repo.mediator import ManyMediator
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+
+        ops = []
+
+        async def cache_factory(kwargs):
+            raise CacheExpiredError(PixivRepoMetadata())
+            yield
+
+        async def remote_factory(kwargs):
+            ops.append("fetch")
+            for i in range(2):
+                yield i
+                yield PixivRepoMetadata(pages=i + 1)
+
+        async def cache_invalidator(kwargs):
+            ops.append("invalidate")
+
+        async def cache_appender(kwargs, data, meta):
+            ops.append(("append", data))
+
+        mediator = ManyMediator("test", cache_factory=cache_factory, remote_factory=remote_factory,
+                                cache_invalidator=cache_invalidator, cache_appender=cache_appender)
+        result = [x async for x in mediator.mediate({}) if not isinstance(x, PixivRepoMetadata)]
+        assert result == [0, 1]
+        # 获取到第一页之后才使原有的缓存失效
+        assert ops == ["fetch", "invalidate", ("append", [0]), ("append", [1])]
+
+
+    @pytest.mark.asyncio
+    async def test_revalidate_with_kwargs(self, monkeypatch):
+        from asyncio import sleep
+        from nonebot_plugin_pixivbot.data.pixiv_repo.enums import PixivResType, CacheStrategy
+        from nonebot_plugin_pixivbot.data.pixiv_repo.mediator_repo import PixivSharedAsyncGeneratorManager, \
+            SharedAgenIdentifier
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+
+        calls = []
+
+        async def image_factory(self, illust_id, illust, page, quantity, cache_strategy):
+            calls.append((cache_strategy, illust))
+            metadata = PixivRepoMetadata()
+            metadata._stale = cache_strategy == CacheStrategy.NORMAL
+            yield metadata
+            yield b"image"
+
+        manager = PixivSharedAsyncGeneratorManager()
+        monkeypatch.setitem(manager.factories, PixivResType.IMAGE, image_factory)
+
+        identifier = SharedAgenIdentifier(PixivResType.IMAGE, illust_id=1, page=0, quantity="original")
+        async with manager.get(identifier, illust="illust") as gen:
+            assert [x async for x in gen][-1] == b"image"
+
+        while len(manager._revalidating) != 0:
+            await sleep(0.01)
+
+        # 后台刷新时传入get()时的额外参数
+        assert calls == [(CacheStrategy.NORMAL, "illust"), (CacheStrategy.FORCE_EXPIRATION, "illust")]
+        assert manager._running_kwargs == {}
+
+class TestNegativeCache(MyTest):
+    @pytest.mark.asyncio
+    async def test_single(self):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.errors import NoSuchItemError
+        from nonebot_plugin_pixivbot.data.pixiv_repo.mediator import SingleMediator
+        from nonebot_plugin_pixivbot.utils.errors import QueryError, ResourceGoneError
+
+        negative = {}
+        calls = {"remote": 0}
+
+        async def cache_factory(kwargs):
+            raise NoSuchItemError()
+            yield
+
+        async def remote_factory(kwargs):
+            calls["remote"] += 1
+            raise ResourceGoneError("该作品已被删除，或作品ID不存在。")
+            yield
+
+        async def negative_loader(kwargs):
+            return negative.get(kwargs["illust_id"])
+
+        async def negative_updater(kwargs, reason):
+            negative[kwargs["illust_id"]] = reason
+
+        async def cache_updater(kwargs, data, meta):
+            pass
+
+        mediator = SingleMediator("test", cache_factory=cache_factory, remote_factory=remote_factory,
+                                  cache_updater=cache_updater,
+                                  negative_loader=negative_loader, negative_updater=negative_updater)
+
+        for _ in range(3):
+            with pytest.raises(QueryError) as e:
+                _ = [x async for x in mediator.mediate({"illust_id": 1})]
+            assert str(e.value) == "该作品已被删除，或作品ID不存在。"
+
+        # 只有第一次向远程查询
+        assert calls["remote"] == 1
+
+        with pytest.raises(QueryError):
+            _ = [x async for x in mediator.mediate({"illust_id": 1}, force_expiration=True)]
+        assert calls["remote"] == 2
+
+    @pytest.mark.asyncio
+    async def test_single_transient_error(self):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.errors import NoSuchItemError
+        from nonebot_plugin_pixivbot.data.pixiv_repo.mediator import SingleMediator
+        from nonebot_plugin_pixivbot.utils.errors import QueryError, RateLimitError
+
+        negative = {}
+        calls = {"remote": 0}
+
+        async def cache_factory(kwargs):
+            raise NoSuchItemError()
+            yield
+
+        async def remote_factory(kwargs):
+            calls["remote"] += 1
+            if calls["remote"] % 2 == 1:
+                raise QueryError("Cannot connect to host app-api.pixiv.net")
+            raise RateLimitError()
+            yield
+
+        async def negative_loader(kwargs):
+            return negative.get(kwargs["illust_id"])
+
+        async def negative_updater(kwargs, reason):
+            negative[kwargs["illust_id"]] = reason
+
+        async def cache_updater(kwargs, data, meta):
+            pass
+
+        mediator = SingleMediator("test", cache_factory=cache_factory, remote_factory=remote_factory,
+                                  cache_updater=cache_updater,
+                                  negative_loader=negative_loader, negative_updater=negative_updater)
+
+        for _ in range(4):
+            with pytest.raises(QueryError):
+                _ = [x async for x in mediator.mediate({"illust_id": 1})]
+
+        # 暂时性的错误不记录，每次都向远程查询
+        assert calls["remote"] == 4
+        assert negative == {}
+
+    @pytest.mark.asyncio
+    async def test_shared_agen(self, monkeypatch):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.enums import PixivResType
+        from nonebot_plugin_pixivbot.data.pixiv_repo.mediator_repo import PixivSharedAsyncGeneratorManager, \
+            SharedAgenIdentifier
+        from nonebot_plugin_pixivbot.utils.errors import QueryError, ResourceGoneError
+
+        errors = {1: ResourceGoneError("该作品已被删除，或作品ID不存在。"),
+                  2: QueryError("Cannot connect to host app-api.pixiv.net")}
+        calls = []
+
+        async def illust_detail_factory(self, illust_id, cache_strategy):
+            calls.append(illust_id)
+            raise errors[illust_id]
+            yield
+
+        manager = PixivSharedAsyncGeneratorManager()
+        monkeypatch.setitem(manager.factories, PixivResType.ILLUST_DETAIL, illust_detail_factory)
+
+        for illust_id in (1, 2):
+            identifier = SharedAgenIdentifier(PixivResType.ILLUST_DETAIL, illust_id=illust_id)
+            for _ in range(2):
+                with pytest.raises(QueryError):
+                    async with manager.get(identifier) as gen:
+                        _ = [x async for x in gen]
+
+        # 只有资源不存在的错误被记录
+        assert calls == [1, 2, 2]
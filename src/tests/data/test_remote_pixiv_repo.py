@@ -0,0 +1,157 @@
+import asyncio
+
+import pytest
+
+from tests import MyTest
+
+
+class TestRemotePixivRepo(MyTest):
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("prefetch_pages", [0, 1])
+    async def test_load_many_pages_without_kwargs(self, prefetch_pages, monkeypatch):
+        from nonebot_plugin_pixivbot.config import Config
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.data.pixiv_repo.remote_repo import RemotePixivRepo
+        from nonebot_plugin_pixivbot.global_context import context
+
+        monkeypatch.setattr(context.require(Config), "pixiv_query_prefetch_pages", prefetch_pages)
+
+        calls = []
+
+        async def load_page(papi_search_func, element_list_name, *, mapper=None, filter_item=None, **kwargs):
+            calls.append(kwargs)
+            offset = kwargs.get("offset", 0)
+            next_qs = {"offset": offset + 1} if offset < 2 else None
+            return [offset], PixivRepoMetadata(next_qs=next_qs)
+
+        repo = context.require(RemotePixivRepo)
+        monkeypatch.setattr(repo, "_load_page", load_page)
+
+        # 与recommended_illusts一样不带参数时也要加载第一页
+        pages = [page async for page, _ in repo._load_many_pages(None, "illusts")]
+        assert pages == [[0], [1], [2]]
+        assert calls == [{}, {"offset": 1}, {"offset": 2}]
+
+    @pytest.mark.asyncio
+    async def test_image_fallback_quantity(self, monkeypatch):
+        from contextlib import asynccontextmanager
+        from nonebot_plugin_pixivbot.config import Config
+        from nonebot_plugin_pixivbot.data.pixiv_repo import mediator_repo
+        from nonebot_plugin_pixivbot.data.pixiv_repo import remote_repo
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.enums import DownloadQuantity
+        from nonebot_plugin_pixivbot.global_context import context
+        from nonebot_plugin_pixivbot.model import Illust
+
+        monkeypatch.setattr(context.require(Config), "pixiv_download_original_max_bytes", 100)
+
+        class Sema:
+            @asynccontextmanager
+            async def use(self, lane):
+                yield
+
+        async def download(url, max_bytes=0):
+            if url.endswith("original"):
+                raise remote_repo._ImageTooLargeError(max_bytes)
+            return b"large"
+
+        repo = context.require(remote_repo.RemotePixivRepo)
+        monkeypatch.setattr(repo, "_sema", Sema())
+        monkeypatch.setattr(repo, "_download", download)
+        monkeypatch.setattr(repo, "_image_url", lambda illust, page, quantity: quantity.value)
+
+        illust = Illust.construct(id=1)
+        result = [x async for x in repo.image(illust, 0, DownloadQuantity.original)]
+        assert result[1] == b"large"
+        assert result[0].quantity == DownloadQuantity.large
+
+        # 按实际下载的质量写入缓存，并记录原图过大
+        updated = []
+        negative = {}
+
+        async def update_image(illust_id, page, content, metadata, quantity):
+            updated.append(quantity)
+
+        async def update_negative_result(res_type, id, reason):
+            negative[(res_type, id)] = reason
+
+        async def negative_result(res_type, id):
+            return negative.get((res_type, id))
+
+        monkeypatch.setattr(mediator_repo.local, "update_image", update_image)
+        monkeypatch.setattr(mediator_repo.local, "update_negative_result", update_negative_result)
+        monkeypatch.setattr(mediator_repo.local, "negative_result", negative_result)
+
+        mediator = mediator_repo.PixivSharedAsyncGeneratorManager.mediators["image"]
+        kwargs = {"illust": illust, "page": 0, "quantity": DownloadQuantity.original}
+        await mediator.cache_updater(kwargs, b"large", result[0])
+        assert updated == [DownloadQuantity.large]
+        assert negative == {("original_too_large_0", 1): "100"}
+
+        # 之后读取缓存与下载时直接使用large
+        assert await mediator_repo._image_quantity(kwargs) == DownloadQuantity.large
+        assert await mediator_repo._image_quantity({**kwargs, "page": 1}) == DownloadQuantity.original
+
+        # 上限调大或取消后重新尝试原图
+        monkeypatch.setattr(context.require(Config), "pixiv_download_original_max_bytes", 1000)
+        assert await mediator_repo._image_quantity(kwargs) == DownloadQuantity.original
+        monkeypatch.setattr(context.require(Config), "pixiv_download_original_max_bytes", 0)
+        assert await mediator_repo._image_quantity(kwargs) == DownloadQuantity.original
+
+        await mediator.cache_updater(kwargs, b"original", PixivRepoMetadata())
+        assert updated == [DownloadQuantity.large, DownloadQuantity.original]
+
+    @pytest.mark.asyncio
+    async def test_download_retry(self, monkeypatch):
+        import aiohttp
+        from nonebot_plugin_pixivbot.data.pixiv_repo import remote_repo
+        from nonebot_plugin_pixivbot.global_context import context
+        from nonebot_plugin_pixivbot.utils.errors import QueryError
+
+        monkeypatch.setattr(remote_repo, "_DOWNLOAD_RETRY_COOLDOWN", 0)
+        repo = context.require(remote_repo.RemotePixivRepo)
+
+        errors = []
+
+        async def download_once(url, max_bytes):
+            if len(errors) > 0:
+                raise errors.pop(0)
+            return b"image"
+
+        monkeypatch.setattr(repo, "_download_once", download_once)
+
+        # 网络错误与超时重试
+        errors.extend([aiohttp.ClientConnectionError(), asyncio.TimeoutError()])
+        assert await repo._download("url") == b"image"
+
+        errors.extend([aiohttp.ClientConnectionError()] * (remote_repo._DOWNLOAD_RETRIES + 1))
+        with pytest.raises(aiohttp.ClientConnectionError):
+            await repo._download("url")
+        assert len(errors) == 0
+
+        # 图片过大与HTTP错误不重试
+        errors.extend([remote_repo._ImageTooLargeError(100), b"unused"])
+        with pytest.raises(remote_repo._ImageTooLargeError):
+            await repo._download("url", 100)
+        assert len(errors) == 1
+        errors.clear()
+
+        errors.extend([QueryError("下载图片失败（HTTP 404）"), b"unused"])
+        with pytest.raises(QueryError):
+            await repo._download("url")
+        assert len(errors) == 1
+
+    def test_check_error_in_raw_result(self):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.remote_repo import RemotePixivRepo
+        from nonebot_plugin_pixivbot.utils.errors import QueryError, RateLimitError, ResourceGoneError
+
+        def make_error(user_message="", message=""):
+            return {"error": {"user_message": user_message, "message": message, "reason": ""}}
+
+        with pytest.raises(RateLimitError):
+            RemotePixivRepo._check_error_in_raw_result(make_error(message="Rate Limit"))
+        with pytest.raises(ResourceGoneError):
+            RemotePixivRepo._check_error_in_raw_result(make_error(user_message="该作品已被删除，或作品ID不存在。"))
+        with pytest.raises(QueryError) as e:
+            RemotePixivRepo._check_error_in_raw_result(make_error(message="Error occurred at the OAuth process."))
+        assert not isinstance(e.value, ResourceGoneError)
@@ -0,0 +1,71 @@
+import sqlite3
+
+import pytest
+
+from tests import MyTest
+
+# v5（迁移前）的缓存表结构
+_V5_SCHEMA = """
+create table meta_info (key VARCHAR not null primary key, value VARCHAR not null);
+insert into meta_info (key, value) values ('db_version', '5');
+create table subscription (id INTEGER not null primary key);
+create table download_cache (
+    illust_id INTEGER not null, page INTEGER not null, content BLOB not null, update_time DATETIME not null,
+    primary key (illust_id, page)
+);
+create table illust_detail_cache (illust_id INTEGER not null primary key, illust JSON not null,
+                                  update_time DATETIME not null);
+create table user_detail_cache (user_id INTEGER not null primary key, user JSON not null,
+                                update_time DATETIME not null);
+create table illust_set_cache (
+    id INTEGER not null primary key autoincrement, cache_type VARCHAR not null, key JSON not null,
+    update_time DATETIME not null, pages INTEGER, next_qs JSON, size INTEGER not null,
+    unique (cache_type, key)
+);
+create table illust_set_cache_illust (
+    cache_id INTEGER not null references illust_set_cache (id) on delete cascade, illust_id INTEGER not null,
+    rank INTEGER not null, primary key (cache_id, illust_id)
+);
+create table user_set_cache (
+    id INTEGER not null primary key autoincrement, cache_type VARCHAR not null, key JSON not null,
+    update_time DATETIME not null, pages INTEGER, next_qs JSON,
+    unique (cache_type, key)
+);
+create table user_set_cache_user (
+    cache_id INTEGER not null references user_set_cache (id) on delete cascade, user_id INTEGER not null,
+    primary key (cache_id, user_id)
+);
+insert into illust_set_cache (cache_type, key, update_time, size)
+values ('search_illust', '{"word": "abc"}', '2023-01-01 00:00:00', 0);
+"""
+
+
+class TestSqlMigration(MyTest):
+    @pytest.mark.asyncio
+    async def test_migrate_from_v5(self, tmp_path):
+        from sqlalchemy import select
+        from nonebot_plugin_pixivbot.config import Config
+        from nonebot_plugin_pixivbot.data.pixiv_repo.local_repo.sql_models import DownloadCache
+        from nonebot_plugin_pixivbot.data.source.sql import DataSource
+        from nonebot_plugin_pixivbot.global_context import context
+
+        db = tmp_path / "pixiv_bot.db"
+        with sqlite3.connect(db) as conn:
+            conn.executescript(_V5_SCHEMA)
+
+        conf = context.require(Config)
+        conf.pixiv_sql_conn_url = "sqlite+aiosqlite:///" + str(db)
+
+        data_source = context.require(DataSource)
+        await data_source.initialize()
+        try:
+            # download_cache按新的结构重建
+            async with data_source.start_session() as session:
+                assert (await session.execute(select(DownloadCache))).all() == []
+        finally:
+            await data_source.close()
+
+        with sqlite3.connect(db) as conn:
+            assert conn.execute("select value from meta_info where key = 'db_version'").fetchone() == ("10",)
+            columns = {x[1] for x in conn.execute("pragma table_info(download_cache)")}
+            assert {"quantity", "size", "digest"} <= columns
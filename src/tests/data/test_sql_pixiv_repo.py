@@ -0,0 +1,465 @@
+import pytest
+import pytest_asyncio
+
+from tests import MyTest
+
+
+class TestSqlPixivRepo(MyTest):
+    @pytest_asyncio.fixture
+    async def repo(self, tmp_path):
+        from nonebot_plugin_pixivbot.config import Config
+        from nonebot_plugin_pixivbot.data.source.sql import DataSource
+        from nonebot_plugin_pixivbot.data.pixiv_repo.local_repo.sql import SqlPixivRepo
+        from nonebot_plugin_pixivbot.global_context import context
+        from nonebot_plugin_pixivbot.utils.blob_store import FileBlobStore
+
+        conf = context.require(Config)
+        conf.pixiv_sql_conn_url = "sqlite+aiosqlite:///" + str(tmp_path / "pixiv_bot.db")
+
+        data_source = context.require(DataSource)
+        await data_source.initialize()
+
+        repo = context.require(SqlPixivRepo)
+        repo._image_store = FileBlobStore(tmp_path / "image")
+        yield repo
+
+        await data_source.close()
+
+    @staticmethod
+    def make_illust(illust_id: int):
+        from nonebot_plugin_pixivbot.model import Illust
+
+        return Illust.parse_obj({
+            "id": illust_id, "title": "", "type": "illust", "caption": "",
+            "image_urls": {"square_medium": "", "medium": "", "large": ""},
+            "user": {"id": 1, "name": "", "account": ""},
+            "tags": [{"name": f"tag{illust_id}", "translated_name": f"标签{illust_id}"}],
+            "create_date": "2023-01-01T00:00:00+09:00", "page_count": 1,
+            "meta_single_page": {"original_image_url": ""}, "meta_pages": [],
+            "total_view": 0, "total_bookmarks": 0,
+        })
+
+    @pytest.mark.asyncio
+    async def test_append(self, repo):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+
+        metadata = PixivRepoMetadata(pages=1)
+        assert not await repo.append_user_illusts(1, [self.make_illust(i) for i in range(3, 6)], metadata)
+        assert await repo.append_user_illusts(1, [self.make_illust(i) for i in range(5, 8)], metadata)
+        assert await repo.append_user_illusts(1, [self.make_illust(i) for i in [1, 2, 3]], metadata,
+                                              append_at_begin=True)
+
+        result = [x async for x in repo.user_illusts(1)]
+        assert [x.id for x in result[1:-1]] == [1, 2, 3, 4, 5, 6, 7]
+        assert all(x.loaded for x in result[1:-1])
+
+    @pytest.mark.asyncio
+    async def test_statements_per_page(self, repo):
+        from sqlalchemy import event
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.global_context import context
+        from nonebot_plugin_pixivbot.data.source.sql import DataSource
+
+        statements = []
+
+        def on_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = context.require(DataSource).engine.sync_engine
+        event.listen(engine, "before_cursor_execute", on_execute)
+        try:
+            counts = []
+            for page, size in enumerate([30, 60]):
+                statements.clear()
+                illusts = [self.make_illust(page * 100 + i) for i in range(size)]
+                await repo.append_search_illust("word", illusts, PixivRepoMetadata(pages=page + 1))
+                counts.append(len(statements))
+        finally:
+            event.remove(engine, "before_cursor_execute", on_execute)
+
+        # 原先每个插画各需要两条语句（插入集合、更新详情），一页30个插画需要60条以上
+        assert counts[0] == counts[1]
+        assert counts[0] < 15
+
+    @pytest.mark.asyncio
+    async def test_light_query(self, repo):
+        from sqlalchemy import event
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.data.pixiv_repo.query_mode import use_light_query
+        from nonebot_plugin_pixivbot.data.source.sql import DataSource
+        from nonebot_plugin_pixivbot.global_context import context
+
+        illusts = [self.make_illust(i) for i in range(100)]
+        await repo.append_user_bookmarks(1, illusts, PixivRepoMetadata(pages=1))
+
+        statements = []
+
+        def on_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = context.require(DataSource).engine.sync_engine
+        event.listen(engine, "before_cursor_execute", on_execute)
+        try:
+            full = [x async for x in repo.user_bookmarks(1)][1:-1]
+            assert not any("illust_light_cache" in x for x in statements)
+
+            statements.clear()
+            with use_light_query():
+                light = [x async for x in repo.user_bookmarks(1)][1:-1]
+            # 只查询投影（缺少投影时才读取完整的插画）
+            assert any("illust_light_cache.total_bookmarks" in x for x in statements)
+        finally:
+            event.remove(engine, "before_cursor_execute", on_execute)
+
+        assert [x.id for x in light] == [x.id for x in full]
+        assert all(x.loaded for x in full)
+        assert not any(x.loaded for x in light)
+        assert light[5].light == full[5].light
+        assert light[5].light.has_tag("标签5")
+        assert light[5].create_date == illusts[5].create_date
+
+    @pytest.mark.asyncio
+    async def test_keyset_batches(self, repo, monkeypatch):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.local_repo import sql
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.data.pixiv_repo.query_mode import use_light_query
+
+        monkeypatch.setattr(sql, "_STREAM_BATCH_SIZE", 3)
+
+        await repo.append_user_illusts(1, [self.make_illust(i) for i in range(5, 11)], PixivRepoMetadata(pages=1))
+        await repo.append_user_illusts(1, [self.make_illust(i) for i in range(1, 5)], PixivRepoMetadata(pages=1),
+                                       append_at_begin=True)
+
+        # 跨越多个批次，且第一批从offset开始
+        for offset in [0, 2, 3, 9, 10]:
+            result = [x async for x in repo.user_illusts(1, offset=offset)][1:-1]
+            assert [x.id for x in result] == list(range(offset + 1, 11))
+
+            with use_light_query():
+                result = [x async for x in repo.user_illusts(1, offset=offset)][1:-1]
+            assert [x.id for x in result] == list(range(offset + 1, 11))
+
+    @pytest.mark.asyncio
+    async def test_migrate_key_hash(self, repo):
+        from sqlalchemy import text
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.data.source.sql import DataSource
+        from nonebot_plugin_pixivbot.data.utils.sql import hash_key
+        from nonebot_plugin_pixivbot.global_context import context
+
+        await repo.append_user_illusts(1, [self.make_illust(i) for i in range(3)], PixivRepoMetadata(pages=1))
+
+        # 退回v8的表结构，并插入两个只有字段顺序不同的键
+        data_source = context.require(DataSource)
+        async with data_source.engine.begin() as conn:
+            for table in ["illust_set_cache", "user_set_cache"]:
+                await conn.execute(text(f"drop index ix_{table}_cache_type_key_hash;"))
+                await conn.execute(text(f"alter table {table} drop column key_hash;"))
+            for i, key in enumerate(['{"a": 1, "b": 2}', '{"b": 2, "a": 1}']):
+                await conn.execute(text("insert into illust_set_cache (cache_type, key, update_time, size) "
+                                        "values ('test', :key, :update_time, 0);"),
+                                   {"key": key, "update_time": f"2023-01-0{i + 1} 00:00:00"})
+            await conn.execute(text("update meta_info set value = '8' where key = 'db_version';"))
+        await data_source.close()
+        await data_source.initialize()
+
+        result = [x async for x in repo.user_illusts(1)][1:-1]
+        assert [x.id for x in result] == [0, 1, 2]
+
+        async with data_source.engine.begin() as conn:
+            rows = (await conn.execute(text("select key_hash from illust_set_cache "
+                                            "where cache_type = 'test';"))).all()
+        assert rows == [(hash_key({"a": 1, "b": 2}),)]
+
+    @pytest.mark.asyncio
+    async def test_clean_expired(self, repo, monkeypatch):
+        from datetime import datetime, timedelta, timezone
+        from nonebot_plugin_pixivbot.config import Config
+        from nonebot_plugin_pixivbot.data.pixiv_repo.errors import NoSuchItemError
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.global_context import context
+
+        conf = context.require(Config)
+        monkeypatch.setattr(conf, "pixiv_sql_clean_batch_size", 7)
+        monkeypatch.setattr(conf, "pixiv_sql_vacuum", "full")
+
+        expired = PixivRepoMetadata(update_time=datetime.now(timezone.utc) - timedelta(days=365), pages=1)
+        fresh = PixivRepoMetadata(pages=1)
+
+        await repo.append_search_illust("expired", [self.make_illust(i) for i in range(20)], expired)
+        await repo.append_search_illust("fresh", [self.make_illust(i) for i in range(20, 25)], fresh)
+        for page in range(10):
+            await repo.update_image(1, page, b"x" * 100, expired)
+        await repo.update_image(2, 0, b"x" * 100, fresh)
+
+        # 批大小小于待删除的行数，需要分多批完成
+        results = await repo.clean_expired()
+        assert results["search_illust"].rows == 1
+        assert results["illust_detail"].rows == 20
+        assert results["download"].rows == 10
+        assert results["download"].bytes == 1000
+
+        with pytest.raises(NoSuchItemError):
+            [x async for x in repo.search_illust("expired")]
+        assert [x.id for x in [x async for x in repo.search_illust("fresh")][1:-1]] == list(range(20, 25))
+        assert len([x async for x in repo.image(self.make_illust(2))]) == 2
+
+    @pytest.mark.asyncio
+    async def test_clean_expired_with_stale_grace(self, repo, monkeypatch):
+        from datetime import datetime, timedelta, timezone
+        from nonebot_plugin_pixivbot.config import Config
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.data.pixiv_repo.query_mode import use_stale_grace
+        from nonebot_plugin_pixivbot.global_context import context
+
+        conf = context.require(Config)
+        monkeypatch.setattr(conf, "pixiv_cache_stale_grace", {"illust_detail": 3600})
+
+        now = datetime.now(timezone.utc)
+        expires_in = timedelta(seconds=conf.pixiv_illust_detail_cache_expires_in)
+        await repo.update_illust_detail(self.make_illust(1),
+                                        PixivRepoMetadata(update_time=now - expires_in - timedelta(seconds=1800)))
+        await repo.update_illust_detail(self.make_illust(2),
+                                        PixivRepoMetadata(update_time=now - expires_in - timedelta(seconds=7200)))
+
+        # 宽限期内的过期缓存不会被删除
+        assert (await repo.clean_expired())["illust_detail"].rows == 1
+        with use_stale_grace(3600):
+            assert [x async for x in repo.illust_detail(1)][1].id == 1
+
+    @pytest.mark.asyncio
+    async def test_image_in_file(self, repo, tmp_path, monkeypatch):
+        from datetime import datetime
+        from sqlalchemy import text
+        from nonebot_plugin_pixivbot.config import Config
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.data.source.sql import DataSource
+        from nonebot_plugin_pixivbot.data.source.sql.migration import sql_v9_to_v10
+        from nonebot_plugin_pixivbot.global_context import context
+
+        data_source = context.require(DataSource)
+
+        await repo.update_image(1, 0, b"image1", PixivRepoMetadata())
+        assert [x async for x in repo.image(self.make_illust(1))][1] == b"image1"
+
+        # 数据库中只有元数据
+        async with data_source.engine.begin() as conn:
+            row = (await conn.execute(text("select content, size from download_cache;"))).one()
+        assert row == (None, 6)
+
+        # 迁移时把数据库中的图片移动到文件中
+        async with data_source.engine.begin() as conn:
+            await conn.execute(text("insert into download_cache (illust_id, page, quantity, content, update_time) "
+                                    "values (2, 0, 'original', :content, :update_time);"),
+                               {"content": b"image2", "update_time": datetime.utcnow()})
+            await conn.execute(text("update meta_info set value = '9' where key = 'db_version';"))
+        await data_source.close()
+
+        conf = context.require(Config)
+        monkeypatch.setattr(conf, "pixiv_local_cache_type", "sql")
+        monkeypatch.setattr(sql_v9_to_v10, "create_sql_image_store", lambda: repo._image_store)
+        await data_source.initialize()
+
+        async with data_source.engine.begin() as conn:
+            rows = (await conn.execute(text("select illust_id, content from download_cache "
+                                            "order by illust_id;"))).all()
+        assert rows == [(1, None), (2, None)]
+        assert [x async for x in repo.image(self.make_illust(2))][1] == b"image2"
+
+    @pytest.mark.asyncio
+    async def test_read_during_write(self, repo):
+        import asyncio
+        from sqlalchemy import text
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.data.source.sql import DataSource
+        from nonebot_plugin_pixivbot.global_context import context
+
+        data_source = context.require(DataSource)
+        await repo.append_user_illusts(1, [self.make_illust(i) for i in range(3)], PixivRepoMetadata(pages=1))
+
+        async with data_source.engine.connect() as conn:
+            assert (await conn.execute(text("PRAGMA journal_mode;"))).scalar_one() == "wal"
+            assert (await conn.execute(text("PRAGMA foreign_keys;"))).scalar_one() == 1
+
+        async def read():
+            return [x.id for x in [x async for x in repo.user_illusts(1)][1:-1]]
+
+        entered = []
+
+        async def write():
+            async with data_source.start_session(write=True):
+                entered.append(True)
+
+        async with data_source.start_session(write=True) as session:
+            # 未提交的写入事务期间，读取不会被阻塞，也看不到未提交的数据
+            await session.execute(text("delete from illust_set_cache_illust;"))
+            assert await asyncio.wait_for(read(), 5) == [0, 1, 2]
+
+            # 写入是串行的
+            task = asyncio.create_task(write())
+            await asyncio.sleep(0.1)
+            assert not entered
+
+            await session.rollback()
+
+        await task
+        assert entered
+
+    @pytest.mark.asyncio
+    async def test_negative_result(self, repo):
+        from nonebot_plugin_pixivbot.config import Config
+        from nonebot_plugin_pixivbot.global_context import context
+
+        assert await repo.negative_result("illust_detail", 1) is None
+        await repo.update_negative_result("illust_detail", 1, "该作品已被删除，或作品ID不存在。")
+        assert await repo.negative_result("illust_detail", 1) == "该作品已被删除，或作品ID不存在。"
+        assert await repo.negative_result("user_detail", 1) is None
+
+        conf = context.require(Config)
+        conf.pixiv_negative_cache_expires_in = 0
+        assert await repo.negative_result("illust_detail", 1) is None
+        assert (await repo.clean_expired())["negative"].rows == 1
+
+    @pytest.mark.asyncio
+    async def test_illust_details(self, repo):
+        from datetime import datetime, timezone, timedelta
+        from nonebot_plugin_pixivbot.config import Config
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.global_context import context
+
+        conf = context.require(Config)
+        expired = datetime.now(timezone.utc) - timedelta(seconds=conf.pixiv_illust_detail_cache_expires_in + 1)
+
+        for i in range(1, 4):
+            await repo.update_illust_detail(self.make_illust(i), PixivRepoMetadata())
+        await repo.update_illust_detail(self.make_illust(4), PixivRepoMetadata(update_time=expired))
+
+        # 不存在与已过期的插画不包含在结果内
+        result = await repo.illust_details([1, 2, 3, 4, 5])
+        assert sorted(result.keys()) == [1, 2, 3]
+        assert result[2].id == 2
+
+    @pytest.mark.asyncio
+    async def test_illust_details_non_utc_host(self, repo, monkeypatch):
+        import time
+        from datetime import datetime, timezone, timedelta
+        from nonebot_plugin_pixivbot.config import Config
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.global_context import context
+
+        conf = context.require(Config)
+        # 过期一小时，在东八区的主机上也不能被当作未过期
+        expired = datetime.now(timezone.utc) - timedelta(seconds=conf.pixiv_illust_detail_cache_expires_in + 3600)
+        await repo.update_illust_detail(self.make_illust(1), PixivRepoMetadata(update_time=expired))
+
+        monkeypatch.setenv("TZ", "Asia/Shanghai")
+        time.tzset()
+        try:
+            result = await repo.illust_details([1])
+        finally:
+            monkeypatch.undo()
+            time.tzset()
+        assert len(result) == 0
+
+    @pytest.mark.asyncio
+    async def test_write_behind_single_transaction(self, repo, monkeypatch):
+        import sqlite3
+        from contextlib import closing
+        from functools import partial
+        from sqlalchemy import event
+        from nonebot_plugin_pixivbot.config import Config
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.data.pixiv_repo.write_behind import WriteBehindQueue, WriteOp
+        from nonebot_plugin_pixivbot.data.source.sql import DataSource
+        from nonebot_plugin_pixivbot.global_context import context
+
+        conf = context.require(Config)
+        monkeypatch.setattr(conf, "pixiv_local_cache_type", "sql")
+
+        data_source = context.require(DataSource)
+        queue = WriteBehindQueue()
+        queue.flush_interval = 60
+
+        commits = []
+        event.listen(data_source.engine.sync_engine, "commit", commits.append)
+
+        visible = []
+
+        async def broken_update(content, metadata):
+            with closing(sqlite3.connect(conf.pixiv_sql_conn_url.split("///", 1)[1])) as conn:
+                visible.append(conn.execute("SELECT COUNT(*) FROM illust_detail_cache").fetchone()[0])
+
+            async with data_source.start_session(write=True) as session:
+                await repo._upsert_illust_details(session, [self.make_illust(100)], metadata.update_time)
+                raise RuntimeError("broken")
+
+        for i in range(1, 4):
+            await queue.put(("illust_detail", i),
+                            WriteOp("update", repo.update_illust_detail, self.make_illust(i), PixivRepoMetadata()))
+        await queue.put(("illust_detail", 100), WriteOp("update", broken_update, None, PixivRepoMetadata()))
+        await queue.put(("user_illusts", 1),
+                        WriteOp("append", partial(repo.append_user_illusts, 1),
+                                [self.make_illust(i) for i in range(4, 7)], PixivRepoMetadata(pages=1)))
+        await queue.flush()
+
+        # 同一次写入只提交一次，提交之前其他连接读不到之前的写入
+        assert len(commits) == 1
+        assert visible == [0]
+        assert queue.stats.flushed == 4 and queue.stats.failed == 1
+
+        # 失败的写入只回滚自己的部分
+        result = await repo.illust_details([1, 2, 3, 100])
+        assert sorted(result.keys()) == [1, 2, 3]
+        result = [x async for x in repo.user_illusts(1)]
+        assert [x.id for x in result[1:-1]] == [4, 5, 6]
+
+        await queue.close()
+
+    @pytest.mark.asyncio
+    async def test_write_behind_with_local_tag_flush(self, repo, monkeypatch):
+        import asyncio
+        from nonebot_plugin_pixivbot.config import Config
+        from nonebot_plugin_pixivbot.data import local_tag
+        from nonebot_plugin_pixivbot.data.pixiv_repo.models import PixivRepoMetadata
+        from nonebot_plugin_pixivbot.data.pixiv_repo.write_behind import WriteBehindQueue, WriteOp
+        from nonebot_plugin_pixivbot.data.source.sql import DataSource, _WriterLock
+        from nonebot_plugin_pixivbot.global_context import context
+
+        monkeypatch.setattr(context.require(Config), "pixiv_local_cache_type", "sql")
+        monkeypatch.setattr(local_tag, "_FLUSH_THRESHOLD", 1)
+        # 单例的锁可能已绑定到之前测试的事件循环
+        monkeypatch.setattr(context.require(DataSource), "_writer", _WriterLock())
+
+        tags = context.require(local_tag.LocalTagRepo)
+        monkeypatch.setattr(tags, "_flush_lock", None)
+        queue = WriteBehindQueue()
+        queue.flush_interval = 60
+
+        in_batch = asyncio.Event()
+        tag_flush_started = asyncio.Event()
+
+        async def wait_tag_flush(content, metadata):
+            in_batch.set()
+            await tag_flush_started.wait()
+
+        await queue.put(("wait", 0), WriteOp("update", wait_tag_flush))
+        await queue.put(("illust_detail", 1),
+                        WriteOp("update", repo.update_illust_detail, self.make_illust(1), PixivRepoMetadata()))
+
+        # 延迟写入的事务持有写入锁时，定时任务开始写入标签
+        write_behind_flush = asyncio.create_task(queue.flush())
+        await in_batch.wait()
+        tags._dirty["tag0"] = "标签0"
+        tag_flush = asyncio.create_task(tags.flush())
+        await asyncio.sleep(0.1)
+        tag_flush_started.set()
+
+        await asyncio.wait_for(asyncio.gather(write_behind_flush, tag_flush), 5)
+        while tags._flush_task is not None and not tags._flush_task.done():
+            await asyncio.sleep(0.01)
+
+        assert queue.stats.failed == 0
+        assert (await tags.find_by_name("tag1")).translated_name == "标签1"
+        assert len(tags._dirty) == 0
+
+        await queue.close()
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from tests import MyTest
+
+
+class TestWriteBehindQueue(MyTest):
+    @pytest.fixture
+    def queue(self):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.write_behind import WriteBehindQueue
+
+        queue = WriteBehindQueue()
+        queue.maxsize = 2
+        queue.flush_interval = 0.05
+        return queue
+
+    @pytest.mark.asyncio
+    async def test_coalesce(self, queue):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.write_behind import WriteOp
+
+        queue.maxsize = 16
+        written = []
+
+        async def append(content, metadata):
+            written.append(("append", content, metadata))
+
+        async def update(content, metadata):
+            written.append(("update", content, metadata))
+
+        async def invalidate():
+            written.append(("invalidate",))
+
+        await queue.put("a", WriteOp("append", append, [1, 2], 1))
+        await queue.put("a", WriteOp("append", append, [3], 2))
+        await queue.put("b", WriteOp("update", update, "x", 1))
+        await queue.put("b", WriteOp("update", update, "y", 2))
+        assert written == []
+
+        await queue.flush()
+        assert written == [("append", [1, 2, 3], 2), ("update", "y", 2)]
+        assert queue.stats.coalesced == 2
+
+        written.clear()
+        await queue.put("a", WriteOp("append", append, [4], 3))
+        await queue.put("a", WriteOp("invalidate", invalidate))
+        await queue.put("a", WriteOp("append", append, [5], 4))
+        await queue.wait_flushed("a")
+        assert written == [("invalidate",), ("append", [5], 4)]
+
+        await queue.close()
+
+    @pytest.mark.asyncio
+    async def test_backpressure(self, queue):
+        from nonebot_plugin_pixivbot.data.pixiv_repo.write_behind import WriteOp
+
+        written = []
+
+        async def update(content, metadata):
+            await asyncio.sleep(0.01)
+            written.append(content)
+
+        # 队列长度为2，第三次入队需要等待后台写入
+        for i in range(5):
+            await queue.put(i, WriteOp("update", update, i))
+            assert queue.pending <= 2
+
+        await queue.close()
+        assert written == [0, 1, 2, 3, 4]
+        assert queue.stats.max_pending == 2
@@ -0,0 +1,43 @@
+from collections import Counter
+
+import pytest
+
+from tests import MyTest
+
+
+class TestRoulette(MyTest):
+    @staticmethod
+    def make_illusts(n: int):
+        from nonebot_plugin_pixivbot.data.pixiv_repo import LazyIllust
+        from nonebot_plugin_pixivbot.model import LightIllust
+
+        return [LazyIllust(i, light=LightIllust(id=i, total_bookmarks=i * 100, total_view=0,
+                                                create_date="2023-01-01T00:00:00+09:00", tags=[],
+                                                illust_ai_type=0))
+                for i in range(n)]
+
+    @staticmethod
+    async def aiter(li):
+        for x in li:
+            yield x
+
+    @pytest.mark.asyncio
+    async def test_reservoir(self):
+        from nonebot_plugin_pixivbot.enums import RandomIllustMethod
+        from nonebot_plugin_pixivbot.service.roulette import roulette_stream
+
+        illusts = self.make_illusts(10)
+
+        winners, n = await roulette_stream(self.aiter(illusts), RandomIllustMethod.uniform, 3)
+        assert n == 10
+        assert len(winners) == 3 and len({x.id for x in winners}) == 3
+
+        winners, n = await roulette_stream(self.aiter(illusts[:2]), RandomIllustMethod.uniform, 3)
+        assert n == 2 and len(winners) == 2
+
+        # 概率正比于书签数（加10平滑）：9号被抽中的次数应远多于1号
+        counter = Counter()
+        for _ in range(2000):
+            winners, _ = await roulette_stream(self.aiter(illusts), RandomIllustMethod.bookmark_proportion, 1)
+            counter[winners[0].id] += 1
+        assert counter[9] > counter[1] * 4
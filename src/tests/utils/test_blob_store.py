@@ -0,0 +1,56 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from tests import MyTest
+
+
+class TestFileBlobStore(MyTest):
+    @pytest.fixture
+    def store(self, tmp_path):
+        from nonebot_plugin_pixivbot.utils.blob_store import FileBlobStore
+
+        return FileBlobStore(tmp_path)
+
+    @pytest.mark.asyncio
+    async def test_read_write(self, store):
+        now = datetime.now(timezone.utc)
+        assert await store.read("hello") is None
+        assert store.misses == 1
+
+        await store.write("hello", b"world", now)
+        update_time, content = await store.read("hello")
+        assert content == b"world"
+        assert abs((update_time - now).total_seconds()) < 1e-3
+        assert store.hits == 1
+
+        # 两级分片目录，且没有残留的临时文件
+        path = store.path_of("hello")
+        assert path.parent.parent.parent == store.root
+        assert list(path.parent.iterdir()) == [path]
+
+        await store.delete("hello")
+        assert await store.read("hello") is None
+
+    @pytest.mark.asyncio
+    async def test_corrupted(self, store):
+        await store.write("hello", b"world", datetime.now(timezone.utc))
+
+        path = store.path_of("hello")
+        data = bytearray(path.read_bytes())
+        data[-1] ^= 0xff
+        path.write_bytes(data)
+
+        assert await store.read("hello") is None
+        assert store.corrupted == 1
+        assert not path.exists()
+
+    @pytest.mark.asyncio
+    async def test_truncated(self, store):
+        await store.write("hello", b"world", datetime.now(timezone.utc))
+
+        path = store.path_of("hello")
+        path.write_bytes(path.read_bytes()[:-2])
+
+        assert await store.read("hello") is None
+        assert store.corrupted == 1
@@ -0,0 +1,63 @@
+from asyncio import create_task, sleep, gather
+
+import pytest
+
+from tests import MyTest
+
+
+class TestLaneSemaphore(MyTest):
+    @pytest.mark.asyncio
+    async def test_reserved(self):
+        from nonebot_plugin_pixivbot.utils.lane_semaphore import LaneSemaphore
+
+        sema = LaneSemaphore(3, weights={"a": 1, "b": 1}, reserved={"a": 1})
+
+        await sema.acquire("b")
+        await sema.acquire("b")
+        # 剩下的一个名额保留给a
+        task = create_task(sema.acquire("b"))
+        await sleep(0)
+        assert not task.done()
+
+        await sema.acquire("a")
+        assert sema.in_use("a") == 1
+
+        sema.release("b")
+        await sleep(0)
+        assert task.done()
+        assert sema.in_use("b") == 2
+
+    @pytest.mark.asyncio
+    async def test_weighted(self):
+        from nonebot_plugin_pixivbot.utils.lane_semaphore import LaneSemaphore
+
+        sema = LaneSemaphore(1, weights={"a": 3, "b": 1})
+        order = []
+
+        async def worker(lane):
+            async with sema.use(lane):
+                order.append(lane)
+                await sleep(0)
+
+        await sema.acquire("a")
+        tasks = [create_task(worker(lane)) for lane in ["b"] * 4 + ["a"] * 4]
+        await sleep(0)
+        sema.release("a")
+        await gather(*tasks)
+
+        assert order == ["a", "a", "b", "a", "a", "b", "b", "b"]
+
+    @pytest.mark.asyncio
+    async def test_cancel(self):
+        from nonebot_plugin_pixivbot.utils.lane_semaphore import LaneSemaphore
+
+        sema = LaneSemaphore(1, weights={"a": 1})
+        await sema.acquire("a")
+        task = create_task(sema.acquire("a"))
+        await sleep(0)
+        task.cancel()
+        await sleep(0)
+        assert sema.waiting("a") == 0
+
+        sema.release("a")
+        await sema.acquire("a")
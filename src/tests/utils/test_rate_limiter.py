@@ -0,0 +1,49 @@
+from asyncio import gather
+from time import monotonic
+
+import pytest
+
+from tests import MyTest
+
+
+class TestAIMDTokenBucket(MyTest):
+    @pytest.fixture
+    def bucket(self):
+        from nonebot_plugin_pixivbot.utils.rate_limiter import AIMDTokenBucket
+
+        return AIMDTokenBucket(max_rate=20, min_rate=1, burst=2, increase_step=1, decrease_cooldown=0)
+
+    @pytest.mark.asyncio
+    async def test_rate(self, bucket):
+        begin = monotonic()
+        await gather(*[bucket.acquire() for _ in range(6)])
+        # 前2个来自burst，剩下4个按20次/秒发出
+        assert monotonic() - begin >= 0.15
+
+    @pytest.mark.asyncio
+    async def test_aimd(self, bucket):
+        bucket.on_rate_limited()
+        assert bucket.rate == 10
+        bucket.on_rate_limited()
+        assert bucket.rate == 5
+
+        bucket.on_success()
+        assert bucket.rate == 6
+
+        for _ in range(100):
+            bucket.on_rate_limited()
+        assert bucket.rate == 1
+
+    @pytest.mark.asyncio
+    async def test_deadline(self, bucket):
+        from nonebot_plugin_pixivbot.utils.errors import RateLimitError
+
+        for _ in range(10):
+            bucket.on_rate_limited()
+
+        # 减速时令牌桶被清空，按1次/秒需要等待1秒
+        with pytest.raises(RateLimitError):
+            await bucket.acquire(0.1)
+        assert bucket.queue_depth == 0
+
+        await bucket.acquire(1.5)
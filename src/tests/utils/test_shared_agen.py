@@ -1,220 +1,178 @@
-# from asyncio import sleep, create_task, gather
-# from datetime import datetime, timedelta, timezone
-# from typing import AsyncGenerator
-# from unittest.mock import MagicMock, AsyncMock, call
-#
-# import pytest
-#
-# from tests import MyTest
-#
-#
-# class TestSharedAsyncGeneratorContextManager(MyTest):
-#     @pytest.fixture
-#     def origin_agen(self):
-#         cnt = 0
-#
-#         async def agen():
-#             nonlocal cnt
-#             for i in range(10):
-#                 await sleep(0.1)
-#                 yield cnt
-#                 cnt += 1
-#
-#         return agen()
-#
-#     @pytest.fixture
-#     def origin_agen_raises(self):
-#         cnt = 0
-#
-#         async def agen():
-#             nonlocal cnt
-#             for i in range(10):
-#                 await sleep(0.1)
-#                 yield cnt
-#                 cnt += 1
-#             raise RuntimeError()
-#
-#         return agen()
-#
-#     @pytest.fixture
-#     def ctx_mgr_factory(self):
-#         from nonebot_plugin_pixivbot.utils.shared_agen import SharedAsyncGeneratorHolder
-#
-#         def factory(origin_agen):
-#             on_each = AsyncMock()
-#             on_stop = AsyncMock()
-#             on_error = AsyncMock()
-#             on_consumers_changed = MagicMock()
-#
-#             # noinspection PyTypeChecker
-#             return SharedAsyncGeneratorHolder(
-#                 origin_agen,
-#                 on_each=on_each,
-#                 on_stop=on_stop,
-#                 on_error=on_error,
-#                 on_consumers_changed=on_consumers_changed
-#             )
-#
-#         return factory
-#
-#     @pytest.mark.asyncio
-#     async def test_on_each_and_on_stop(self, ctx_mgr_factory, origin_agen):
-#         ctx_mgr = ctx_mgr_factory(origin_agen)
-#         with ctx_mgr as iter:
-#             items = [i async for i in iter]
-#
-#         # noinspection PyUnresolvedReferences
-#         ctx_mgr._on_each.assert_has_awaits([call(i) for i in range(10)])
-#         # noinspection PyUnresolvedReferences
-#         ctx_mgr._on_stop.assert_awaited_once_with([i for i in range(10)])
-#
-#     @pytest.mark.asyncio
-#     async def test_on_error(self, ctx_mgr_factory, origin_agen_raises):
-#         ctx_mgr = ctx_mgr_factory(origin_agen_raises)
-#         with pytest.raises(RuntimeError) as e:
-#             with ctx_mgr as iter:
-#                 items = [i async for i in iter]
-#
-#             # noinspection PyUnresolvedReferences
-#             ctx_mgr._on_error.assert_awaited_once_with(e)
-#
-#     @pytest.mark.asyncio
-#     async def test_single_consumer(self, ctx_mgr_factory, origin_agen):
-#         ctx_mgr = ctx_mgr_factory(origin_agen)
-#         with ctx_mgr as iter:
-#             items = [i async for i in iter]
-#
-#         assert items == [i for i in range(10)]
-#
-#         # noinspection PyTypeChecker
-#         on_consumers_changed: MagicMock = ctx_mgr._on_consumers_changed
-#         assert on_consumers_changed.call_args_list[0].args == (ctx_mgr, 1)
-#         assert on_consumers_changed.call_args_list[1].args == (ctx_mgr, 0)
-#
-#     @pytest.mark.asyncio
-#     async def test_multi_consumer(self, ctx_mgr_factory, origin_agen):
-#         ctx_mgr = ctx_mgr_factory(origin_agen)
-#
-#         async def consume():
-#             with ctx_mgr as iter:
-#                 items = [i async for i in iter]
-#
-#             assert items == [i for i in range(10)]
-#
-#         # consumer2 except to wait for all the 10 items together
-#         consumer1 = create_task(consume())
-#         await sleep(0.25)
-#
-#         # consumer2 except to get 2 generated items, then wait for the rest 8 items together
-#         consumer2 = create_task(consume())
-#
-#         # consumer3 begin collecting after the agen stopped
-#         await sleep(1.5)
-#         consumer3 = create_task(consume())
-#
-#         await gather(consumer1, consumer2, consumer3)
-#
-#         # noinspection PyTypeChecker
-#         on_consumers_changed: MagicMock = ctx_mgr._on_consumers_changed
-#         assert on_consumers_changed.call_args_list[0].args == (ctx_mgr, 1)
-#         assert on_consumers_changed.call_args_list[1].args == (ctx_mgr, 2)
-#         assert on_consumers_changed.call_args_list[2].args == (ctx_mgr, 1)
-#         assert on_consumers_changed.call_args_list[3].args == (ctx_mgr, 0)
-#         assert on_consumers_changed.call_args_list[4].args == (ctx_mgr, 1)
-#         assert on_consumers_changed.call_args_list[5].args == (ctx_mgr, 0)
-#
-#     @pytest.mark.asyncio
-#     async def test_close(self, ctx_mgr_factory, origin_agen):
-#         ctx_mgr = ctx_mgr_factory(origin_agen)
-#         with ctx_mgr as iter:
-#             await iter.__anext__()
-#             await iter.__anext__()
-#
-#         ctx_mgr.close()
-#
-#         with ctx_mgr as iter:
-#             await iter.__anext__()
-#             await iter.__anext__()
-#             with pytest.raises(StopAsyncIteration):
-#                 await iter.__anext__()
-#
-#
-# class TestSharedAsyncGeneratorManager(MyTest):
-#     @pytest.fixture
-#     def shared_agen_mgr(self):
-#         from nonebot_plugin_pixivbot.utils.shared_agen import SharedAsyncGeneratorManager
-#
-#         class SharedAsyncGeneratorManagerImpl(SharedAsyncGeneratorManager[int, int]):
-#             def agen(self, identifier: int, *args, **kwargs) -> AsyncGenerator[int, None]:
-#                 async def agen():
-#                     cnt = identifier
-#                     for i in range(10):
-#                         await sleep(0.1)
-#                         yield cnt
-#                         cnt += 1
-#
-#                 return agen()
-#
-#         impl = SharedAsyncGeneratorManagerImpl()
-#         impl.on_agen_next = AsyncMock()
-#         impl.on_agen_stop = AsyncMock()
-#         return impl
-#
-#     @pytest.mark.asyncio
-#     async def test_get(self, shared_agen_mgr):
-#         # except same
-#         inst = shared_agen_mgr.get(0)
-#         with inst as iter:
-#             inst2 = shared_agen_mgr.get(0)
-#             with inst2 as iter2:
-#                 assert inst == inst2
-#
-#         # prev inst was except to be destroyed
-#
-#         inst3 = shared_agen_mgr.get(0)
-#         assert inst != inst3
-#
-#     @pytest.mark.asyncio
-#     async def test_set_expires_time(self, shared_agen_mgr):
-#         inst = shared_agen_mgr.get(0)
-#         with inst as iter:
-#             await iter.__anext__()
-#             await iter.__anext__()
-#
-#             await shared_agen_mgr.set_expires_time(0, datetime.now(timezone.utc) + timedelta(seconds=1))
-#
-#         # prev inst was except to be saved
-#
-#         inst2 = shared_agen_mgr.get(0)
-#         assert inst == inst2
-#
-#         await sleep(1.5)
-#
-#         # prev inst was except to be removed
-#
-#         inst2 = shared_agen_mgr.get(0)
-#         assert inst != inst2
-#
-#     @pytest.mark.asyncio
-#     async def test_invalidate(self, shared_agen_mgr):
-#         inst = shared_agen_mgr.get(0)
-#         with inst as iter:
-#             await iter.__anext__()
-#             await iter.__anext__()
-#
-#             await shared_agen_mgr.set_expires_time(0, datetime.now(timezone.utc) + timedelta(seconds=1))
-#
-#         # prev inst was except to be saved
-#
-#         inst2 = shared_agen_mgr.get(0)
-#         assert inst == inst2
-#
-#         await shared_agen_mgr.invalidate(0)
-#
-#         # prev inst was except to be removed
-#
-#         inst2 = shared_agen_mgr.get(0)
-#         assert inst != inst2
-#
-#         # invalidate a non-existing key should not raise
-#         await shared_agen_mgr.invalidate(114514)
+import time
+from asyncio import sleep, gather, create_task, CancelledError
+from typing import AsyncGenerator
+
+import pytest
+
+from tests import MyTest
+
+
+class TestSharedAsyncGeneratorManager(MyTest):
+    @pytest.fixture
+    def manager_factory(self):
+        from nonebot_plugin_pixivbot.utils.shared_agen import SharedAsyncGeneratorManager
+
+        class Manager(SharedAsyncGeneratorManager[str, bytes]):
+            async def agen(self, identifier: str, cache_strategy, **kwargs) -> AsyncGenerator[bytes, None]:
+                await self.set_expires_time(identifier, time.time() + 60)
+                for _ in range(kwargs.get("n", 4)):
+                    yield b"x" * kwargs.get("size", 100)
+
+            def group_of(self, identifier: str):
+                return identifier[0]
+
+        def factory(**kwargs):
+            return Manager(sizer=len, **kwargs)
+
+        return factory
+
+    @staticmethod
+    async def consume(manager, identifier, **kwargs):
+        async with manager.get(identifier, **kwargs) as gen:
+            return [x async for x in gen]
+
+    @pytest.mark.asyncio
+    async def test_replay(self, manager_factory):
+        manager = manager_factory()
+        assert await self.consume(manager, "a1") == [b"x" * 100] * 4
+        # 第二次从缓存的结果回放，不再调用agen
+        assert await self.consume(manager, "a1", n=0) == [b"x" * 100] * 4
+
+        stats = manager.stats
+        assert stats.cached == 1
+        assert stats.resident_bytes == 400
+        assert manager.get_expires_time("a1") > time.time()
+
+        await manager.invalidate("a1")
+        assert manager.stats.resident_bytes == 0
+
+    @pytest.mark.asyncio
+    async def test_evict_lru(self, manager_factory):
+        manager = manager_factory(max_bytes=1000)
+        await self.consume(manager, "a1")
+        await self.consume(manager, "a2")
+        await self.consume(manager, "a1")  # a1最近使用过
+        await self.consume(manager, "a3")
+
+        stats = manager.stats
+        assert stats.evicted == 1
+        assert stats.resident_bytes == 800
+        assert manager.get_expires_time("a2") is None
+        assert manager.get_expires_time("a1") is not None
+
+        # 单个超出预算的结果不会被缓存
+        await self.consume(manager, "a4", size=2000)
+        assert manager.get_expires_time("a4") is None
+        assert manager.stats.resident_bytes <= 1000
+
+    @pytest.mark.asyncio
+    async def test_group_budget(self, manager_factory):
+        manager = manager_factory(group_budgets={"i": 500})
+        await self.consume(manager, "a1")
+        await self.consume(manager, "i1")
+        await self.consume(manager, "i2")
+
+        stats = manager.stats
+        assert stats.resident_bytes_by_group == {"a": 400, "i": 400}
+        assert manager.get_expires_time("a1") is not None
+        assert manager.get_expires_time("i1") is None
+
+    @pytest.fixture
+    def broadcast_manager(self):
+        from nonebot_plugin_pixivbot.utils.shared_agen import SharedAsyncGeneratorManager
+
+        class Manager(SharedAsyncGeneratorManager[str, int]):
+            pulled = 0
+            closed = 0
+
+            async def agen(self, identifier: str, cache_strategy, **kwargs) -> AsyncGenerator[int, None]:
+                await self.set_expires_time(identifier, time.time() + 60)
+                try:
+                    for i in range(kwargs.get("n", 10)):
+                        await sleep(kwargs.get("delay", 0.01))
+                        self.pulled += 1
+                        yield i
+                    if kwargs.get("raises", False):
+                        raise RuntimeError()
+                finally:
+                    self.closed += 1
+
+        return Manager()
+
+    @pytest.mark.asyncio
+    async def test_broadcast(self, broadcast_manager):
+        results = await gather(*[self.consume(broadcast_manager, "a") for _ in range(10)])
+        assert all(x == list(range(10)) for x in results)
+        # 所有消费者共享同一次获取
+        assert broadcast_manager.pulled == 10
+
+    @pytest.mark.asyncio
+    async def test_error(self, broadcast_manager):
+        results = await gather(*[self.consume(broadcast_manager, "a", raises=True) for _ in range(3)],
+                               return_exceptions=True)
+        assert all(isinstance(x, RuntimeError) for x in results)
+        assert broadcast_manager.stats.running == 0
+
+    @pytest.mark.asyncio
+    async def test_callback_error(self, broadcast_manager, monkeypatch):
+        errors = []
+
+        async def on_agen_next(identifier, item):
+            if item == 3:
+                raise RuntimeError()
+
+        async def on_agen_error(identifier, e):
+            errors.append(e)
+            await broadcast_manager.invalidate(identifier)
+
+        monkeypatch.setattr(broadcast_manager, "on_agen_next", on_agen_next)
+        monkeypatch.setattr(broadcast_manager, "on_agen_error", on_agen_error)
+
+        # manager的回调出错时，消费者收到该错误而不是截断的结果
+        results = await gather(*[self.consume(broadcast_manager, "a") for _ in range(3)],
+                               return_exceptions=True)
+        assert all(isinstance(x, RuntimeError) for x in results)
+        assert len(errors) == 1
+        assert broadcast_manager.stats.running == 0
+
+    @pytest.mark.asyncio
+    async def test_cancel_consumer(self, broadcast_manager):
+        slow = create_task(self.consume(broadcast_manager, "a"))
+        fast = create_task(self.consume(broadcast_manager, "a"))
+        await sleep(0.05)
+        slow.cancel()
+
+        assert await fast == list(range(10))
+        with pytest.raises(CancelledError):
+            await slow
+
+    @pytest.mark.asyncio
+    async def test_all_consumers_exit(self, broadcast_manager):
+        async with broadcast_manager.get("a") as gen:
+            async for x in gen:
+                if x == 2:
+                    break
+
+        # origin在结束前被关闭，不再继续获取
+        assert broadcast_manager.closed == 1
+        assert broadcast_manager.pulled == 3
+        assert broadcast_manager.stats.running == 0
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("consumers", [1, 10, 50])
+    async def test_consumer_scaling(self, broadcast_manager, consumers):
+        results = await gather(*[self.consume(broadcast_manager, "a", n=200, delay=0)
+                                 for _ in range(consumers)])
+        assert all(x == list(range(200)) for x in results)
+        # 无论有多少消费者，origin都只获取一遍
+        assert broadcast_manager.pulled == 200
+        assert broadcast_manager.closed == 1
+
+    def test_estimate_size(self):
+        from nonebot_plugin_pixivbot.model import Tag
+        from nonebot_plugin_pixivbot.utils.shared_agen import estimate_size
+
+        assert estimate_size(b"x" * 10000) >= 10000
+        tags = [Tag(name="tag" * 100, translated_name="标签")] * 10
+        # 同一个对象只计算一次
+        assert estimate_size(tags) < estimate_size([Tag(name="tag" * 100)]) * 2
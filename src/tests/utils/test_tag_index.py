@@ -0,0 +1,39 @@
+from tests import MyTest
+
+
+class TestTagSearchIndex(MyTest):
+    def test_search(self):
+        from nonebot_plugin_pixivbot.utils.tag_index import TagSearchIndex
+
+        index = TagSearchIndex(100)
+        index.add("ラブライブ!", "ラブライブ!")
+        index.add("LoveLive!", "ラブライブ!")
+        index.add("ラブライブ!スーパースター!!", "ラブライブ!スーパースター!!", hits=10)
+        index.add("原神", "原神")
+        index.add("Genshin Impact", "原神")
+
+        # 大小写、全半角与标点不同
+        assert index.best_match("lovelive", 0.6) == "ラブライブ!"
+        assert index.best_match("ＧＥＮＳＨＩＮ　ＩＭＰＡＣＴ", 0.6) == "原神"
+        # 拼写接近
+        assert index.best_match("genshin inpact", 0.6) == "原神"
+        # 只差一个字符
+        assert index.best_match("ラブライ", 0.6) == "ラブライブ!"
+        # 较短的关键字不会匹配到以其为前缀的较长的标签
+        assert index.best_match("ラブラ", 0.6) is None
+        assert index.best_match("ラブライブスーパー", 0.6) is None
+        assert index.best_match("艦これ", 0.6) is None
+
+    def test_evict(self):
+        from nonebot_plugin_pixivbot.utils.tag_index import TagSearchIndex
+
+        index = TagSearchIndex(2)
+        index.add("aaa", "aaa")
+        index.add("bbb", "bbb")
+        index.add("aaa", "aaa")
+        index.add("ccc", "ccc")
+
+        assert len(index) == 2
+        assert index.best_match("bbb", 0.6) is None
+        assert index.best_match("aaa", 0.6) == "aaa"
+        assert "bb" not in index._postings